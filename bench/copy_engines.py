@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from bench.tree import PROFILES, generate_tree, sample_spec
+from setup.ramdisk.copy_mounts import copy_from_source
+from setup.ramdisk.copy_strategies import CopyStrategies, CpStrategy
+from utils.ramboot_config import RambootConfig
+
+# File-level copy strategies behind copy_from_source, cp does not use the copy workers and runs once per tree
+ENGINES = [name for name in CopyStrategies.get_names() if not CopyStrategies.get(name).block_level]
+DEFAULT_WORKERS = [1, 4, 8, 16]
+
+
+def get_commit() -> str | None:
+    """
+    Get the commit being benchmarked, so results can be told apart.
+
+    Returns:
+        str | None: The commit hash, with a -dirty suffix for uncommitted changes, or None outside a git checkout.
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty", "--abbrev=12"], cwd=repo_dir,
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_cpu_seconds() -> Tuple[float, float]:
+    """
+    Get the CPU time used so far by this process and by its finished children.
+
+    Returns:
+        Tuple[float, float]: The user plus system seconds of this process and of its children.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+def drop_caches() -> None:
+    """
+    Drop the page, dentry and inode caches, so the source is read from disk.
+
+    Returns:
+        None
+    """
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3")
+
+
+def run_copy(source: str, dest: str, engine: str, workers: int, cold: bool) -> Dict:
+    """
+    Copy a tree once with a copy strategy, timing it.
+
+    Args:
+        source (str): The tree to copy.
+        dest (str): An empty directory to copy into, removed afterwards.
+        engine (str): One of ENGINES.
+        workers (int): The number of copy workers, for the builtin engine and strategies built on it.
+        cold (bool): Whether to drop the caches first.
+
+    Returns:
+        Dict: The seconds, CPU seconds of this process and its children, files and bytes copied, and the seconds of
+            the data and metadata phases of the builtin engine.
+    """
+    RambootConfig.get_config().read_dict({"copy": {"copy_workers": str(workers)}})
+    os.makedirs(dest)
+
+    # Write back the previous run first, so it does not compete with this one
+    if cold:
+        drop_caches()
+    else:
+        os.sync()
+
+    own_start, children_start = get_cpu_seconds()
+    start = time.perf_counter()
+    stats = copy_from_source(source, dest, strategy=engine)
+    seconds = time.perf_counter() - start
+    own_end, children_end = get_cpu_seconds()
+
+    shutil.rmtree(dest)
+
+    return {"seconds": seconds, "cpu_seconds": own_end - own_start,
+            "children_cpu_seconds": children_end - children_start,
+            "files": stats.files_copied, "bytes": stats.bytes_copied, "errors": stats.errors,
+            "data_seconds": stats.data_seconds, "metadata_seconds": stats.metadata_seconds}
+
+
+def benchmark_tree(name: str, source: str, dest: str, counts: Dict, engines: List[str], workers: List[int],
+                   repeat: int, cold: bool) -> List[Dict]:
+    """
+    Copy a tree with every engine and worker count, keeping the median of the repeated runs.
+
+    Args:
+        name (str): The name the tree is reported under.
+        source (str): The tree to copy.
+        dest (str): A directory to copy into, which must not exist.
+        counts (Dict): The files, bytes, symlinks and hardlinks in the tree.
+        engines (List[str]): The engines to run.
+        workers (List[int]): The worker counts to run the strategies other than cp with.
+        repeat (int): How many times to run each combination.
+        cold (bool): Whether to drop the caches before each run.
+
+    Returns:
+        List[Dict]: One result per engine and worker count.
+    """
+    results = []
+    entries = counts["files"] + counts["symlinks"] + counts["hardlinks"]
+
+    for engine in engines:
+        for worker_count in (workers if engine != CpStrategy.name else [1]):
+            runs = [run_copy(source, dest, engine, worker_count, cold) for _ in range(repeat)]
+            seconds = statistics.median(run["seconds"] for run in runs)
+
+            results.append({"tree": name, "engine": engine, "workers": worker_count if engine != CpStrategy.name else None,
+                            "seconds": round(seconds, 4),
+                            "files_per_second": round(entries / seconds, 1),
+                            "mb_per_second": round(counts["bytes"] / 10 ** 6 / seconds, 2),
+                            "cpu_seconds": round(statistics.median(run["cpu_seconds"] for run in runs), 3),
+                            "children_cpu_seconds": round(statistics.median(run["children_cpu_seconds"]
+                                                                            for run in runs), 3),
+                            "data_seconds": round(statistics.median(run["data_seconds"] for run in runs), 4),
+                            "metadata_seconds": round(statistics.median(run["metadata_seconds"] for run in runs), 4),
+                            "errors": max(run["errors"] for run in runs)})
+
+    return results
+
+
+def get_key(result: Dict) -> Tuple:
+    """
+    Get what identifies a result across runs of the benchmark.
+
+    Args:
+        result (Dict): A result of benchmark_tree.
+
+    Returns:
+        Tuple: The tree, engine and worker count.
+    """
+    return result["tree"], result["engine"], result["workers"]
+
+
+def print_results(report: Dict, baseline: Dict | None) -> None:
+    """
+    Print the results as a table, with the change against a baseline run if given.
+
+    Args:
+        report (Dict): The report of this run.
+        baseline (Dict | None): The report of an earlier run, such as on another commit.
+
+    Returns:
+        None
+    """
+    baseline_results = {get_key(result): result for result in baseline["results"]} if baseline else {}
+
+    if baseline:
+        print(f"Comparing {report['commit']} against {baseline['commit']}")
+        for name, tree in report["trees"].items():
+            if baseline["trees"].get(name, tree) != tree:
+                print(f"Warning: {name} differs from the baseline tree, its results are not comparable")
+
+    for name, tree in report["trees"].items():
+        print(f"{name}: {tree['files']} files, {tree['symlinks']} symlinks, {tree['hardlinks']} hardlinks, "
+              f"{tree['dirs']} directories, {tree['bytes'] / 10 ** 6:.1f} MB")
+
+    print()
+    print(f"{'tree':<14} {'engine':<11} {'workers':>7} {'seconds':>9} {'files/s':>10} {'MB/s':>8} {'cpu':>7} "
+          f"{'children':>8}{'  vs baseline' if baseline else ''}")
+
+    for result in report["results"]:
+        change = ""
+        if get_key(result) in baseline_results:
+            change = f"  {baseline_results[get_key(result)]['seconds'] / result['seconds']:>10.2f}x"
+
+        print(f"{result['tree']:<14} {result['engine']:<11} {result['workers'] or '-':>7} {result['seconds']:>9.3f} "
+              f"{result['files_per_second']:>10.0f} {result['mb_per_second']:>8.1f} {result['cpu_seconds']:>7.2f} "
+              f"{result['children_cpu_seconds']:>8.2f}{change}")
+
+
+def main() -> None:
+    """
+    Benchmark the copy engines behind copy_from_source on synthetic trees of different shapes.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(prog="python -m bench.copy_engines",
+                                     description="Benchmark the copy strategies on synthetic trees of several shapes.")
+    parser.add_argument("--profile", nargs="*", choices=sorted(PROFILES), default=sorted(PROFILES),
+                        help="Built-in tree shapes to generate")
+    parser.add_argument("--spec", action="append", default=[], help="Tree shape as JSON, such as from --sample")
+    parser.add_argument("--sample", metavar="PATH", help="Print the shape of an existing tree as JSON and exit")
+    parser.add_argument("--entries", type=int, default=10000, help="Files, symlinks and hardlinks per tree")
+    parser.add_argument("--max-mb", type=int, default=1000, help="Stop growing a tree once it holds this many MB")
+    parser.add_argument("--engine", nargs="*", choices=ENGINES, default=ENGINES, help="Copy strategies to run")
+    parser.add_argument("--workers", type=int, nargs="*", default=DEFAULT_WORKERS,
+                        help="Copy worker counts for the strategies other than cp")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per combination, the median is kept")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic trees")
+    parser.add_argument("--work-dir", default="/var/tmp",
+                        help="Where to generate the trees and copy them to, a tmpfs measures the copy alone")
+    parser.add_argument("--cold", action="store_true", help="Drop the caches before each run, needs root")
+    parser.add_argument("--baseline", help="Results of an earlier run, saved with --json, to compare against")
+    parser.add_argument("--json", action="store_true", help="Print JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="ramboot: %(message)s")
+
+    if args.sample:
+        print(json.dumps(sample_spec(args.sample, RambootConfig.get_scan_workers()), indent=2))
+        return
+
+    # Progress reports would only add noise
+    RambootConfig.get_config().read_dict({"progress": {"interval": "0"}})
+
+    specs = {name: PROFILES[name] for name in args.profile}
+    for path in args.spec:
+        with open(path) as f:
+            specs[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+
+    report = {"commit": get_commit(), "entries": args.entries, "max_mb": args.max_mb, "seed": args.seed,
+              "cold": args.cold, "trees": {}, "results": []}
+
+    with tempfile.TemporaryDirectory(prefix="ramboot-bench-", dir=args.work_dir) as work_dir:
+        for name, spec in specs.items():
+            source = os.path.join(work_dir, name)
+            counts = generate_tree(source, args.entries, spec, args.seed, args.max_mb * 10 ** 6)
+            report["trees"][name] = dict(counts, spec=spec)
+            report["results"] += benchmark_tree(name, source, os.path.join(work_dir, "dest"), counts, args.engine,
+                                                args.workers, args.repeat, args.cold)
+            shutil.rmtree(source)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_results(report, baseline)
+
+    if any(result["errors"] for result in report["results"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
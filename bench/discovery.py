@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from bench.topology import generate
+from setup.mounts import fstab
+from setup.mounts.mount_info import AllMounts
+from setup.mounts.mounts import check_for_ignored_mounts, get_all_mounts
+from setup.zfs import zfs
+from utils.command_replay import CommandReplay
+from utils.ramboot_config import RambootConfig
+
+DEFAULT_SIZES = [10, 100, 1000, 5000]
+
+
+def replay_fixture(fixture: Dict, fstab_file: str) -> None:
+    """
+    Point discovery at a fixture, writing its fstab to a file and answering commands from it.
+
+    Args:
+        fixture (Dict): The recorded or generated fixture.
+        fstab_file (str): Where to write the fixture's fstab.
+
+    Returns:
+        None
+    """
+    with open(fstab_file, "w") as f:
+        f.write(fixture["fstab"])
+
+    RambootConfig.get_config().read_dict({"mounts": {"fstab_file": fstab_file}})
+    CommandReplay.replay(fixture)
+
+
+def measure(name: str, fixture: Dict, fstab_file: str, repeat: int) -> Dict:
+    """
+    Time discovery against a fixture, as a whole and split into listing the mounts and building AllMounts.
+
+    Args:
+        name (str): The name the fixture is reported under.
+        fixture (Dict): The recorded or generated fixture.
+        fstab_file (str): Where to write the fixture's fstab.
+        repeat (int): How many times to run each measurement, the fastest run is kept.
+
+    Returns:
+        Dict: The timings, the number of mounts found and the commands run per program.
+    """
+    result = {"fixture": name, "get_all_mounts": float("inf"), "listing": float("inf"), "all_mounts": float("inf")}
+
+    for _ in range(repeat):
+        replay_fixture(fixture, fstab_file)
+        start = time.perf_counter()
+        mounts = get_all_mounts()
+        result["get_all_mounts"] = min(result["get_all_mounts"], time.perf_counter() - start)
+        result["mounts"] = len(mounts)
+        result["commands"] = dict(CommandReplay.get_counts())
+
+        replay_fixture(fixture, fstab_file)
+        start = time.perf_counter()
+        listed = check_for_ignored_mounts(fstab.get_mounts() + zfs.get_mounts())
+        listed_at = time.perf_counter()
+        AllMounts(listed)
+        result["listing"] = min(result["listing"], listed_at - start)
+        result["all_mounts"] = min(result["all_mounts"], time.perf_counter() - listed_at)
+
+    CommandReplay.stop()
+    return result
+
+
+def check(result: Dict, max_commands_per_mount: float, expected_commands: int | None) -> List[str]:
+    """
+    Check the commands a discovery run invoked against the budget.
+
+    Args:
+        result (Dict): The result of measure.
+        max_commands_per_mount (float): The most commands discovery may run per mount found.
+        expected_commands (int | None): The exact number of commands expected, if known.
+
+    Returns:
+        List[str]: The failed checks.
+    """
+    failures = []
+    total = sum(result["commands"].values())
+
+    if total > max_commands_per_mount * result["mounts"]:
+        failures.append(f"{result['fixture']}: {total} commands for {result['mounts']} mounts, more than "
+                        f"{max_commands_per_mount} per mount")
+
+    if expected_commands is not None and total != expected_commands:
+        failures.append(f"{result['fixture']}: {total} commands, expected {expected_commands}")
+
+    return failures
+
+
+def main() -> None:
+    """
+    Benchmark mount discovery against recorded fixtures and synthetic topologies, without running any command.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(prog="python -m bench.discovery",
+                                     description="Benchmark mount discovery on fixtures and synthetic topologies.")
+    parser.add_argument("--fixture", action="append", default=[], help="Fixture recorded with record-commands")
+    parser.add_argument("--mounts", type=int, nargs="*", default=None,
+                        help=f"Synthetic topology sizes to generate (default: {DEFAULT_SIZES} without fixtures)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic topologies")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the fastest is kept")
+    parser.add_argument("--max-commands-per-mount", type=float, default=10.0,
+                        help="Fail if discovery runs more commands than this per mount")
+    parser.add_argument("--expect-commands", type=int, default=None,
+                        help="Fail unless discovery runs exactly this many commands, with a single fixture or size")
+    parser.add_argument("--json", action="store_true", help="Print JSON")
+    args = parser.parse_args()
+
+    fixtures = []
+    for path in args.fixture:
+        with open(path) as f:
+            fixtures.append((os.path.basename(path), json.load(f)))
+
+    sizes = args.mounts if args.mounts is not None else ([] if fixtures else DEFAULT_SIZES)
+    fixtures += [(f"synthetic-{size}", generate(size, seed=args.seed)) for size in sizes]
+
+    results = []
+    failures = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, fixture in fixtures:
+            result = measure(name, fixture, os.path.join(temp_dir, "fstab"), args.repeat)
+            results.append(result)
+            failures += check(result, args.max_commands_per_mount, args.expect_commands)
+
+    if args.json:
+        print(json.dumps({"results": results, "failures": failures}, indent=2))
+    else:
+        print(f"{'fixture':<20} {'mounts':>7} {'commands':>9} {'get_all_mounts':>15} {'listing':>9} "
+              f"{'AllMounts':>10}  commands by program")
+
+        for result in results:
+            programs = ", ".join(f"{program} {count}" for program, count in sorted(result["commands"].items()))
+            print(f"{result['fixture']:<20} {result['mounts']:>7} {sum(result['commands'].values()):>9} "
+                  f"{result['get_all_mounts']:>14.3f}s {result['listing']:>8.3f}s {result['all_mounts']:>9.3f}s  "
+                  f"{programs}")
+
+        for failure in failures:
+            print(f"FAIL: {failure}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+from __future__ import annotations
+
+import argparse
+import configparser
+import glob
+import json
+import logging
+import os
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from bench.tree import generate_tree
+from ramboot import phase
+from setup.mounts.mounts import get_all_mounts
+from setup.ramdisk.copy_mounts import copy_all_mounts
+from setup.ramdisk.main_ramdisk import RAMDISK_DEV, create_ramdisk
+from utils.phase_profiler import PhaseProfiler
+from utils.shell_commands import run_command
+from utils.trace import Tracer
+
+# Source filesystems the harness can build, lvm is ext4 on a logical volume
+FILESYSTEMS = ["ext4", "xfs", "btrfs", "lvm"]
+MKFS_CMDS = {"ext4": ["/usr/sbin/mkfs.ext4", "-q", "-F"], "xfs": ["/usr/sbin/mkfs.xfs", "-q", "-f"],
+             "btrfs": ["/usr/sbin/mkfs.btrfs", "-q", "-f"]}
+VG_NAME = "rambootbench"
+
+# Host directories bind mounted into the synthetic root, so ramboot and the tools it runs work inside it
+HOST_DIRS = ["usr", "bin", "sbin", "lib", "lib32", "lib64", "etc", "run"]
+
+
+def wait_for_partition(device: str) -> None:
+    """
+    Make sure the device node of a partition exists, creating it from sysfs where no udev does so, like in a container.
+
+    Args:
+        device (str): The partition device path.
+
+    Returns:
+        None
+    """
+    if os.path.exists("/usr/bin/udevadm"):
+        run_command(["/usr/bin/udevadm", "settle"])
+
+    sysfs_dev = os.path.join("/sys/class/block", os.path.basename(device), "dev")
+    if not os.path.exists(device) and os.path.exists(sysfs_dev):
+        with open(sysfs_dev) as f:
+            major, minor = f.read().strip().split(":")
+
+        os.mknod(device, 0o660 | stat.S_IFBLK, os.makedev(int(major), int(minor)))
+
+
+def make_source(name: str, fstype: str, work_dir: str, size_mb: int) -> Dict:
+    """
+    Build a loop device backed source filesystem on a partitioned image file.
+
+    Args:
+        name (str): The name of the source, used for its image file.
+        fstype (str): One of FILESYSTEMS.
+        work_dir (str): The directory holding the image files.
+        size_mb (int): The size of the image in MiB.
+
+    Returns:
+        Dict: The image, loop device, filesystem device and filesystem type of the source.
+    """
+    image = os.path.join(work_dir, f"{name}.img")
+
+    with open(image, "wb") as f:
+        f.truncate(size_mb * 1024 ** 2)
+
+    # Partitioned, since discovery sizes mounts by their partition
+    run_command(["/usr/sbin/sgdisk", "--new", "1::", image], check=True, stdout=subprocess.DEVNULL)
+    loop = run_command(["losetup", "--find", "--show", "--partscan", image], check=True,
+                       stdout=subprocess.PIPE).stdout.decode("utf-8").strip()
+    device = f"{loop}p1"
+    wait_for_partition(device)
+
+    if fstype == "lvm":
+        run_command(["/usr/sbin/pvcreate", "--quiet", device], check=True)
+        run_command(["/usr/sbin/vgcreate", "--quiet", VG_NAME, device], check=True)
+        run_command(["/usr/sbin/lvcreate", "--quiet", "--yes", "--name", name, "--extents", "100%FREE", VG_NAME],
+                    check=True)
+        device = f"/dev/mapper/{VG_NAME}-{name}"
+        fstype = "ext4"
+
+    run_command(MKFS_CMDS[fstype] + [device], check=True)
+
+    return {"image": image, "loop": loop, "device": device, "fstype": fstype}
+
+
+def populate_source(source: Dict, work_dir: str, entries: int, seed: int, mount_points: List[str] = ()) -> Dict:
+    """
+    Fill a source filesystem with a synthetic tree.
+
+    Args:
+        source (Dict): The source, as returned by make_source.
+        work_dir (str): The directory to mount the source below while filling it.
+        entries (int): The number of files, symlinks and hardlinks to create.
+        seed (int): The seed for the tree.
+        mount_points (List[str]): Directories to create for other filesystems to be mounted on, relative to the root.
+
+    Returns:
+        Dict: The counts of the generated tree.
+    """
+    mount_point = os.path.join(work_dir, "mnt")
+    os.makedirs(mount_point, exist_ok=True)
+    run_command(["mount", source["device"], mount_point], check=True)
+
+    try:
+        counts = generate_tree(os.path.join(mount_point, "tree"), entries, seed=seed)
+
+        for rel_path in mount_points:
+            host_path = os.path.join(os.path.sep, rel_path)
+
+            # Keep the host's symlinks, such as /bin -> usr/bin, so paths resolve the same inside the root
+            if os.path.islink(host_path):
+                os.symlink(os.readlink(host_path), os.path.join(mount_point, rel_path))
+            else:
+                os.makedirs(os.path.join(mount_point, rel_path), exist_ok=True)
+    finally:
+        run_command(["umount", mount_point], check=True)
+
+    return counts
+
+
+def write_config(work_dir: str, config_files: List[str], overrides: List[str]) -> str:
+    """
+    Write the ramboot config used inside the benchmark, pointing it at the synthetic fstab.
+
+    Trace, profile and progress output go to the work directory unless configured otherwise.
+
+    Args:
+        work_dir (str): The work directory, also holding the fstab.
+        config_files (List[str]): Config files to start from, later ones taking precedence.
+        overrides (List[str]): Options as section.option=value, taking precedence over the files.
+
+    Returns:
+        str: The path of the written config.
+    """
+    config = configparser.ConfigParser()
+    config.read_dict({"trace": {"file": os.path.join(work_dir, "trace.json")},
+                      "profiling": {"directory": os.path.join(work_dir, "profile")},
+                      "progress": {"output": os.path.join(work_dir, "progress.log")}})
+    config.read(config_files)
+
+    for override in overrides:
+        option, value = override.split("=", 1)
+        section, option = option.split(".", 1)
+        config.read_dict({section: {option: value}})
+
+    config.read_dict({"mounts": {"fstab_file": os.path.join(work_dir, "fstab")}})
+
+    path = os.path.join(work_dir, "ramboot.conf")
+    with open(path, "w") as f:
+        config.write(f)
+
+    return path
+
+
+def get_peak_rss() -> int:
+    """
+    Get the peak resident set size of this process since it was last reset.
+
+    Returns:
+        int: The peak resident bytes.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+def reset_peak_rss() -> None:
+    """
+    Reset the peak resident set size of this process to its current size, so each phase reports its own peak.
+
+    Returns:
+        None
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def measure_phase(results: List[Dict], name: str, func: Callable):
+    """
+    Run a phase of the boot, recording its time, CPU time and peak memory.
+
+    Args:
+        results (List[Dict]): The results to append the phase to.
+        name (str): The name of the phase.
+        func (Callable): The phase, called without arguments.
+
+    Returns:
+        The return value of the phase.
+    """
+    reset_peak_rss()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+
+    with phase(name):
+        value = func()
+
+    seconds = time.monotonic() - start
+    own_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    results.append({"phase": name, "seconds": round(seconds, 3),
+                    "cpu_seconds": round(own_end.ru_utime + own_end.ru_stime - own.ru_utime - own.ru_stime, 3),
+                    "children_cpu_seconds": round(children_end.ru_utime + children_end.ru_stime
+                                                  - children.ru_utime - children.ru_stime, 3),
+                    "peak_rss_bytes": get_peak_rss(),
+                    "children_peak_rss_bytes": children_end.ru_maxrss * 1024})
+
+    return value
+
+
+def get_ramdisk_used() -> int:
+    """
+    Get the bytes used on the filesystems of the RAM disk.
+
+    Returns:
+        int: The used bytes, summed over every mounted RAM disk partition.
+    """
+    used = 0
+    seen = set()
+
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            device, mount_point = line.split()[:2]
+
+            if device.startswith(RAMDISK_DEV) and device not in seen:
+                seen.add(device)
+                stats = os.statvfs(mount_point)
+                used += (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+
+    return used
+
+
+def run_inside(root_device: str, work_dir: str, repo_dir: str) -> None:
+    """
+    Run discovery, create_ramdisk and copy_all_mounts chrooted into the synthetic root, stopping before pivot_root.
+
+    Runs in its own mount namespace, so every mount made here, including the RAM disk, goes away with it.  Host
+    directories are bind mounted into the root for the tools, on mount points the root copy does not descend into.
+
+    Args:
+        root_device (str): The device of the synthetic root filesystem.
+        work_dir (str): The work directory, holding the fstab, config and results.
+        repo_dir (str): The directory ramboot is run from.
+
+    Returns:
+        None
+    """
+    root = os.path.join(work_dir, "root")
+    os.makedirs(root, exist_ok=True)
+    run_command(["mount", root_device, root], check=True)
+
+    for name in HOST_DIRS:
+        host_path = os.path.join(os.path.sep, name)
+        if os.path.isdir(host_path) and not os.path.islink(host_path):
+            run_command(["mount", "--rbind", host_path, os.path.join(root, name)], check=True)
+
+    run_command(["mount", "--rbind", "/dev", os.path.join(root, "dev")], check=True)
+    run_command(["mount", "--rbind", "/sys", os.path.join(root, "sys")], check=True)
+    run_command(["mount", "--types", "proc", "proc", os.path.join(root, "proc")], check=True)
+    run_command(["mount", "--types", "tmpfs", "tmpfs", os.path.join(root, "tmp")], check=True)
+
+    # Same paths inside and out, so nothing needs translating
+    for path in sorted({repo_dir, work_dir, sys.prefix, sys.base_prefix}):
+        if path.lstrip(os.path.sep).split(os.path.sep)[0] in HOST_DIRS:
+            continue
+
+        os.makedirs(os.path.join(root, path.lstrip(os.path.sep)), exist_ok=True)
+        run_command(["mount", "--bind", path, os.path.join(root, path.lstrip(os.path.sep))], check=True)
+
+    os.chroot(root)
+    os.chdir(repo_dir)
+
+    results: List[Dict] = []
+    start = time.monotonic()
+
+    try:
+        all_mounts = measure_phase(results, "get_all_mounts", get_all_mounts)
+        physical_mounts = all_mounts.get_physical_mounts()
+        ramdisk_base = measure_phase(results, "create_ramdisk", lambda: create_ramdisk(physical_mounts))
+        measure_phase(results, "copy_all_mounts", lambda: copy_all_mounts(physical_mounts, ramdisk_base))
+    finally:
+        Tracer.save()
+        PhaseProfiler.save()
+
+    with open(os.path.join(work_dir, "result.json"), "w") as f:
+        json.dump({"phases": results, "seconds": round(time.monotonic() - start, 3), "mounts": len(physical_mounts),
+                   "ramdisk_used_bytes": get_ramdisk_used(),
+                   "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}, f, indent=2)
+
+
+def cleanup(work_dir: str, uses_lvm: bool, keep: bool) -> None:
+    """
+    Remove the volume group, loop devices and RAM disk of a benchmark run.
+
+    Args:
+        work_dir (str): The work directory, holding the images.
+        uses_lvm (bool): Whether a volume group was created.
+        keep (bool): Whether to keep the work directory, with its images, trace and profiles.
+
+    Returns:
+        None
+    """
+    if uses_lvm:
+        run_command(["/usr/sbin/vgremove", "--quiet", "--force", VG_NAME])
+
+    for image in glob.glob(os.path.join(work_dir, "*.img")):
+        output = run_command(["losetup", "--associated", image], check=True,
+                             stdout=subprocess.PIPE).stdout.decode("utf-8")
+
+        for line in output.splitlines():
+            run_command(["losetup", "--detach", line.split(":")[0]])
+
+    # Only ever loaded by this run, see run_benchmark
+    if os.path.exists("/sys/module/brd"):
+        run_command(["/usr/sbin/rmmod", "brd"])
+
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict:
+    """
+    Build the sources, run the boot phases in a private mount namespace and collect the results.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+
+    Returns:
+        Dict: The results, including the sources and the config used.
+    """
+    # The RAM disk module is global, a loaded one may hold a booted ramdisk
+    if os.path.exists("/sys/module/brd"):
+        raise RuntimeError("The brd module is already loaded, unload it first")
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="ramboot-bench-", dir=args.work_dir)
+    sources: List[Dict] = []
+
+    try:
+        root = make_source("root", args.root_fstype, work_dir, args.size_mb)
+        sources.append(root)
+
+        fstab = [f"{root['device']}\t/\t{root['fstype']}\tdefaults\t0\t1"]
+        mount_points = HOST_DIRS + ["dev", "sys", "proc", "tmp"]
+
+        for index, fstype in enumerate(args.fs, start=1):
+            source = make_source(f"{fstype}{index}", fstype, work_dir, args.size_mb)
+            source["dest"] = f"/srv/{fstype}{index}"
+            source["tree"] = populate_source(source, work_dir, args.entries, args.seed + index)
+            sources.append(source)
+
+            fstab.append(f"{source['device']}\t{source['dest']}\t{source['fstype']}\tdefaults\t0\t2")
+            mount_points.append(source["dest"].lstrip(os.path.sep))
+
+        root["dest"] = "/"
+        root["tree"] = populate_source(root, work_dir, args.entries, args.seed, mount_points)
+
+        with open(os.path.join(work_dir, "fstab"), "w") as f:
+            f.write("\n".join(fstab) + "\n")
+
+        config = write_config(work_dir, args.config, args.set)
+
+        if not args.keep_caches:
+            os.sync()
+            with open("/proc/sys/vm/drop_caches", "w") as f:
+                f.write("3")
+
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        run_command(["unshare", "--mount", "--propagation", "private", sys.executable, "-m", "bench.e2e",
+                     "--inside", root["device"], work_dir],
+                    check=True, cwd=repo_dir, env=dict(os.environ, RAMBOOT_CONFIG=config))
+
+        with open(os.path.join(work_dir, "result.json")) as f:
+            result = json.load(f)
+
+        with open(config) as f:
+            result["config"] = f.read()
+    finally:
+        cleanup(work_dir, "lvm" in args.fs, args.keep)
+
+    result["sources"] = [{"dest": source["dest"], "fstype": source["fstype"], "device": source["device"],
+                          **source["tree"]} for source in sources]
+    result["work_dir"] = work_dir if args.keep else None
+
+    return result
+
+
+def print_result(result: Dict) -> None:
+    """
+    Print the phase timings and memory use of a benchmark run.
+
+    Args:
+        result (Dict): The results of run_benchmark.
+
+    Returns:
+        None
+    """
+    source_bytes = sum(source["bytes"] for source in result["sources"])
+    source_files = sum(source["files"] + source["symlinks"] + source["hardlinks"] for source in result["sources"])
+
+    for source in result["sources"]:
+        print(f"{source['dest']:<12} {source['fstype']:<6} {source['files']:>8} files "
+              f"{source['bytes'] / 2 ** 20:>9.1f} MiB")
+
+    print()
+    print(f"{'phase':<16} {'seconds':>8} {'cpu':>8} {'children':>9} {'peak rss':>10} {'children rss':>13}")
+
+    for row in result["phases"]:
+        print(f"{row['phase']:<16} {row['seconds']:>8.2f} {row['cpu_seconds']:>8.2f} "
+              f"{row['children_cpu_seconds']:>9.2f} {row['peak_rss_bytes'] / 2 ** 20:>7.1f}MiB "
+              f"{row['children_peak_rss_bytes'] / 2 ** 20:>10.1f}MiB")
+
+    copy_seconds = next(row["seconds"] for row in result["phases"] if row["phase"] == "copy_all_mounts")
+    print()
+    print(f"Copied {source_files} entries, {source_bytes / 2 ** 20:.1f} MiB, in {copy_seconds:.2f}s: "
+          f"{source_files / copy_seconds:.0f} files/s, {source_bytes / 2 ** 20 / copy_seconds:.1f} MiB/s")
+    print(f"RAM disk holds {result['ramdisk_used_bytes'] / 2 ** 20:.1f} MiB, "
+          f"peak RSS {result['peak_rss_bytes'] / 2 ** 20:.1f} MiB")
+
+    if result["work_dir"] is not None:
+        print(f"Trace, profiles and images kept in {result['work_dir']}")
+
+
+def main() -> None:
+    """
+    Benchmark discovery, RAM disk creation and the copy on loop device backed sources, stopping before pivot_root.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(prog="python -m bench.e2e",
+                                     description="Benchmark discovery, RAM disk creation and the copy on loop devices.")
+    parser.add_argument("--fs", nargs="*", choices=FILESYSTEMS, default=FILESYSTEMS,
+                        help="Sources to mount below /srv, besides the root")
+    parser.add_argument("--root-fstype", choices=["ext4", "xfs", "btrfs"], default="ext4",
+                        help="Filesystem of the synthetic root")
+    parser.add_argument("--entries", type=int, default=1000, help="Files, symlinks and hardlinks per source")
+    parser.add_argument("--size-mb", type=int, default=1024, help="Size of each source image in MiB")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic trees")
+    parser.add_argument("--config", action="append", default=[], help="ramboot config file to benchmark with")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.OPTION=VALUE",
+                        help="Override a config option")
+    parser.add_argument("--work-dir", default="/var/tmp", help="Where to create the images")
+    parser.add_argument("--keep", action="store_true", help="Keep the images, trace and profiles")
+    parser.add_argument("--keep-caches", action="store_true", help="Do not drop the page cache before the run")
+    parser.add_argument("--json", action="store_true", help="Print JSON")
+    parser.add_argument("--inside", nargs=2, metavar=("ROOT_DEVICE", "WORK_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="ramboot: %(message)s")
+
+    if args.inside:
+        run_inside(args.inside[0], args.inside[1], os.getcwd())
+        return
+
+    try:
+        result = run_benchmark(args)
+    except (RuntimeError, subprocess.CalledProcessError) as e:
+        print(f"Benchmark failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_result(result)
+
+
+if __name__ == "__main__":
+    main()
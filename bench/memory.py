@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from bench.copy_engines import ENGINES, get_commit
+from bench.tree import PROFILES, generate_tree
+from setup.ramdisk.copy_mounts import copy_from_source
+from utils.ramboot_config import RambootConfig
+
+DEFAULT_ENTRIES = [10000, 20000, 40000, 80000]
+
+
+def measure_child(source: str | None, dest: str, engine: str) -> Dict:
+    """
+    Copy a tree in a forked child and measure the peak resident memory of the child.
+
+    The child starts with the memory of this process, so a child that copies nothing gives the baseline.
+
+    Args:
+        source (str | None): The tree to copy, or None to exit right away.
+        dest (str): An empty directory to copy into.
+        engine (str): One of ENGINES.
+
+    Returns:
+        Dict: The seconds, the peak resident memory in bytes and whether the copy had errors.
+    """
+    start = time.perf_counter()
+    pid = os.fork()
+
+    if pid == 0:
+        code = 0
+
+        try:
+            if source is not None:
+                code = 1 if copy_from_source(source, dest, strategy=engine).errors else 0
+        except BaseException:
+            code = 2
+        finally:
+            os._exit(code)
+
+    _, status, usage = os.wait4(pid, 0)
+
+    # ru_maxrss is in kilobytes on Linux
+    return {"seconds": time.perf_counter() - start, "peak_rss": usage.ru_maxrss * 1024,
+            "failed": os.WEXITSTATUS(status) != 0}
+
+
+def benchmark_tree(name: str, source: str, dest: str, counts: Dict, engines: List[str]) -> List[Dict]:
+    """
+    Measure the peak memory of copying a tree with each copy strategy.
+
+    Args:
+        name (str): The name the tree is reported under.
+        source (str): The tree to copy.
+        dest (str): A directory to copy into, which must not exist.
+        counts (Dict): The files, bytes, directories, symlinks and hardlinks in the tree.
+        engines (List[str]): The copy strategies to run.
+
+    Returns:
+        List[Dict]: One result per strategy.
+    """
+    entries = counts["files"] + counts["symlinks"] + counts["hardlinks"] + counts["dirs"]
+    results = []
+
+    for engine in engines:
+        os.makedirs(dest)
+        baseline = measure_child(None, dest, engine)
+        run = measure_child(source, dest, engine)
+        shutil.rmtree(dest)
+
+        results.append({"tree": name, "engine": engine, "entries": entries, "seconds": round(run["seconds"], 3),
+                        "peak_rss": run["peak_rss"], "baseline_rss": baseline["peak_rss"],
+                        "growth": max(0, run["peak_rss"] - baseline["peak_rss"]), "failed": run["failed"]})
+
+    return results
+
+
+def get_slopes(results: List[Dict]) -> Dict[str, float]:
+    """
+    Get how much the memory growth of each tree shape and strategy rises per entry, from the smallest tree to the
+    largest.
+
+    Args:
+        results (List[Dict]): The results of every tree.
+
+    Returns:
+        Dict[str, float]: The bytes of growth per added entry, by profile and strategy.
+    """
+    runs: Dict[str, List[Dict]] = {}
+    for result in results:
+        runs.setdefault(f"{result['tree'].rsplit('-', 1)[0]} {result['engine']}", []).append(result)
+
+    slopes = {}
+    for key, series in runs.items():
+        first, last = min(series, key=lambda run: run["entries"]), max(series, key=lambda run: run["entries"])
+
+        if last["entries"] > first["entries"]:
+            slopes[key] = round((last["growth"] - first["growth"]) / (last["entries"] - first["entries"]), 1)
+
+    return slopes
+
+
+def print_results(report: Dict) -> None:
+    """
+    Print the results as a table, followed by how much memory each entry added.
+
+    Args:
+        report (Dict): The report of this run.
+
+    Returns:
+        None
+    """
+    print(f"{'tree':<20} {'engine':<11} {'entries':>9} {'seconds':>9} {'peak MB':>9} {'growth MB':>10}")
+
+    for result in report["results"]:
+        print(f"{result['tree']:<20} {result['engine']:<11} {result['entries']:>9} {result['seconds']:>9.3f} "
+              f"{result['peak_rss'] / 10 ** 6:>9.1f} {result['growth'] / 10 ** 6:>10.1f}"
+              f"{'  FAILED' if result['failed'] else ''}")
+
+    print()
+    for key, slope in report["slopes"].items():
+        print(f"{key}: {slope:.1f} bytes per added entry")
+
+
+def main() -> None:
+    """
+    Benchmark the peak memory of the copy strategies behind copy_from_source on synthetic trees of growing size, to
+    show it stays flat as the number of files grows.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(prog="python -m bench.memory",
+                                     description="Benchmark the peak memory of the copy strategies on growing trees.")
+    parser.add_argument("--profile", nargs="*", choices=sorted(PROFILES), default=["small_files", "hardlinks"],
+                        help="Built-in tree shapes to generate")
+    parser.add_argument("--entries", type=int, nargs="*", default=DEFAULT_ENTRIES,
+                        help="Files, symlinks and hardlinks per tree, one tree per count")
+    parser.add_argument("--max-mb", type=int, default=1000, help="Stop growing a tree once it holds this many MB")
+    parser.add_argument("--engine", nargs="*", choices=ENGINES, default=["builtin", "pipeline"],
+                        help="Copy strategies to run")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic trees")
+    parser.add_argument("--work-dir", default="/var/tmp", help="Where to generate the trees and copy them to")
+    parser.add_argument("--json", action="store_true", help="Print JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="ramboot: %(message)s")
+
+    # Progress reports would only add noise
+    RambootConfig.get_config().read_dict({"progress": {"interval": "0"}})
+
+    report = {"commit": get_commit(), "max_mb": args.max_mb, "seed": args.seed, "trees": {}, "results": []}
+
+    with tempfile.TemporaryDirectory(prefix="ramboot-bench-", dir=args.work_dir) as work_dir:
+        for profile in args.profile:
+            for entries in sorted(args.entries):
+                name = f"{profile}-{entries}"
+                source = os.path.join(work_dir, name)
+                counts = generate_tree(source, entries, PROFILES[profile], args.seed, args.max_mb * 10 ** 6)
+                report["trees"][name] = counts
+                report["results"] += benchmark_tree(name, source, os.path.join(work_dir, "dest"), counts,
+                                                    args.engine)
+                shutil.rmtree(source)
+
+    report["slopes"] = get_slopes(report["results"])
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_results(report)
+
+    if any(result["failed"] for result in report["results"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
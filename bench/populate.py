@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from bench.copy_engines import ENGINES, drop_caches, get_commit
+from bench.tree import PROFILES, generate_tree
+from setup.ramdisk.copy_mounts import copy_from_source
+from setup.ramdisk.mkfs_populate import POPULATE_FSTYPES
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import run_command
+
+# Room for the filesystem metadata on top of the bytes in the tree
+INODE_OVERHEAD = 8192
+IMAGE_SLACK = 1.3
+MIN_IMAGE_MB = 64
+
+
+def get_image_bytes(counts: Dict) -> int:
+    """
+    Size an image to hold a tree.
+
+    Args:
+        counts (Dict): The files, bytes, directories, symlinks and hardlinks in the tree.
+
+    Returns:
+        int: The size of the image in bytes.
+    """
+    entries = counts["files"] + counts["dirs"] + counts["symlinks"] + counts["hardlinks"]
+    return int((counts["bytes"] + entries * INODE_OVERHEAD) * IMAGE_SLACK) + MIN_IMAGE_MB * 1024 ** 2
+
+
+def create_image(image: str, size: int) -> None:
+    """
+    Create an empty image file, like the zero filled ramdisk.
+
+    Args:
+        image (str): The path of the image.
+        size (int): The size in bytes.
+
+    Returns:
+        None
+    """
+    with open(image, "wb") as f:
+        f.truncate(size)
+
+
+def run_mount_copy(source: str, image: str, mount_point: str, fstype: str, engine: str) -> Dict:
+    """
+    Build a filesystem the way ramboot does without populating: format it empty, mount it, copy and unmount.
+
+    Args:
+        source (str): The tree to copy.
+        image (str): The image to build, which must exist.
+        mount_point (str): An empty directory to mount the image on.
+        fstype (str): The filesystem to format the image with.
+        engine (str): The copy strategy, one of ENGINES.
+
+    Returns:
+        Dict: The seconds of each step and the errors of the copy.
+    """
+    start = time.perf_counter()
+    run_command([f"/usr/sbin/mkfs.{fstype}", "-q", "-F", image], check=True)
+    formatted = time.perf_counter()
+    run_command(["mount", "--options", "loop", image, mount_point], check=True)
+
+    try:
+        copied_start = time.perf_counter()
+        stats = copy_from_source(source, mount_point, strategy=engine)
+        copied = time.perf_counter()
+    finally:
+        # Unmounting writes back what the copy left in the page cache, it is part of the cost
+        run_command(["umount", mount_point], check=True)
+
+    end = time.perf_counter()
+    return {"seconds": end - start, "format_seconds": formatted - start, "copy_seconds": copied - copied_start,
+            "errors": stats.errors}
+
+
+def run_populate(source: str, image: str, fstype: str) -> Dict:
+    """
+    Build a filesystem already populated from a tree with `mkfs -d`, as ramboot does for the populate strategy.
+
+    Args:
+        source (str): The tree to copy.
+        image (str): The image to build, which must exist.
+        fstype (str): The filesystem to format the image with.
+
+    Returns:
+        Dict: The seconds taken.
+    """
+    start = time.perf_counter()
+    run_command([f"/usr/sbin/mkfs.{fstype}", "-q", "-F", "-d", source, image], check=True)
+    return {"seconds": time.perf_counter() - start, "errors": 0}
+
+
+def verify(source: str, image: str, mount_point: str) -> bool:
+    """
+    Compare the tree in an image against its source.
+
+    Args:
+        source (str): The tree that was copied.
+        image (str): The image built from it.
+        mount_point (str): An empty directory to mount the image on.
+
+    Returns:
+        bool: True if the contents are the same, False otherwise.
+    """
+    run_command(["mount", "--options", "loop,ro", image, mount_point], check=True)
+
+    try:
+        # lost+found only exists in the image
+        result = run_command(["diff", "--recursive", "--no-dereference", "--brief", "--exclude", "lost+found",
+                              source, mount_point], stdout=subprocess.DEVNULL)
+    finally:
+        run_command(["umount", mount_point], check=True)
+
+    return result.returncode == 0
+
+
+def benchmark_tree(name: str, source: str, work_dir: str, counts: Dict, fstype: str, engines: List[str],
+                   repeat: int, cold: bool, check: bool) -> List[Dict]:
+    """
+    Build an image of a tree with mkfs -d and with each copy strategy, keeping the median of the repeated runs.
+
+    Args:
+        name (str): The name the tree is reported under.
+        source (str): The tree to copy.
+        work_dir (str): Where to put the image and its mount point.
+        counts (Dict): The files, bytes, directories, symlinks and hardlinks in the tree.
+        fstype (str): The filesystem to build.
+        engines (List[str]): The copy strategies to run after formatting empty.
+        repeat (int): How many times to run each method.
+        cold (bool): Whether to drop the caches before each run.
+        check (bool): Whether to compare the last image of each method against the tree.
+
+    Returns:
+        List[Dict]: One result per method.
+    """
+    image = os.path.join(work_dir, "image")
+    mount_point = os.path.join(work_dir, "mnt")
+    os.makedirs(mount_point, exist_ok=True)
+
+    methods = [("mkfs -d", lambda: run_populate(source, image, fstype))]
+    methods += [(f"mount + {engine}", lambda engine=engine: run_mount_copy(source, image, mount_point, fstype, engine))
+                for engine in engines]
+
+    results = []
+    for method, run in methods:
+        runs = []
+
+        for _ in range(repeat):
+            create_image(image, get_image_bytes(counts))
+
+            # Write back the previous run first, so it does not compete with this one
+            if cold:
+                drop_caches()
+            else:
+                os.sync()
+
+            runs.append(run())
+
+        seconds = statistics.median(run["seconds"] for run in runs)
+        result = {"tree": name, "method": method, "seconds": round(seconds, 4),
+                  "mb_per_second": round(counts["bytes"] / 10 ** 6 / seconds, 2),
+                  "errors": max(run["errors"] for run in runs)}
+
+        if "copy_seconds" in runs[0]:
+            result["format_seconds"] = round(statistics.median(run["format_seconds"] for run in runs), 4)
+            result["copy_seconds"] = round(statistics.median(run["copy_seconds"] for run in runs), 4)
+
+        if check:
+            result["identical"] = verify(source, image, mount_point)
+
+        results.append(result)
+        os.remove(image)
+
+    return results
+
+
+def print_results(report: Dict) -> None:
+    """
+    Print the results as a table, with the speedup of mkfs -d over each other method.
+
+    Args:
+        report (Dict): The report of this run.
+
+    Returns:
+        None
+    """
+    for name, tree in report["trees"].items():
+        print(f"{name}: {tree['files']} files, {tree['symlinks']} symlinks, {tree['hardlinks']} hardlinks, "
+              f"{tree['dirs']} directories, {tree['bytes'] / 10 ** 6:.1f} MB")
+
+    print()
+    print(f"{'tree':<14} {'method':<20} {'seconds':>9} {'MB/s':>8} {'format':>8} {'copy':>8} {'mkfs -d':>8} "
+          f"{'same':>5}")
+
+    populated = {result["tree"]: result["seconds"] for result in report["results"] if result["method"] == "mkfs -d"}
+
+    for result in report["results"]:
+        speedup = result["seconds"] / populated[result["tree"]] if result["tree"] in populated else None
+        steps = [f"{result[key]:.3f}" if key in result else "-" for key in ("format_seconds", "copy_seconds")]
+        print(f"{result['tree']:<14} {result['method']:<20} {result['seconds']:>9.3f} {result['mb_per_second']:>8.1f} "
+              f"{steps[0]:>8} {steps[1]:>8} "
+              f"{f'{speedup:.2f}x' if speedup else '-':>8} "
+              f"{'-' if 'identical' not in result else 'yes' if result['identical'] else 'NO':>5}")
+
+
+def main() -> None:
+    """
+    Benchmark building ramdisk filesystems populated with mkfs -d against formatting them empty, mounting and
+    copying, on synthetic trees of different shapes.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(prog="python -m bench.populate",
+                                     description="Benchmark mkfs -d against formatting empty, mounting and copying.")
+    parser.add_argument("--profile", nargs="*", choices=sorted(PROFILES), default=sorted(PROFILES),
+                        help="Built-in tree shapes to generate")
+    parser.add_argument("--spec", action="append", default=[], help="Tree shape as JSON, such as from --sample")
+    parser.add_argument("--entries", type=int, default=10000, help="Files, symlinks and hardlinks per tree")
+    parser.add_argument("--max-mb", type=int, default=1000, help="Stop growing a tree once it holds this many MB")
+    parser.add_argument("--fstype", choices=sorted(POPULATE_FSTYPES), default="ext4", help="Filesystem to build")
+    parser.add_argument("--engine", nargs="*", choices=ENGINES, default=ENGINES,
+                        help="Copy strategies to compare against")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per method, the median is kept")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic trees")
+    parser.add_argument("--work-dir", default="/dev/shm",
+                        help="Where to generate the trees and images, a tmpfs stands in for the RAM disk")
+    parser.add_argument("--cold", action="store_true", help="Drop the caches before each run")
+    parser.add_argument("--verify", action="store_true", help="Compare each image against its tree")
+    parser.add_argument("--json", action="store_true", help="Print JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="ramboot: %(message)s")
+
+    if os.geteuid() != 0:
+        sys.exit("The populate benchmark mounts images and needs root")
+
+    # Progress reports would only add noise
+    RambootConfig.get_config().read_dict({"progress": {"interval": "0"}})
+
+    specs = {name: PROFILES[name] for name in args.profile}
+    for path in args.spec:
+        with open(path) as f:
+            specs[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+
+    report = {"commit": get_commit(), "entries": args.entries, "max_mb": args.max_mb, "seed": args.seed,
+              "fstype": args.fstype, "cold": args.cold, "trees": {}, "results": []}
+
+    with tempfile.TemporaryDirectory(prefix="ramboot-bench-", dir=args.work_dir) as work_dir:
+        for name, spec in specs.items():
+            source = os.path.join(work_dir, name)
+            counts = generate_tree(source, args.entries, spec, args.seed, args.max_mb * 10 ** 6)
+            report["trees"][name] = dict(counts, spec=spec)
+            report["results"] += benchmark_tree(name, source, work_dir, counts, args.fstype, args.engine,
+                                                args.repeat, args.cold, args.verify)
+            shutil.rmtree(source)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_results(report)
+
+    if any(result["errors"] or result.get("identical") is False for result in report["results"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
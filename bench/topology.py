@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import json
+import random
+import string
+from typing import Dict, List
+
+from utils.command_replay import FIXTURE_VERSION, command_key
+
+LSBLK_CMD = ["lsblk", "--output-all", "--bytes", "--json", "--paths", "--inverse"]
+LVS_CMD = ["/usr/sbin/lvs", "--noheadings", "--options", "vg_name"]
+ZFS_LIST_CMD = ["/usr/sbin/zfs", "list", "-H", "-o", "name,mountpoint"]
+ZPOOL_STATUS_CMD = ["zpool", "status", "-L", "-P"]
+ZPOOL_SIZE_CMD = ["/usr/sbin/zpool", "list", "-H", "-o", "size", "-p"]
+
+# How the mounts besides root are spread over the layers, by weight
+DEFAULT_MIX = {"part": 2, "lvm": 3, "md_lvm": 2, "zfs": 3}
+
+# How many partitions a disk, logical volumes a volume group and datasets a pool hold before the next one is started
+PARTS_PER_DISK = 64
+LVS_PER_VG = 50
+DATASETS_PER_POOL = 100
+
+GIB = 1024 ** 3
+
+
+def get_disk_name(index: int) -> str:
+    """
+    Name a disk like the kernel does, sda to sdz, then sdaa onwards.
+
+    Args:
+        index (int): The index of the disk, from 0.
+
+    Returns:
+        str: The device path of the disk.
+    """
+    letters = ""
+    index += 1
+
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = string.ascii_lowercase[remainder] + letters
+
+    return f"/dev/sd{letters}"
+
+
+class Topology:
+    """
+    Builds a synthetic block device topology and the command output ramboot would see on a host with it.
+    """
+
+    def __init__(self, seed: int = 0):
+        """
+        Initialize an empty topology.
+
+        Args:
+            seed (int): The seed for sizes, so the same arguments always generate the same fixture.
+        """
+        self.random = random.Random(seed)
+        self.devices: Dict[str, Dict] = {}
+        self.fstab: List[str] = []
+        self.datasets: List[str] = []
+        self.pools: Dict[str, List[str]] = {}
+        self.lv_groups: Dict[str, str] = {}
+
+        self.disk_count = 0
+        self.current_disk: str | None = None
+        self.md_count = 0
+        self.vg_count = 0
+        self.current_vgs: Dict[str, Dict] = {}
+        self.pool_count = 0
+        self.current_pool: str | None = None
+        self.pool_datasets = 0
+
+    def add_device(self, name: str, device_type: str, size: int, parents: List[str]) -> str:
+        """
+        Add a block device.
+
+        Args:
+            name (str): The device path.
+            device_type (str): The lsblk type, e.g. disk, part, raid1 or lvm.
+            size (int): The size in bytes.
+            parents (List[str]): The devices it is built on.
+
+        Returns:
+            str: The device path.
+        """
+        self.devices[name] = {"type": device_type, "size": size, "parents": parents}
+        return name
+
+    def new_partition(self) -> str:
+        """
+        Add a partition, on a new disk once the current one is full.
+
+        Returns:
+            str: The device path of the partition.
+        """
+        if self.current_disk is None or len(self.devices[self.current_disk]["children"]) >= PARTS_PER_DISK:
+            self.current_disk = self.add_device(get_disk_name(self.disk_count), "disk",
+                                                self.random.choice((512, 960, 1920, 3840)) * GIB, [])
+            self.devices[self.current_disk]["children"] = []
+            self.disk_count += 1
+
+        disk = self.devices[self.current_disk]
+        disk["children"].append(None)
+        name = f"{self.current_disk}{len(disk['children'])}"
+
+        return self.add_device(name, "part", self.random.randint(1, 64) * GIB, [self.current_disk])
+
+    def new_lv(self, on_md: bool) -> str:
+        """
+        Add a logical volume, in a new volume group once the current one is full.
+
+        Args:
+            on_md (bool): Whether the volume group's physical volume is an md raid1 of two partitions.
+
+        Returns:
+            str: The device path of the logical volume.
+        """
+        kind = "md" if on_md else "part"
+        vg = self.current_vgs.get(kind)
+
+        if vg is None or vg["lvs"] >= LVS_PER_VG:
+            if on_md:
+                pv = self.add_device(f"/dev/md{self.md_count}", "raid1", 512 * GIB,
+                                     [self.new_partition(), self.new_partition()])
+                self.md_count += 1
+            else:
+                pv = self.new_partition()
+
+            vg = {"name": f"vg{self.vg_count}", "pv": pv, "lvs": 0}
+            self.current_vgs[kind] = vg
+            self.vg_count += 1
+
+        name = f"/dev/mapper/{vg['name']}-lv{vg['lvs']}"
+        vg["lvs"] += 1
+        self.lv_groups[name] = vg["name"]
+
+        return self.add_device(name, "lvm", self.random.randint(1, 32) * GIB, [vg["pv"]])
+
+    def new_dataset(self, dest: str) -> None:
+        """
+        Add a ZFS dataset, in a new mirrored pool once the current one is full.
+
+        Args:
+            dest (str): The mount point of the dataset.
+
+        Returns:
+            None
+        """
+        if self.current_pool is None or self.pool_datasets >= DATASETS_PER_POOL:
+            self.current_pool = f"pool{self.pool_count}"
+            self.pools[self.current_pool] = [self.new_partition(), self.new_partition()]
+            self.pool_count += 1
+            self.pool_datasets = 0
+            self.datasets.append(f"{self.current_pool}\tnone")
+
+        self.pool_datasets += 1
+        self.datasets.append(f"{self.current_pool}/ds{len(self.datasets)}\t{dest}")
+
+    def add_mount(self, kind: str, dest: str) -> None:
+        """
+        Add a mount on the given kind of layers.
+
+        Args:
+            kind (str): One of part, lvm, md_lvm or zfs.
+            dest (str): The mount point.
+
+        Returns:
+            None
+        """
+        if kind == "zfs":
+            self.new_dataset(dest)
+            return
+
+        source = self.new_partition() if kind == "part" else self.new_lv(kind == "md_lvm")
+        self.fstab.append(f"{source}\t{dest}\text4\tdefaults\t0\t2")
+
+    def inverse_tree(self, name: str) -> Dict:
+        """
+        Build the lsblk --inverse tree of a device, from the device down to its disks.
+
+        Args:
+            name (str): The device path.
+
+        Returns:
+            Dict: The lsblk entry of the device.
+        """
+        device = self.devices[name]
+        entry = {"name": name, "type": device["type"], "size": device["size"]}
+
+        if device["parents"]:
+            entry["children"] = [self.inverse_tree(parent) for parent in device["parents"]]
+
+        return entry
+
+    def to_fixture(self) -> Dict:
+        """
+        Get the fixture a host with this topology would record.
+
+        Returns:
+            Dict: The fstab and the output of every command discovery may run.
+        """
+        commands = {}
+
+        def add(cmd: List[str], output: str) -> None:
+            commands[command_key(cmd)] = {"returncode": 0, "output": output}
+
+        for name in self.devices:
+            add(LSBLK_CMD + [name], json.dumps({"blockdevices": [self.inverse_tree(name)]}))
+
+        for name, vg in self.lv_groups.items():
+            add(LVS_CMD + [name], f"  {vg}\n")
+
+        # Without any pool, the host is taken not to have ZFS installed
+        if self.datasets:
+            add(ZFS_LIST_CMD, "\n".join(self.datasets) + "\n")
+        else:
+            commands[command_key(ZFS_LIST_CMD)] = {"missing": True}
+
+        for pool, partitions in self.pools.items():
+            status = "\n".join(f"\t    {partition}  ONLINE       0     0     0" for partition in partitions)
+            add(ZPOOL_STATUS_CMD + [pool], f"  pool: {pool}\n state: ONLINE\nconfig:\n\n\t{pool}  ONLINE\n"
+                                           f"\t  mirror-0  ONLINE\n{status}\n\nerrors: No known data errors\n")
+            add(ZPOOL_SIZE_CMD + [pool], f"{min(self.devices[part]['size'] for part in partitions)}\n")
+
+        return {"version": FIXTURE_VERSION, "fstab": "\n".join(self.fstab) + "\n", "commands": commands}
+
+
+def generate(mounts: int, mix: Dict[str, int] | None = None, seed: int = 0) -> Dict:
+    """
+    Generate a fixture for a synthetic host with the given number of mounts over partitions, LVM, LVM on md raid1
+    and ZFS.
+
+    Args:
+        mounts (int): The number of mounts, including root.
+        mix (Dict[str, int] | None): The weight of each kind of mount, defaulting to DEFAULT_MIX.
+        seed (int): The seed for the layout and sizes.
+
+    Returns:
+        Dict: The fixture, ready to be replayed.
+    """
+    mix = mix or DEFAULT_MIX
+    topology = Topology(seed)
+    topology.add_mount("part", "/")
+
+    kinds = topology.random.choices(list(mix), weights=list(mix.values()), k=max(0, mounts - 1))
+    for index, kind in enumerate(kinds):
+        topology.add_mount(kind, f"/srv/{kind}/{index:05d}")
+
+    return topology.to_fixture()
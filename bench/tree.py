@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import bisect
+import os
+import random
+import stat
+from typing import Dict, List
+
+from utils.scan import parallel_scan
+
+# File sizes, as [largest size in bytes, weight] buckets, a file is sized uniformly within its bucket
+DEFAULT_SIZE_HISTOGRAM = [[0, 2], [512, 20], [4096, 35], [64 * 1024, 30], [1024 ** 2, 10], [16 * 1024 ** 2, 3]]
+
+# How deep files sit below the root, as a weight per depth from 0
+DEFAULT_DEPTH_HISTOGRAM = [1, 4, 8, 8, 5, 3, 1]
+
+# The shape of a tree: size and depth histograms and the share of entries that are symlinks and hardlinks
+DEFAULT_SPEC = {"sizes": DEFAULT_SIZE_HISTOGRAM, "depths": DEFAULT_DEPTH_HISTOGRAM, "symlinks": 0.05,
+                "hardlinks": 0.02}
+
+# Trees that stress copies in different ways
+PROFILES = {
+    "default": DEFAULT_SPEC,
+    # Millions of tiny files, like /usr/share
+    "small_files": {"sizes": [[0, 2], [512, 40], [2048, 35], [8192, 20], [65536, 3]],
+                    "depths": [0, 1, 3, 6, 8, 6, 3, 1], "symlinks": 0.02, "hardlinks": 0.0},
+    # A few huge files, like databases and images in /var/lib
+    "large_files": {"sizes": [[4096, 5], [1024 ** 2, 5], [64 * 1024 ** 2, 60], [256 * 1024 ** 2, 30]],
+                    "depths": [2, 4, 2], "symlinks": 0.0, "hardlinks": 0.0},
+    # Deep trees of symlinks, like /etc/alternatives or package manager farms
+    "symlink_farm": {"sizes": [[0, 5], [512, 60], [4096, 35]], "depths": [0, 0, 1, 2, 4, 6, 8, 8, 6, 4, 2],
+                     "symlinks": 0.7, "hardlinks": 0.0},
+    # Trees where most files have several names, like deduplicated package stores
+    "hardlinks": {"sizes": [[512, 30], [4096, 40], [64 * 1024, 30]], "depths": [1, 4, 8, 4],
+                  "symlinks": 0.0, "hardlinks": 0.5},
+}
+
+# Bucket bounds used when sampling a tree, the last bucket ends at the largest file found
+SAMPLE_BOUNDS = [0, 512, 4096, 16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2,
+                 64 * 1024 ** 2, 256 * 1024 ** 2]
+
+# How many files a directory holds on average before a new one is started at the same depth
+FILES_PER_DIR = 32
+
+# Size of the random block file contents are cut from
+BLOCK_SIZE = 1024 ** 2
+
+
+def sample_spec(root: str, workers: int = 8) -> Dict:
+    """
+    Measure the shape of an existing tree, such as a real host's /usr, to generate look-alike trees from.
+
+    Args:
+        root (str): The directory to scan, staying on its filesystem.
+        workers (int): The number of directories to scan concurrently.
+
+    Returns:
+        Dict: The size and depth histograms and the symlink and hardlink shares of the tree.
+    """
+    sizes = [0] * (len(SAMPLE_BOUNDS) + 1)
+    depths: List[int] = []
+    entries = 0
+    symlinks = 0
+    hardlinks = 0
+    seen = set()
+    largest = 0
+
+    for rel_path, entry_stat in parallel_scan(root, workers):
+        if stat.S_ISDIR(entry_stat.st_mode):
+            continue
+
+        entries += 1
+
+        if stat.S_ISLNK(entry_stat.st_mode):
+            symlinks += 1
+            continue
+
+        if entry_stat.st_nlink > 1:
+            key = (entry_stat.st_dev, entry_stat.st_ino)
+            if key in seen:
+                hardlinks += 1
+                continue
+
+            seen.add(key)
+
+        depth = rel_path.count(os.path.sep)
+        depths.extend([0] * (depth + 1 - len(depths)))
+        depths[depth] += 1
+        sizes[bisect.bisect_left(SAMPLE_BOUNDS, entry_stat.st_size)] += 1
+        largest = max(largest, entry_stat.st_size)
+
+    bounds = SAMPLE_BOUNDS + [largest]
+    return {"sizes": [[bound, weight] for bound, weight in zip(bounds, sizes) if weight],
+            "depths": depths or [1], "symlinks": round(symlinks / max(1, entries), 4),
+            "hardlinks": round(hardlinks / max(1, entries), 4)}
+
+
+class TreeGenerator:
+    """
+    Generates a directory tree whose file sizes and depths follow histograms, with symlinks and hardlinks mixed in.
+
+    The same seed and histograms always generate the same tree.
+    """
+
+    def __init__(self, root: str, spec: Dict | None = None, seed: int = 0):
+        """
+        Initialize a generator for a tree below a directory.
+
+        Args:
+            root (str): The directory to generate the tree in, created if missing.
+            spec (Dict | None): The shape of the tree, like DEFAULT_SPEC, which it defaults to.  `sizes` holds the file
+                size buckets, `depths` the weight of each depth and `symlinks` and `hardlinks` the share of entries
+                that are symlinks and hardlinks to an earlier file.
+            seed (int): The seed for the layout, sizes and contents.
+        """
+        spec = spec or DEFAULT_SPEC
+        self.root = root
+        self.size_histogram = spec["sizes"]
+        self.depth_histogram = spec["depths"]
+        self.symlinks = spec["symlinks"]
+        self.hardlinks = spec["hardlinks"]
+        self.random = random.Random(seed)
+        self.block = self.random.getrandbits(8 * BLOCK_SIZE).to_bytes(BLOCK_SIZE, "little")
+
+        self.dirs: Dict[int, List[str]] = {0: [""]}
+        self.files: List[str] = []
+        self.counts = {"files": 0, "bytes": 0, "dirs": 0, "symlinks": 0, "hardlinks": 0}
+
+    def get_dir(self, depth: int) -> str:
+        """
+        Pick a directory at a depth, creating a new one now and then or when there is none yet.
+
+        Args:
+            depth (int): The depth below the root.
+
+        Returns:
+            str: The directory, relative to the root.
+        """
+        if depth == 0:
+            return ""
+
+        dirs = self.dirs.setdefault(depth, [])
+
+        if dirs and self.random.random() >= 1 / FILES_PER_DIR:
+            return self.random.choice(dirs)
+
+        parent = self.get_dir(depth - 1)
+        rel_dir = os.path.join(parent, f"d{sum(len(level) for level in self.dirs.values())}")
+        os.mkdir(os.path.join(self.root, rel_dir))
+        dirs.append(rel_dir)
+        self.counts["dirs"] += 1
+
+        return rel_dir
+
+    def get_size(self) -> int:
+        """
+        Pick a file size from the size histogram.
+
+        Returns:
+            int: The size in bytes.
+        """
+        bounds = [bound for bound, _ in self.size_histogram]
+        index = self.random.choices(range(len(bounds)), weights=[weight for _, weight in self.size_histogram])[0]
+        low = bounds[index - 1] + 1 if index > 0 else 0
+
+        return self.random.randint(min(low, bounds[index]), bounds[index])
+
+    def write_file(self, path: str, size: int) -> None:
+        """
+        Write a file cut from the random block at a random offset, so files do not share their contents.
+
+        Args:
+            path (str): The path of the file.
+            size (int): The size in bytes.
+
+        Returns:
+            None
+        """
+        offset = self.random.randrange(BLOCK_SIZE)
+
+        with open(path, "wb") as f:
+            while size > 0:
+                chunk = self.block[offset:offset + size]
+                f.write(chunk)
+                size -= len(chunk)
+                offset = 0
+
+    def add_entry(self, index: int) -> None:
+        """
+        Add one file, symlink or hardlink.
+
+        Args:
+            index (int): The number of the entry, used to name it.
+
+        Returns:
+            None
+        """
+        depth = self.random.choices(range(len(self.depth_histogram)), weights=self.depth_histogram)[0]
+        rel_path = os.path.join(self.get_dir(depth), f"f{index}")
+        path = os.path.join(self.root, rel_path)
+        kind = self.random.random()
+
+        if self.files and kind < self.symlinks:
+            target = self.random.choice(self.files)
+            os.symlink(os.path.relpath(target, os.path.dirname(rel_path) or os.curdir), path)
+            self.counts["symlinks"] += 1
+        elif self.files and kind < self.symlinks + self.hardlinks:
+            os.link(os.path.join(self.root, self.random.choice(self.files)), path)
+            self.counts["hardlinks"] += 1
+        else:
+            size = self.get_size()
+            self.write_file(path, size)
+            self.files.append(rel_path)
+            self.counts["files"] += 1
+            self.counts["bytes"] += size
+
+    def generate(self, entries: int, max_bytes: int | None = None) -> Dict[str, int]:
+        """
+        Generate the tree.
+
+        Args:
+            entries (int): The number of files, symlinks and hardlinks to create.
+            max_bytes (int | None): Stop early once the files hold this many bytes, for trees of large files.
+
+        Returns:
+            Dict[str, int]: The number of files, bytes, directories, symlinks and hardlinks created.
+        """
+        os.makedirs(self.root, exist_ok=True)
+
+        for index in range(entries):
+            if max_bytes is not None and self.counts["bytes"] >= max_bytes:
+                break
+
+            self.add_entry(index)
+
+        return self.counts
+
+
+def generate_tree(root: str, entries: int, spec: Dict | None = None, seed: int = 0,
+                  max_bytes: int | None = None) -> Dict[str, int]:
+    """
+    Generate a synthetic directory tree.
+
+    Args:
+        root (str): The directory to generate the tree in.
+        entries (int): The number of files, symlinks and hardlinks to create.
+        spec (Dict | None): The shape of the tree, defaulting to DEFAULT_SPEC.
+        seed (int): The seed for the layout, sizes and contents.
+        max_bytes (int | None): Stop early once the files hold this many bytes.
+
+    Returns:
+        Dict[str, int]: The number of files, bytes, directories, symlinks and hardlinks created.
+    """
+    return TreeGenerator(root, spec, seed).generate(entries, max_bytes)
@@ -3,6 +3,9 @@ import os.path
 
 from glob import glob
 from setup.mounts.mount_info import AllMounts
+from setup.ramdisk.early_pivot import EarlyPivot
+from setup.ramdisk.keep_on_disk import KeepOnDisk
+from setup.ramdisk.write_back import WriteBack
 from utils.ramboot_config import RambootConfig
 
 
@@ -70,7 +73,8 @@ def hide_block_devices(all_mounts: AllMounts) -> None:
 
     This function removes devices / volumes from the system by writing to the appropriate
     sysfs files. This operation is performed only if the root filesystem is on an LVM
-    and the configuration allows for disk hiding.
+    and the configuration allows for disk hiding.  Disks still backing subtrees kept on
+    disk, mounts pending an early pivot or written back paths are left alone.
 
     Args:
         all_mounts (AllMounts): An object containing all the mount information, including the root mount.
@@ -100,6 +104,10 @@ def hide_block_devices(all_mounts: AllMounts) -> None:
     # [[ /dev/sda, /dev/sdb ], [ /dev/sda, /dev/sdb ]] -> { sda, sdb }
     disks = set(os.path.basename(disk) for disk in itertools.chain.from_iterable(disks))
 
+    # Disks backing subtrees kept on disk, pending mounts or written back paths are still in use
+    disks_in_use = KeepOnDisk.get_disks_in_use() | EarlyPivot.get_disks_in_use() | WriteBack.get_disks_in_use()
+    disks -= set(os.path.basename(disk) for disk in disks_in_use)
+
     for disk in disks:
         delete_path = os.path.join(path_prefix, disk, path_suffix)
 
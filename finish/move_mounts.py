@@ -1,5 +1,7 @@
 import os.path
-import subprocess
+
+from setup.ramdisk.early_pivot import EarlyPivot
+from utils.shell_commands import run_command
 
 MOVE_MOUNT_CMD = ["mount", "--move"]
 COMMON_MOUNTS = ["dev", "proc", "sys", "run"]
@@ -19,7 +21,7 @@ def move_mount(source: str, target: str) -> None:
     Returns:
         None
     """
-    subprocess.run(MOVE_MOUNT_CMD + [source, target])
+    run_command(MOVE_MOUNT_CMD + [source, target])
 
 
 def move_system_mounts(ramdisk_base: str) -> None:
@@ -27,7 +29,8 @@ def move_system_mounts(ramdisk_base: str) -> None:
     Move common system mounts (e.g., /dev, /proc, /sys, /run) to a new base directory.
 
     This function relocates the common system mounts to a new directory on a RAM disk,
-    to ensure that they are properly mounted in the new environment.
+    to ensure that they are properly mounted in the new environment.  The layers of mounts pending an early
+    pivot are moved along with them.
 
     Args:
         ramdisk_base (str): The base directory on the RAM disk where the system mounts
@@ -38,3 +41,5 @@ def move_system_mounts(ramdisk_base: str) -> None:
     """
     for mount in COMMON_MOUNTS:
         move_mount(f"{os.path.sep}{mount}", os.path.join(ramdisk_base, mount))
+
+    EarlyPivot.move_staging(ramdisk_base)
@@ -1,5 +1,6 @@
 import os
-import subprocess
+
+from utils.shell_commands import run_command
 
 OLD_ROOT = "oldroot"
 
@@ -26,10 +27,10 @@ def pivot_root(ramdisk_base: str) -> None:
     os.mkdir(os.path.join(ramdisk_base, OLD_ROOT))
 
     # pivotroot
-    subprocess.run(["./usr/sbin/pivot_root", ".", "oldroot"])
+    run_command(["./usr/sbin/pivot_root", ".", "oldroot"])
 
     # Unmount oldroot
-    subprocess.run(["umount", "--lazy", "--recursive", OLD_ROOT])
+    run_command(["umount", "--lazy", "--recursive", OLD_ROOT])
 
     try:
         os.rmdir(OLD_ROOT)
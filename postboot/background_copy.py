@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import stat
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+from setup.mounts.mount_info import MountInfo
+from setup.ramdisk.early_pivot import LOWER_DIR, PENDING_DIR, RAM_DIR, STATE_FILE, UPPER_DIR, write_status
+from setup.ramdisk.exclusions import ExclusionRules
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+from utils.shell_commands import run_command
+
+logger = logging.getLogger(__name__)
+
+# How often the status file is rewritten while copying
+STATUS_INTERVAL = 2.0
+
+
+def get_mount_points() -> List[str]:
+    """
+    Get every mount point in the current mount namespace.
+
+    Returns:
+        List[str]: The mount points, with the octal escapes of /proc/self/mountinfo decoded.
+    """
+    with open("/proc/self/mountinfo") as f:
+        return [re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), line.split()[4]) for line in f]
+
+
+def copy_up(path: str, entry_stat: os.stat_result) -> int:
+    """
+    Copy a single entry of an overlay from its lower layer to its upper layer.
+
+    Any change to the metadata makes overlayfs copy the entry up, setting the timestamps to their current values
+    is the one change that leaves everything else as it was.
+
+    Args:
+        path (str): The entry, as seen through the overlay.
+        entry_stat (os.stat_result): The lstat result of the entry.
+
+    Returns:
+        int: The number of bytes copied.
+    """
+    try:
+        os.utime(path, ns=(entry_stat.st_atime_ns, entry_stat.st_mtime_ns), follow_symlinks=False)
+    except OSError:
+        # Removed since it was scanned
+        return 0
+
+    return entry_stat.st_size if stat.S_ISREG(entry_stat.st_mode) else 0
+
+
+def remove_whiteouts(root: str) -> None:
+    """
+    Remove the whiteouts overlayfs left behind for files deleted while a mount was pending.
+
+    Args:
+        root (str): The former upper directory, now mounted in place of the overlay.
+
+    Returns:
+        None
+    """
+    for rel_path, entry_stat in parallel_scan(root, RambootConfig.get_scan_workers()):
+        if stat.S_ISCHR(entry_stat.st_mode) and entry_stat.st_rdev == 0:
+            try:
+                os.remove(os.path.join(root, rel_path))
+            except OSError:
+                pass
+
+
+class BackgroundCopy:
+    """
+    Copies the mounts left pending by an early pivot onto the ramdisk, then swaps each overlay for the ramdisk.
+
+    Copies go through the overlays themselves, so files written or deleted since the pivot are never overwritten.
+    """
+
+    def __init__(self, staging: str):
+        """
+        Initialize the background copy from the state left in the staging area.
+
+        Args:
+            staging (str): The staging area holding the overlay layers, as seen after the pivot.
+        """
+        self.staging = staging
+        self.lock = threading.Lock()
+        self.last_status = 0.0
+
+        with open(os.path.join(staging, STATE_FILE)) as f:
+            self.pending: List[Dict] = json.load(f)
+
+        self.status: Dict = {"state": "copying", "pid": os.getpid(), "started": time.time(),
+                             "files_copied": 0, "bytes_copied": 0,
+                             "mounts": {entry["dest"]: {"state": "pending", "files_copied": 0, "bytes_copied": 0}
+                                        for entry in self.pending}}
+
+    def report(self, force: bool = False) -> None:
+        """
+        Write the status file, at most every few seconds unless forced.
+
+        Args:
+            force (bool): Write the status even if it was written recently.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_status < STATUS_INTERVAL:
+                return
+
+            self.last_status = now
+            elapsed = time.time() - self.status["started"]
+            self.status["bytes_per_second"] = int(self.status["bytes_copied"] / elapsed) if elapsed > 0 else 0
+            write_status(self.status)
+
+    def count(self, mount_point: str, future: Future) -> None:
+        """
+        Add a finished copy to the totals.
+
+        Args:
+            mount_point (str): The mount the entry belongs to.
+            future (Future): The finished copy, holding the number of bytes copied.
+
+        Returns:
+            None
+        """
+        copied = future.result()
+
+        with self.lock:
+            for totals in (self.status, self.status["mounts"][mount_point]):
+                totals["files_copied"] += 1
+                totals["bytes_copied"] += copied
+
+    def copy_mount(self, entry: Dict) -> None:
+        """
+        Copy everything a pending mount still serves from its source filesystem.
+
+        Masked directories, excluded paths and mount points below the mount are left where they are, like the copy
+        before pivoting does.
+
+        Args:
+            entry (Dict): The pending mount, as recorded by the early pivot.
+
+        Returns:
+            None
+        """
+        mount_point = entry["dest"]
+        upper = os.path.join(self.staging, RAM_DIR, entry["name"], UPPER_DIR)
+        masked = set(entry["masked"])
+        exclude = ExclusionRules.get_exclude(MountInfo(entry["source"], mount_point, entry["fstype"], entry["fsopts"],
+                                                       "0", "0"))
+
+        def skip_contents(rel_path: str, is_dir: bool) -> bool:
+            return rel_path in masked or (exclude is not None and exclude(rel_path, is_dir))
+
+        self.status["mounts"][mount_point]["state"] = "copying"
+        self.report(force=True)
+
+        workers = RambootConfig.get_copy_workers()
+        root_dev = os.lstat(mount_point).st_dev
+        slots = threading.BoundedSemaphore(workers * 64)
+
+        def release(future: Future) -> None:
+            try:
+                self.count(mount_point, future)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rel_path, entry_stat in parallel_scan(mount_point, RambootConfig.get_scan_workers(),
+                                                      exclude=skip_contents):
+                # Mount points below the mount are not part of it
+                if stat.S_ISDIR(entry_stat.st_mode) and entry_stat.st_dev != root_dev:
+                    continue
+
+                # Already on the ramdisk, copied ahead of the pivot or written since
+                if os.path.lexists(os.path.join(upper, rel_path)):
+                    continue
+
+                slots.acquire()
+                executor.submit(copy_up, os.path.join(mount_point, rel_path), entry_stat).add_done_callback(release)
+                self.report()
+
+        self.status["mounts"][mount_point]["state"] = "copied"
+        logger.info("%s copied to the ramdisk: %d files, %d bytes", mount_point,
+                    self.status["mounts"][mount_point]["files_copied"],
+                    self.status["mounts"][mount_point]["bytes_copied"])
+
+    def detach_mount(self, entry: Dict) -> bool:
+        """
+        Replace the overlay of a fully copied mount with its upper directory, releasing the source filesystem.
+
+        Root cannot be replaced under running processes and stays on its overlay, as do mounts with anything but
+        other pending mounts below them, since replacing the overlay would take those mounts with it.
+
+        Args:
+            entry (Dict): The pending mount, as recorded by the early pivot.
+
+        Returns:
+            bool: True if the overlay was replaced, False if it stays in place.
+        """
+        mount_point = entry["dest"]
+        if mount_point == os.path.sep:
+            return False
+
+        pending = {other["dest"] for other in self.pending}
+        below = [path for path in get_mount_points()
+                 if path != mount_point and os.path.commonpath([path, mount_point]) == mount_point]
+        foreign = [path for path in below if path not in pending]
+
+        if foreign:
+            logger.warning("Leaving %s on its overlay, %s is mounted below it", mount_point, foreign[0])
+            return False
+
+        # The upper directory is bound aside first, so the overlay stays in place if that fails
+        upper = os.path.join(self.staging, RAM_DIR, entry["name"], UPPER_DIR)
+        staged = os.path.join(self.staging, f"{entry['name']}.detach")
+        os.makedirs(staged, exist_ok=True)
+
+        if run_command(["mount", "--bind", upper, staged]).returncode != 0:
+            logger.warning("Leaving %s on its overlay, unable to bind its upper directory", mount_point)
+            os.rmdir(staged)
+            return False
+
+        # Open files keep working through the lazily unmounted overlay, their changes land in the same upper
+        # directory.  Pending mounts below go along with it and are put back in turn, their mount points are
+        # created since they were never copied up.
+        if mount_point in get_mount_points() \
+                and run_command(["umount", "--lazy", mount_point], stderr=subprocess.DEVNULL).returncode != 0:
+            logger.warning("Leaving %s on its overlay, unable to unmount it", mount_point)
+            run_command(["umount", staged])
+            os.rmdir(staged)
+            return False
+
+        os.makedirs(mount_point, exist_ok=True)
+
+        if run_command(["mount", "--bind", staged, mount_point]).returncode != 0:
+            logger.error("Unable to bind the upper directory of %s into place, it stays at %s", mount_point, staged)
+            return False
+
+        run_command(["umount", staged])
+        os.rmdir(staged)
+        remove_whiteouts(mount_point)
+
+        if run_command(["umount", "--lazy", os.path.join(self.staging, LOWER_DIR, entry["name"])]).returncode != 0:
+            logger.warning("Unable to detach the source of %s, it stays mounted", mount_point)
+
+        return True
+
+    def run(self) -> None:
+        """
+        Copy every pending mount, then detach the source filesystems that are no longer needed.
+
+        Returns:
+            None
+        """
+        try:
+            for entry in self.pending:
+                self.copy_mount(entry)
+
+            for entry in self.pending:
+                detached = self.detach_mount(entry)
+                self.status["mounts"][entry["dest"]]["state"] = "detached" if detached else "copied"
+        except Exception as e:
+            self.status.update(state="failed", error=str(e))
+            self.report(force=True)
+            raise
+
+        self.status["state"] = "complete"
+        self.report(force=True)
+        logger.info("Background copy complete: %d files, %d bytes in %.1fs", self.status["files_copied"],
+                    self.status["bytes_copied"], time.time() - self.status["started"])
+
+
+def complete_copy() -> None:
+    """
+    Finish copying the mounts left pending by an early pivot.
+
+    Returns:
+        None
+    """
+    BackgroundCopy(os.path.join(os.path.sep, PENDING_DIR)).run()
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import statistics
+import time
+from typing import Dict, List
+
+from postboot.boot_metrics import BootMetrics
+from setup.mounts.mount_info import AllMounts
+from utils.ramboot_config import RambootConfig
+from utils.topology import get_topology_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Oldest records are dropped once the history grows past this many boots
+HISTORY_LIMIT = 1000
+
+# Phases shorter than this are too noisy to flag, however much slower they got
+MIN_REGRESSION_SECONDS = 0.5
+
+
+def get_config_hash() -> str:
+    """
+    Hash the ramboot configuration, so a changed configuration explains a changed boot.
+
+    Returns:
+        str: A short hash of every configured option.
+    """
+    config = RambootConfig.get_config()
+    options = {section: dict(config.items(section, raw=True)) for section in config.sections()}
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def read_history(path: str) -> List[Dict]:
+    """
+    Read the boot history, one JSON record per line.
+
+    Args:
+        path (str): The history file.
+
+    Returns:
+        List[Dict]: The records, oldest first.  Lines that do not parse are skipped.
+    """
+    records = []
+
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return records
+
+
+def append_history(physical_mounts: AllMounts, ramdisk_base: str) -> None:
+    """
+    Append a record of this boot to the history file on disk, and update the copy on the ramdisk.
+
+    Must be called before the root is pivoted, while the disk is still the root.  The phases after the pivot are
+    quick and not recorded.
+
+    Args:
+        physical_mounts (AllMounts): The physical mounts being copied.
+        ramdisk_base (str): The base directory on the RAM disk.
+
+    Returns:
+        None
+    """
+    path = RambootConfig.get_history_file()
+    if path is None:
+        return
+
+    record = {"time": int(time.time()), "topology": get_topology_fingerprint(physical_mounts),
+              "config": get_config_hash(), **BootMetrics.summarize()}
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        records = read_history(path)
+
+        if len(records) >= HISTORY_LIMIT:
+            with open(f"{path}.tmp", "w") as f:
+                f.writelines(json.dumps(old, separators=(",", ":")) + "\n" for old in records[-HISTORY_LIMIT + 1:])
+            os.replace(f"{path}.tmp", path)
+
+        with open(path, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+        # The ramdisk holds the history as it was before this boot, unless the path is kept on disk
+        ramdisk_path = os.path.join(ramdisk_base, path.lstrip(os.path.sep))
+        os.makedirs(os.path.dirname(ramdisk_path), exist_ok=True)
+
+        if not os.path.exists(ramdisk_path) or not os.path.samefile(path, ramdisk_path):
+            shutil.copy2(path, ramdisk_path)
+    except OSError as e:
+        logger.warning("Unable to append to the boot history %s: %s", path, e)
+
+
+def find_regressions(records: List[Dict], threshold: float, window: int) -> Dict[str, Dict]:
+    """
+    Compare the phases of the latest boot against their rolling median over the previous boots of the same layout.
+
+    Args:
+        records (List[Dict]): The boot history, oldest first.
+        threshold (float): How much slower than the median, as a fraction of it, a phase has to be to be flagged.
+        window (int): How many previous boots the median is taken over.
+
+    Returns:
+        Dict[str, Dict]: The regressed phases, with their latest and median seconds and the change as a fraction.
+    """
+    if not records:
+        return {}
+
+    latest = records[-1]
+    previous = [record for record in records[:-1] if record.get("topology") == latest.get("topology")][-window:]
+    regressions = {}
+
+    phases = dict(latest.get("phases", {}), total=latest.get("duration"))
+    for phase, seconds in phases.items():
+        history = [record["duration"] if phase == "total" else record.get("phases", {}).get(phase)
+                   for record in previous]
+        history = [value for value in history if value is not None]
+
+        if seconds is None or not history:
+            continue
+
+        median = statistics.median(history)
+        if seconds - median >= MIN_REGRESSION_SECONDS and seconds > median * (1 + threshold):
+            regressions[phase] = {"seconds": seconds, "median": median,
+                                  "change": round(seconds / median - 1, 3) if median else None}
+
+    return regressions
+
+
+def print_history(as_json: bool = False, last: int = 10) -> None:
+    """
+    Print the trend of recent boots and flag phases of the latest boot that regressed against the rolling median.
+
+    Args:
+        as_json (bool): Print JSON instead of a table.
+        last (int): How many recent boots to show.
+
+    Returns:
+        None
+    """
+    path = RambootConfig.get_history_file()
+    if path is None:
+        print("No boot history is kept, set file in the [history] section of the config")
+        return
+
+    records = read_history(path)
+    regressions = find_regressions(records, RambootConfig.get_history_threshold(), RambootConfig.get_history_window())
+
+    if as_json:
+        print(json.dumps({"boots": records[-last:], "regressions": regressions}, indent=2))
+        return
+
+    if not records:
+        print(f"No boots recorded in {path} yet")
+        return
+
+    phases = sorted({phase for record in records[-last:] for phase in record.get("phases", {})})
+    print(f"{'boot':<20} {'topology':<13} {'config':<13} {'total':>8} {'GiB':>7} "
+          + " ".join(f"{phase[:16]:>16}" for phase in phases))
+
+    for record in records[-last:]:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"]))
+        print(f"{started:<20} {record.get('topology', ''):<13} {record.get('config', ''):<13} "
+              f"{record.get('duration', 0):>8.1f} {record.get('bytes', 0) / 2 ** 30:>7.2f} "
+              + " ".join(f"{record.get('phases', {}).get(phase, float('nan')):>16.1f}" for phase in phases))
+
+    print()
+    for phase, regression in regressions.items():
+        change = "" if regression["change"] is None else f" (+{regression['change']:.0%})"
+        print(f"Regression: {phase} took {regression['seconds']:.1f}s against a median of "
+              f"{regression['median']:.1f}s{change}")
+
+    if not regressions:
+        print("No regressions in the latest boot")
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from postboot.reclaim import get_ramdisk_mounts, get_used_bytes
+from setup.ramdisk.image_cache import ImageCache
+from setup.ramdisk.main_ramdisk import RAMDISK_DEV
+from utils.ramboot_config import RambootConfig
+from utils.trace import Tracer
+
+logger = logging.getLogger(__name__)
+
+# A metric is a name, a type, a help text and its samples, each a set of labels and a value
+Metric = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """
+    Format the labels of a sample in the Prometheus text format.
+
+    Args:
+        labels (Dict[str, str]): The label names mapped to their values.
+
+    Returns:
+        str: The labels in braces, or an empty string if there are none.
+    """
+    if not labels:
+        return ""
+
+    escaped = {name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in sorted(escaped.items())) + "}"
+
+
+def format_metrics(metrics: List[Metric]) -> str:
+    """
+    Format metrics in the Prometheus text format.
+
+    Args:
+        metrics (List[Metric]): The metrics to format.
+
+    Returns:
+        str: The text, ending in a newline.
+    """
+    lines = []
+
+    for name, metric_type, help_text, samples in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines += [f"{name}{format_labels(labels)} {value}" for labels, value in samples]
+
+    return "\n".join(lines) + "\n"
+
+
+class BootMetrics:
+    """
+    Collects the timings and volumes of a boot from its spans and writes them for the node_exporter textfile
+    collector, and summarizes them for the boot history.
+    """
+
+    _started: float = 0.0
+    _phases: Dict[str, float] = {}
+    _mounts: Dict[str, Dict] = {}
+    _commands: int = 0
+    _command_seconds: float = 0.0
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        """
+        Check if boot metrics are written.
+
+        Returns:
+            bool: True if a textfile is configured, False otherwise.
+        """
+        return RambootConfig.get_metrics_textfile() is not None
+
+    @classmethod
+    def start(cls) -> None:
+        """
+        Start collecting the spans of the boot, if boot metrics are written or the boot history is kept.
+
+        Returns:
+            None
+        """
+        cls._started = time.monotonic()
+
+        if cls.is_enabled() or RambootConfig.get_history_file() is not None:
+            Tracer.add_listener(cls.add_span)
+
+    @classmethod
+    def summarize(cls) -> Dict:
+        """
+        Summarize the boot so far.
+
+        Returns:
+            Dict: The seconds since the boot started, the seconds of each phase and the bytes and files copied.
+        """
+        with cls._lock:
+            return {"duration": round(time.monotonic() - cls._started, 3),
+                    "phases": {phase: round(seconds, 3) for phase, seconds in sorted(cls._phases.items())},
+                    "bytes": sum(mount["bytes"] for mount in cls._mounts.values()),
+                    "files": sum(mount["files"] or 0 for mount in cls._mounts.values()),
+                    "commands": cls._commands}
+
+    @classmethod
+    def add_span(cls, name: str, category: str, seconds: float, args: Dict) -> None:
+        """
+        Count a span that has ended towards the metrics.
+
+        Args:
+            name (str): The name of the span.
+            category (str): The category of the span.
+            seconds (float): How long the span took.
+            args (Dict): The details of the span.
+
+        Returns:
+            None
+        """
+        with cls._lock:
+            if category == "phase":
+                cls._phases[name] = cls._phases.get(name, 0.0) + seconds
+            elif category == "mount":
+                cls._mounts[name] = {"bytes": args.get("bytes", 0), "files": args.get("files"), "seconds": seconds,
+                                     "strategy": args.get("strategy"), "data_seconds": args.get("data_seconds"),
+                                     "metadata_seconds": args.get("metadata_seconds")}
+            elif category == "command":
+                cls._commands += 1
+                cls._command_seconds += seconds
+
+    @classmethod
+    def gather(cls) -> List[Metric]:
+        """
+        Gather the metrics of the boot, along with the current size and usage of the ramdisk.
+
+        Returns:
+            List[Metric]: The metrics.
+        """
+        mounts = sorted(cls._mounts.items())
+        copy_bytes = sum(mount["bytes"] for _, mount in mounts)
+        copy_seconds = sum(mount["seconds"] for _, mount in mounts)
+
+        try:
+            with open(f"/sys/block/{os.path.basename(RAMDISK_DEV)}/size") as f:
+                provisioned = int(f.read()) * 512
+        except (OSError, ValueError):
+            provisioned = None
+
+        used = sum(get_used_bytes(mount_point) for mount_point in get_ramdisk_mounts().values())
+
+        metrics: List[Metric] = [
+            ("ramboot_boot_timestamp_seconds", "gauge", "When the last boot into the ramdisk finished.",
+             [({}, time.time())]),
+            ("ramboot_phase_duration_seconds", "gauge", "How long each phase of the boot took.",
+             [({"phase": phase}, seconds) for phase, seconds in sorted(cls._phases.items())]),
+            ("ramboot_mount_copy_bytes", "gauge", "Bytes copied to the ramdisk per mount.",
+             [({"mount": dest}, mount["bytes"]) for dest, mount in mounts]),
+            ("ramboot_mount_copy_files", "gauge", "Files copied to the ramdisk per mount.",
+             [({"mount": dest}, mount["files"]) for dest, mount in mounts if mount["files"] is not None]),
+            ("ramboot_mount_copy_duration_seconds", "gauge", "How long copying each mount took.",
+             [({"mount": dest}, mount["seconds"]) for dest, mount in mounts]),
+            ("ramboot_mount_copy_throughput_bytes_per_second", "gauge", "Copy throughput per mount.",
+             [({"mount": dest}, mount["bytes"] / mount["seconds"]) for dest, mount in mounts if mount["seconds"]]),
+            ("ramboot_mount_copy_phase_seconds", "gauge",
+             "How long the builtin engine spent writing data and applying metadata per mount.",
+             [({"mount": dest, "phase": phase}, mount[f"{phase}_seconds"]) for dest, mount in mounts
+              for phase in ("data", "metadata") if mount["data_seconds"]]),
+            ("ramboot_mount_copy_strategy", "gauge", "The strategy each mount was copied with.",
+             [({"mount": dest, "strategy": mount["strategy"]}, 1) for dest, mount in mounts
+              if mount["strategy"] is not None]),
+            ("ramboot_copy_throughput_bytes_per_second", "gauge", "Copy throughput over all mounts.",
+             [({}, copy_bytes / copy_seconds)] if copy_seconds else []),
+            ("ramboot_external_commands", "gauge", "External commands run during the boot.",
+             [({}, cls._commands)]),
+            ("ramboot_external_command_duration_seconds", "gauge", "Time spent in external commands during the boot.",
+             [({}, cls._command_seconds)]),
+            ("ramboot_ramdisk_provisioned_bytes", "gauge", "Size of the ramdisk block device.",
+             [({"device": RAMDISK_DEV}, provisioned)] if provisioned is not None else []),
+            ("ramboot_ramdisk_used_bytes", "gauge", "Bytes used by the ramdisk filesystems.",
+             [({"device": RAMDISK_DEV}, used)]),
+            ("ramboot_image_cache_hit", "gauge", "Whether the ramdisk was restored from the cached image.",
+             [({}, int(ImageCache.is_restored()))] if ImageCache.is_enabled() else []),
+        ]
+
+        return [metric for metric in metrics if metric[3]]
+
+    @classmethod
+    def write(cls) -> None:
+        """
+        Write the boot metrics to the textfile, if configured.
+
+        Must be called after the root is pivoted, so the ramdisk is measured and the file lands on it.  The file is
+        replaced atomically, so the collector never reads it half written.
+
+        Returns:
+            None
+        """
+        path = RambootConfig.get_metrics_textfile()
+        if path is None:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(f"{path}.tmp", "w") as f:
+                f.write(format_metrics(cls.gather()))
+
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning("Unable to write boot metrics to %s: %s", path, e)
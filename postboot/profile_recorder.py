@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import subprocess
+import time
+from typing import List, Set
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.mounts.source_mounts import cleanup_mount, mount_source
+from setup.ramdisk.access_profile import write_profile
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import get_ramboot_cmd
+
+logger = logging.getLogger(__name__)
+
+# From linux/fanotify.h
+FAN_CLASS_NOTIF = 0x00000000
+FAN_CLOEXEC = 0x00000001
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_MOUNT = 0x00000010
+FAN_OPEN = 0x00000020
+FAN_NOFD = -1
+AT_FDCWD = -100
+
+# struct fanotify_event_metadata
+EVENT_FORMAT = "=IBBHQii"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+
+def fanotify_open(mount_points: List[str]) -> int:
+    """
+    Create a fanotify group reporting files opened on the given mounts.
+
+    Args:
+        mount_points (List[str]): The mount points to watch.
+
+    Returns:
+        int: The fanotify file descriptor.
+
+    Raises:
+        OSError: If fanotify is not available or a mount cannot be watched.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+
+    fan_fd = libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC, os.O_RDONLY | os.O_LARGEFILE)
+    if fan_fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    for mount_point in mount_points:
+        if libc.fanotify_mark(fan_fd, FAN_MARK_ADD | FAN_MARK_MOUNT, FAN_OPEN, AT_FDCWD, os.fsencode(mount_point)) < 0:
+            errno = ctypes.get_errno()
+            os.close(fan_fd)
+            raise OSError(errno, os.strerror(errno), mount_point)
+
+    return fan_fd
+
+
+def record_opened_files(mount_points: List[str], seconds: int) -> Set[str]:
+    """
+    Record the paths of files opened on the given mounts for a while.
+
+    Args:
+        mount_points (List[str]): The mount points to watch.
+        seconds (int): How long to record for.
+
+    Returns:
+        Set[str]: The absolute paths of the opened files.
+    """
+    fan_fd = fanotify_open(mount_points)
+    opened = set()
+    deadline = time.monotonic() + seconds
+
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            readable, _, _ = select.select([fan_fd], [], [], remaining)
+            if not readable:
+                continue
+
+            buffer = os.read(fan_fd, EVENT_SIZE * 1024)
+            offset = 0
+
+            while offset + EVENT_SIZE <= len(buffer):
+                event_len, _, _, _, _, event_fd, pid = struct.unpack_from(EVENT_FORMAT, buffer, offset)
+                offset += event_len
+
+                if event_fd == FAN_NOFD:
+                    continue
+
+                try:
+                    if pid != os.getpid():
+                        opened.add(os.readlink(f"/proc/self/fd/{event_fd}"))
+                except OSError:
+                    pass
+                finally:
+                    os.close(event_fd)
+    finally:
+        os.close(fan_fd)
+
+    return opened
+
+
+def record_profile(source: str, fstype: str, fsopts: str, mount_points: List[str]) -> None:
+    """
+    Record the files opened after the root is pivoted and save them as the access profile of the root filesystem.
+
+    The profile has to outlive the ramdisk, so the root source is mounted again just long enough to write it.
+
+    Args:
+        source (str): The source device of the root filesystem.
+        fstype (str): The filesystem type of the root filesystem.
+        fsopts (str): The comma separated mount options of the root filesystem.
+        mount_points (List[str]): The ramdisk mount points to watch.
+
+    Returns:
+        None
+    """
+    try:
+        opened = record_opened_files(mount_points, RambootConfig.get_profile_record_seconds())
+    except OSError as e:
+        logger.warning("Unable to record an access profile: %s", e)
+        return
+
+    # Only regular files are worth copying ahead of time
+    opened = [path for path in opened if os.path.isfile(path)]
+
+    root_mount = MountInfo(source, os.path.sep, fstype, fsopts.split(",") if fsopts else [], "0", "0")
+    temp_mount_point = mount_source(root_mount)
+
+    try:
+        if not os.path.ismount(temp_mount_point):
+            logger.warning("Unable to mount %s, the access profile was not saved", source)
+            return
+
+        profile_path = os.path.join(temp_mount_point, RambootConfig.get_profile_path().lstrip(os.path.sep))
+        write_profile(profile_path, opened)
+        logger.info("Recorded %d boot-critical files to %s", len(opened), RambootConfig.get_profile_path())
+    finally:
+        cleanup_mount(temp_mount_point)
+
+
+def start_profile_recorder(physical_mounts: AllMounts) -> None:
+    """
+    Start recording an access profile in the background, if configured.
+
+    Must be called after the root is pivoted, so the recorder watches the ramdisk.
+
+    Args:
+        physical_mounts (AllMounts): An object containing all the physical mounts.
+
+    Returns:
+        None
+    """
+    if not RambootConfig.get_profile_record():
+        return
+
+    root_mount = physical_mounts.get_root_mount()
+    cmd = get_ramboot_cmd() + ["record-profile", "--source", root_mount.source, "--fstype", root_mount.fstype,
+                               "--options", ",".join(root_mount.fsopts)]
+
+    subprocess.Popen(cmd + [mount.dest for mount in physical_mounts], start_new_session=True)
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import logging
+import os
+import struct
+import subprocess
+import time
+from typing import Dict
+
+from setup.ramdisk.main_ramdisk import RAMDISK_DEV
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import get_ramboot_cmd
+
+logger = logging.getLogger(__name__)
+
+# brd exposes the number of pages it holds for each device in debugfs
+BRD_PAGES_DIR = "/sys/kernel/debug/ramdisk_pages"
+
+# From linux/fs.h, _IOWR('X', 121, struct fstrim_range)
+FITRIM = 0xC0185879
+FSTRIM_RANGE_FORMAT = "=QQQ"
+
+
+def get_ramdisk_mounts() -> Dict[str, str]:
+    """
+    Find the mounted filesystems living on the ramdisk.
+
+    Bind mounts of the same filesystem are folded into the shortest mount point.
+
+    Returns:
+        Dict[str, str]: Ramdisk devices mapped to a mount point of their filesystem.
+    """
+    mounts: Dict[str, str] = {}
+
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            device, mount_point = line.split()[:2]
+            mount_point = mount_point.replace("\\040", " ")
+
+            if device != RAMDISK_DEV and not device.startswith(f"{RAMDISK_DEV}p"):
+                continue
+
+            if device not in mounts or len(mount_point) < len(mounts[device]):
+                mounts[device] = mount_point
+
+    return mounts
+
+
+def get_brd_bytes() -> int | None:
+    """
+    Get the memory held by the ramdisk block device, including pages of files deleted since.
+
+    Returns:
+        int | None: The allocated bytes, None if debugfs is not mounted or brd does not report it.
+    """
+    try:
+        with open(os.path.join(BRD_PAGES_DIR, os.path.basename(RAMDISK_DEV))) as f:
+            return int(f.read()) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def get_used_bytes(mount_point: str) -> int:
+    """
+    Get the bytes in use by a filesystem, as it reports them.
+
+    Args:
+        mount_point (str): A mount point of the filesystem.
+
+    Returns:
+        int: The used bytes.
+    """
+    stats = os.statvfs(mount_point)
+    return (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+
+
+def supports_discard() -> bool:
+    """
+    Check if the ramdisk block device frees pages when its filesystems discard them.
+
+    Returns:
+        bool: True if discards are supported, False otherwise.
+    """
+    try:
+        with open(f"/sys/block/{os.path.basename(RAMDISK_DEV)}/queue/discard_max_bytes") as f:
+            return int(f.read()) > 0
+    except (OSError, ValueError):
+        return False
+
+
+def trim(mount_point: str) -> int:
+    """
+    Discard the unused blocks of a filesystem, like fstrim.
+
+    Args:
+        mount_point (str): A mount point of the filesystem.
+
+    Returns:
+        int: The bytes the filesystem reports as trimmed.
+    """
+    fd = os.open(mount_point, os.O_RDONLY | os.O_DIRECTORY)
+
+    try:
+        trim_range = bytearray(struct.pack(FSTRIM_RANGE_FORMAT, 0, 2 ** 64 - 1, 0))
+        fcntl.ioctl(fd, FITRIM, trim_range)
+        return struct.unpack(FSTRIM_RANGE_FORMAT, trim_range)[1]
+    finally:
+        os.close(fd)
+
+
+def reclaim_once() -> None:
+    """
+    Trim every ramdisk filesystem and log the memory returned to the kernel.
+
+    Returns:
+        None
+    """
+    start = time.monotonic()
+    before = get_brd_bytes()
+    trimmed = 0
+
+    for device, mount_point in get_ramdisk_mounts().items():
+        try:
+            trimmed += trim(mount_point)
+        except OSError as e:
+            logger.warning("Unable to trim %s on %s: %s", device, mount_point, e)
+
+    after = get_brd_bytes()
+
+    if before is None or after is None:
+        logger.info("Trimmed %d bytes in %.1fs", trimmed, time.monotonic() - start)
+    else:
+        logger.info("Returned %d bytes to the kernel, trimmed %d bytes in %.1fs", before - after, trimmed,
+                    time.monotonic() - start)
+
+
+def run_reclaim() -> None:
+    """
+    Trim the ramdisk filesystems every trim interval, forever.
+
+    Returns:
+        None
+    """
+    if not supports_discard():
+        logger.warning("%s does not support discard, trimming frees no memory", RAMDISK_DEV)
+        return
+
+    while True:
+        time.sleep(RambootConfig.get_reclaim_trim_interval())
+        reclaim_once()
+
+
+def start_reclaim() -> None:
+    """
+    Start trimming the ramdisk filesystems periodically in the background, if configured.
+
+    Must be called after the root is pivoted.  Filesystems mounted with discard free memory as files are deleted and
+    do not need it.
+
+    Returns:
+        None
+    """
+    if RambootConfig.get_reclaim_trim_interval() <= 0:
+        return
+
+    subprocess.Popen(get_ramboot_cmd() + ["reclaim"], start_new_session=True)
+
+
+def print_reclaim_status(as_json: bool = False) -> None:
+    """
+    Print the memory held by the ramdisk block device against the bytes its filesystems use.
+
+    The difference is memory held for deleted files, which trimming or discard returns to the kernel.
+
+    Args:
+        as_json (bool): Print JSON instead of a table.
+
+    Returns:
+        None
+    """
+    mounts = {device: {"mount_point": mount_point, "used_bytes": get_used_bytes(mount_point)}
+              for device, mount_point in sorted(get_ramdisk_mounts().items())}
+    used = sum(mount["used_bytes"] for mount in mounts.values())
+    allocated = get_brd_bytes()
+    status = {"device": RAMDISK_DEV, "allocated_bytes": allocated, "used_bytes": used,
+              "drift_bytes": None if allocated is None else allocated - used, "discard": supports_discard(),
+              "mounts": mounts}
+
+    if as_json:
+        print(json.dumps(status, indent=2))
+        return
+
+    for device, mount in mounts.items():
+        print(f"{device:<16} {mount['mount_point']:<32} {mount['used_bytes'] / 2 ** 20:>12.1f} MiB used")
+
+    print(f"{'filesystems':<49} {used / 2 ** 20:>12.1f} MiB used")
+
+    if allocated is None:
+        print(f"{RAMDISK_DEV} allocated pages unknown, mount debugfs at /sys/kernel/debug to see them")
+    else:
+        print(f"{RAMDISK_DEV:<49} {allocated / 2 ** 20:>12.1f} MiB allocated")
+        print(f"{'drift':<49} {(allocated - used) / 2 ** 20:>12.1f} MiB")
@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import json
+import os
+import stat
+from typing import Dict, List, Set, Tuple
+
+from postboot.reclaim import get_brd_bytes, get_ramdisk_mounts, get_used_bytes
+from setup.ramdisk.compressed_images import OVERLAY_DIR
+from setup.ramdisk.main_ramdisk import RAMDISK_DEV
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+
+# Where ramboot keeps its own tmpfs mounts after the root is pivoted
+RAMBOOT_DIR = "/.ramboot"
+
+MEMINFO_FIELDS = ("MemTotal", "MemAvailable", "Shmem", "Cached", "Buffers")
+
+
+def get_meminfo() -> Dict[str, int]:
+    """
+    Get the system-wide memory counters relevant to the ramdisk.
+
+    Returns:
+        Dict[str, int]: The counters from /proc/meminfo, in bytes.
+    """
+    meminfo = {}
+
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            if name in MEMINFO_FIELDS:
+                meminfo[name] = int(value.split()[0]) * 1024
+
+    return meminfo
+
+
+def get_ramboot_tmpfs() -> List[str]:
+    """
+    Find the tmpfs mounts ramboot created, for compressed images and the early pivot staging area.
+
+    Returns:
+        List[str]: The mount points.
+    """
+    with open("/proc/self/mounts") as f:
+        return sorted(mount_point for _, mount_point, fstype, *_ in (line.split() for line in f)
+                      if fstype == "tmpfs" and mount_point.startswith(RAMBOOT_DIR + os.path.sep))
+
+
+def get_provisioned_bytes(mount_point: str) -> int:
+    """
+    Get the size of a filesystem.
+
+    Args:
+        mount_point (str): A mount point of the filesystem.
+
+    Returns:
+        int: The total bytes of the filesystem.
+    """
+    stats = os.statvfs(mount_point)
+    return stats.f_blocks * stats.f_frsize
+
+
+def measure_tree(root: str, depth: int) -> Dict[str, int]:
+    """
+    Measure the space taken by a directory tree and the directories in it, like du.
+
+    Hardlinked files are only counted once.
+
+    Args:
+        root (str): The directory to measure, without crossing into other filesystems.
+        depth (int): How many levels of directories below the root to report.
+
+    Returns:
+        Dict[str, int]: The bytes of each directory up to the depth, relative to the root.
+    """
+    directories: Dict[str, int] = {}
+    seen: Set[Tuple[int, int]] = set()
+
+    for rel_path, entry_stat in parallel_scan(root, RambootConfig.get_scan_workers()):
+        if entry_stat.st_nlink > 1 and not stat.S_ISDIR(entry_stat.st_mode):
+            if (entry_stat.st_dev, entry_stat.st_ino) in seen:
+                continue
+            seen.add((entry_stat.st_dev, entry_stat.st_ino))
+
+        size = entry_stat.st_blocks * 512
+
+        parts = rel_path.split(os.path.sep)
+        for level in range(1, min(depth, len(parts) - (0 if stat.S_ISDIR(entry_stat.st_mode) else 1)) + 1):
+            prefix = os.path.join(*parts[:level])
+            directories[prefix] = directories.get(prefix, 0) + size
+
+    return directories
+
+
+def get_top_directories(mount_point: str, depth: int, top: int) -> List[Dict]:
+    """
+    Get the largest directories of a filesystem.
+
+    Args:
+        mount_point (str): A mount point of the filesystem.
+        depth (int): How many levels of directories to consider.
+        top (int): How many directories to report.
+
+    Returns:
+        List[Dict]: The largest directories, largest first, with their absolute path and size in bytes.
+    """
+    directories = measure_tree(mount_point, depth)
+    largest = sorted(directories.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    return [{"path": os.path.join(mount_point, rel_path), "bytes": size} for rel_path, size in largest]
+
+
+def get_compressed_images() -> List[Dict]:
+    """
+    Measure the compressed images held in RAM against the data packed into them.
+
+    Returns:
+        List[Dict]: The images with their compressed and uncompressed size and their compression ratio.
+    """
+    images_dir = os.path.join(os.path.sep, OVERLAY_DIR, "images")
+    images = []
+
+    if not os.path.isdir(images_dir):
+        return images
+
+    for name in sorted(os.listdir(images_dir)):
+        compressed = os.stat(os.path.join(images_dir, name)).st_blocks * 512
+        lower = os.path.join(os.path.sep, OVERLAY_DIR, "lower", name)
+        uncompressed = sum(entry_stat.st_size for _, entry_stat in parallel_scan(lower)
+                           if stat.S_ISREG(entry_stat.st_mode)) if os.path.ismount(lower) else 0
+
+        images.append({"image": name, "compressed_bytes": compressed, "uncompressed_bytes": uncompressed,
+                       "compression_ratio": round(uncompressed / compressed, 2) if compressed else None})
+
+    return images
+
+
+def describe_filesystem(device: str, mount_point: str, depth: int, top: int) -> Dict:
+    """
+    Describe a single ramboot-created filesystem.
+
+    Args:
+        device (str): The ramdisk partition, or tmpfs.
+        mount_point (str): A mount point of the filesystem.
+        depth (int): How many levels of directories to consider for the largest directories.
+        top (int): How many of the largest directories to report.
+
+    Returns:
+        Dict: The device, mount point, provisioned and used bytes and the largest directories.
+    """
+    filesystem = {"device": device, "mount_point": mount_point,
+                  "provisioned_bytes": get_provisioned_bytes(mount_point), "used_bytes": get_used_bytes(mount_point)}
+
+    # tmpfs only takes up RAM for what it holds, the ramdisk device is only measured as a whole
+    if device == "tmpfs":
+        filesystem["ram_bytes"] = filesystem["used_bytes"]
+
+    filesystem["top_directories"] = get_top_directories(mount_point, depth, top)
+    return filesystem
+
+
+def gather_stats(depth: int = 2, top: int = 10) -> Dict:
+    """
+    Gather what the ramdisk and ramboot's tmpfs mounts provision, use and actually cost in RAM.
+
+    Args:
+        depth (int): How many levels of directories to consider for the largest directories.
+        top (int): How many of the largest directories to report per filesystem.
+
+    Returns:
+        Dict: The report.
+    """
+    filesystems = [describe_filesystem(device, mount_point, depth, top)
+                   for device, mount_point in sorted(get_ramdisk_mounts().items())]
+    filesystems += [describe_filesystem("tmpfs", mount_point, depth, top) for mount_point in get_ramboot_tmpfs()]
+
+    try:
+        with open(f"/sys/block/{os.path.basename(RAMDISK_DEV)}/size") as f:
+            ramdisk_provisioned = int(f.read()) * 512
+    except (OSError, ValueError):
+        ramdisk_provisioned = None
+
+    ramdisk_used = sum(filesystem["used_bytes"] for filesystem in filesystems if filesystem["device"] != "tmpfs")
+    ramdisk_ram = get_brd_bytes()
+
+    return {"ramdisk": {"device": RAMDISK_DEV, "provisioned_bytes": ramdisk_provisioned, "used_bytes": ramdisk_used,
+                        "ram_bytes": ramdisk_ram},
+            "filesystems": filesystems,
+            "compressed_images": get_compressed_images(),
+            "meminfo": get_meminfo()}
+
+
+def format_bytes(value: int | None) -> str:
+    """
+    Format a byte count for the report.
+
+    Args:
+        value (int | None): The byte count, or None if unknown.
+
+    Returns:
+        str: The byte count in MiB, or "unknown".
+    """
+    return "unknown" if value is None else f"{value / 2 ** 20:.1f} MiB"
+
+
+def print_stats(as_json: bool = False, depth: int = 2, top: int = 10) -> None:
+    """
+    Print what the ramdisk costs, per ramboot-created device and mount.
+
+    Args:
+        as_json (bool): Print JSON instead of a report.
+        depth (int): How many levels of directories to consider for the largest directories.
+        top (int): How many of the largest directories to report per filesystem.
+
+    Returns:
+        None
+    """
+    stats = gather_stats(depth, top)
+
+    if as_json:
+        print(json.dumps(stats, indent=2))
+        return
+
+    ramdisk = stats["ramdisk"]
+    print(f"{ramdisk['device']}: {format_bytes(ramdisk['provisioned_bytes'])} provisioned, "
+          f"{format_bytes(ramdisk['used_bytes'])} used by filesystems, {format_bytes(ramdisk['ram_bytes'])} in RAM")
+
+    for filesystem in stats["filesystems"]:
+        print()
+        print(f"{filesystem['mount_point']} ({filesystem['device']}): "
+              f"{format_bytes(filesystem['provisioned_bytes'])} provisioned, "
+              f"{format_bytes(filesystem['used_bytes'])} used")
+
+        for directory in filesystem["top_directories"]:
+            print(f"  {format_bytes(directory['bytes']):>14}  {directory['path']}")
+
+    if stats["compressed_images"]:
+        print()
+
+    for image in stats["compressed_images"]:
+        print(f"{image['image']}: {format_bytes(image['compressed_bytes'])} in RAM, "
+              f"{format_bytes(image['uncompressed_bytes'])} uncompressed, ratio {image['compression_ratio']}")
+
+    print()
+    print(", ".join(f"{name} {format_bytes(value)}" for name, value in stats["meminfo"].items()))
@@ -0,0 +1,466 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import stat
+import struct
+import threading
+import time
+from typing import Dict, List
+
+from setup.mounts.mount_info import MountInfo
+from setup.ramdisk.exclusions import ExclusionRules
+from setup.ramdisk.file_copy import apply_metadata, copy_entry, remove_path
+from setup.ramdisk.write_back import STATE_FILE, WRITE_BACK_DIR
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+
+logger = logging.getLogger(__name__)
+
+# From linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# struct inotify_event, followed by a NUL padded name
+EVENT_FORMAT = "=iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+# Suffix of the temporary copy a file is written to before replacing the original on the source
+TEMP_SUFFIX = ".ramboot-write-back"
+
+
+def wait_for_background_copy() -> None:
+    """
+    Wait until the background copy of an early pivot, if any, has replaced its overlays.
+
+    Watches placed on an overlay would stop reporting changes once it is replaced.
+
+    Returns:
+        None
+    """
+    status_file = RambootConfig.get_early_pivot_status_file()
+
+    while True:
+        try:
+            with open(status_file) as f:
+                if json.load(f).get("state") not in ("pending", "copying"):
+                    return
+        except (OSError, ValueError):
+            return
+
+        time.sleep(5)
+
+
+class WriteBackDaemon:
+    """
+    Watches the written back paths with inotify and writes their changes back to the source filesystems.
+
+    Changed paths are coalesced into a journal, mapping each path to when it first changed, and a flush thread writes
+    the journal back in batches every flush interval.  Each path is compared with its source, so a path changed many
+    times is written once and unchanged files are skipped.
+    """
+
+    def __init__(self, entries: List[Dict]):
+        """
+        Initialize the daemon for the written back paths recorded before pivoting.
+
+        Args:
+            entries (List[Dict]): The written back paths, as recorded by WriteBack.mount_all.
+        """
+        self.entries = entries
+        self.excludes = {entry["path"]: ExclusionRules.get_exclude(MountInfo(entry["source"], entry["dest"],
+                                                                             entry["fstype"], entry["fsopts"], "0", "0"))
+                         for entry in entries}
+        self.journal: Dict[str, float] = {}
+        self.watches: Dict[int, str] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.metrics: Dict = {"flushes": 0, "files_flushed": 0, "bytes_flushed": 0, "deleted": 0, "errors": 0,
+                              "pending": 0, "last_flush": None, "last_flush_seconds": 0.0, "last_lag_seconds": 0.0,
+                              "max_lag_seconds": 0.0}
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        # Holding the sources open keeps them from being unmounted at shutdown before the final flush
+        self.backing_fds = [os.open(backing, os.O_RDONLY | os.O_DIRECTORY)
+                            for backing in sorted(set(entry["backing"] for entry in entries))]
+
+    def get_entry(self, path: str) -> Dict | None:
+        """
+        Find the written back path a path belongs to.
+
+        Args:
+            path (str): An absolute path on the ramdisk.
+
+        Returns:
+            Dict | None: The written back path holding it, None if it is not written back.
+        """
+        for entry in self.entries:
+            if path == entry["path"] or path.startswith(entry["path"].rstrip(os.path.sep) + os.path.sep):
+                return entry
+
+        return None
+
+    def get_backing_path(self, entry: Dict, path: str) -> str:
+        """
+        Translate a path on the ramdisk to the same path on the mounted source.
+
+        Args:
+            entry (Dict): The written back path holding the path.
+            path (str): An absolute path on the ramdisk.
+
+        Returns:
+            str: The matching path on the source.
+        """
+        return os.path.normpath(os.path.join(entry["backing"], os.path.relpath(path, entry["dest"])))
+
+    def is_excluded(self, entry: Dict, path: str, is_dir: bool) -> bool:
+        """
+        Check if a path was left out of the copy, so its source must be left alone.
+
+        Args:
+            entry (Dict): The written back path holding the path.
+            path (str): An absolute path on the ramdisk.
+            is_dir (bool): Whether the path is a directory.
+
+        Returns:
+            bool: True if the path is excluded, False otherwise.
+        """
+        exclude = self.excludes[entry["path"]]
+        return exclude is not None and exclude(os.path.relpath(path, entry["dest"]), is_dir)
+
+    def mark(self, path: str) -> None:
+        """
+        Record a changed path in the journal, keeping the time of its first change.
+
+        Args:
+            path (str): An absolute path on the ramdisk.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.journal.setdefault(path, time.time())
+
+    def watch_tree(self, path: str, mark: bool = False) -> None:
+        """
+        Watch a directory and every directory below it on the same filesystem.
+
+        Args:
+            path (str): The directory to watch.
+            mark (bool): Whether to record everything below it in the journal, for directories that appeared
+                after being populated elsewhere.
+
+        Returns:
+            None
+        """
+        if not os.path.isdir(path) or os.path.islink(path):
+            return
+
+        directories = [path]
+
+        for rel_path, entry_stat in parallel_scan(path, RambootConfig.get_scan_workers()):
+            if mark:
+                self.mark(os.path.join(path, rel_path))
+
+            if stat.S_ISDIR(entry_stat.st_mode):
+                directories.append(os.path.join(path, rel_path))
+
+        for directory in directories:
+            wd = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), WATCH_MASK)
+
+            if wd >= 0:
+                self.watches[wd] = directory
+            elif ctypes.get_errno() == errno.ENOSPC:
+                logger.warning("Out of inotify watches, changes below %s are not written back", directory)
+                return
+
+    def unwatch_tree(self, path: str) -> None:
+        """
+        Stop watching a directory moved elsewhere, along with everything below it.
+
+        Args:
+            path (str): The directory's former path.
+
+        Returns:
+            None
+        """
+        for wd, directory in list(self.watches.items()):
+            if directory == path or directory.startswith(path + os.path.sep):
+                self.libc.inotify_rm_watch(self.inotify_fd, wd)
+                del self.watches[wd]
+
+    def resync(self) -> None:
+        """
+        Record every path on both the ramdisk and the sources in the journal.
+
+        Used at startup, for changes made before the watches were in place, and whenever inotify drops events.
+        Unchanged files are skipped when flushing, so this only costs a walk.
+
+        Returns:
+            None
+        """
+        for entry in self.entries:
+            self.mark(entry["path"])
+            backing_root = self.get_backing_path(entry, entry["path"])
+
+            for root, prefix in ((entry["path"], entry["path"]), (backing_root, entry["path"])):
+                if not os.path.isdir(root):
+                    continue
+
+                # Mounts on the ramdisk below the path, like compressed images, are not written back
+                def skip_contents(rel_path: str, is_dir: bool) -> bool:
+                    path = os.path.join(prefix, rel_path)
+                    return (is_dir and os.path.ismount(path)) or self.is_excluded(entry, path, is_dir)
+
+                for rel_path, _ in parallel_scan(root, RambootConfig.get_scan_workers(), exclude=skip_contents):
+                    self.mark(os.path.join(prefix, rel_path))
+
+    def handle_events(self, data: bytes) -> None:
+        """
+        Record the paths named by a buffer of inotify events in the journal.
+
+        Args:
+            data (bytes): The events read from the inotify file descriptor.
+
+        Returns:
+            None
+        """
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, name_len = struct.unpack_from(EVENT_FORMAT, data, offset)
+            name = data[offset + EVENT_SIZE:offset + EVENT_SIZE + name_len].rstrip(b"\0")
+            offset += EVENT_SIZE + name_len
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, resyncing all written back paths")
+                self.resync()
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            self.mark(path)
+
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self.unwatch_tree(path)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path, mark=True)
+
+    def sync_path(self, path: str, directories: List[str]) -> int:
+        """
+        Make the source match a single path on the ramdisk.
+
+        Files are written to a temporary copy and renamed over the original, so the source never holds a partially
+        written file.
+
+        Args:
+            path (str): An absolute path on the ramdisk.
+            directories (List[str]): Collects the directories whose metadata is applied at the end of the batch.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        entry = self.get_entry(path)
+        if entry is None:
+            return 0
+
+        backing_path = self.get_backing_path(entry, path)
+
+        try:
+            ram_stat = os.lstat(path)
+        except FileNotFoundError:
+            if os.path.lexists(backing_path) and not self.is_excluded(entry, path, os.path.isdir(backing_path)):
+                remove_path(backing_path)
+                self.metrics["deleted"] += 1
+            return 0
+
+        if self.is_excluded(entry, path, stat.S_ISDIR(ram_stat.st_mode)):
+            return 0
+
+        try:
+            backing_stat = os.lstat(backing_path)
+        except FileNotFoundError:
+            backing_stat = None
+
+        if backing_stat is not None and stat.S_IFMT(backing_stat.st_mode) != stat.S_IFMT(ram_stat.st_mode):
+            remove_path(backing_path)
+            backing_stat = None
+
+        os.makedirs(os.path.dirname(backing_path), exist_ok=True)
+
+        if stat.S_ISDIR(ram_stat.st_mode):
+            copy_entry(path, backing_path, ram_stat)
+            directories.append(path)
+            return 0
+
+        if (backing_stat is not None and backing_stat.st_size == ram_stat.st_size
+                and backing_stat.st_mtime_ns == ram_stat.st_mtime_ns):
+            if (backing_stat.st_mode, backing_stat.st_uid, backing_stat.st_gid) != \
+                    (ram_stat.st_mode, ram_stat.st_uid, ram_stat.st_gid):
+                apply_metadata(backing_path, ram_stat, path)
+            return 0
+
+        temp_path = backing_path + TEMP_SUFFIX
+        written = copy_entry(path, temp_path, ram_stat)
+        os.replace(temp_path, backing_path)
+        self.metrics["files_flushed"] += 1
+
+        return written
+
+    def flush(self) -> None:
+        """
+        Write the journal back to the sources as a single batch.
+
+        Returns:
+            None
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch, self.journal = self.journal, {}
+
+            if not batch:
+                return
+
+            start = time.time()
+            lag = start - min(batch.values())
+            written = 0
+            directories = []
+
+            # Sorted, so directories are created before their contents
+            for path in sorted(batch):
+                try:
+                    written += self.sync_path(path, directories)
+                except OSError as e:
+                    logger.warning("Unable to write back %s: %s", path, e)
+                    self.metrics["errors"] += 1
+
+            # Once their contents are written, so the timestamps stick
+            for path in reversed(directories):
+                try:
+                    apply_metadata(self.get_backing_path(self.get_entry(path), path), os.lstat(path), path)
+                except OSError:
+                    pass
+
+            os.sync()
+
+            self.metrics["flushes"] += 1
+            self.metrics["bytes_flushed"] += written
+            self.metrics["last_flush"] = time.time()
+            self.metrics["last_flush_seconds"] = time.time() - start
+            self.metrics["last_lag_seconds"] = lag
+            self.metrics["max_lag_seconds"] = max(self.metrics["max_lag_seconds"], lag)
+            self.write_metrics()
+
+            logger.info("Wrote back %d paths, %d bytes in %.1fs, %.1fs after the first change",
+                        len(batch), written, self.metrics["last_flush_seconds"], lag)
+
+    def write_metrics(self) -> None:
+        """
+        Write the write-back metrics to the configured metrics file.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.metrics["pending"] = len(self.journal)
+
+        metrics_file = RambootConfig.get_write_back_metrics_file()
+        os.makedirs(os.path.dirname(metrics_file), exist_ok=True)
+
+        temp_path = f"{metrics_file}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.metrics, f, indent=2)
+
+        os.replace(temp_path, metrics_file)
+
+    def flush_periodically(self) -> None:
+        """
+        Flush the journal every flush interval until the daemon stops.
+
+        Returns:
+            None
+        """
+        interval = RambootConfig.get_write_back_flush_interval()
+
+        while not self.stopping.wait(interval):
+            self.flush()
+
+    def run(self) -> None:
+        """
+        Watch and write back until terminated, then flush whatever is left.
+
+        Returns:
+            None
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+
+        for entry in self.entries:
+            self.watch_tree(entry["path"])
+
+        self.resync()
+
+        flusher = threading.Thread(target=self.flush_periodically, daemon=True)
+        flusher.start()
+
+        while not self.stopping.is_set():
+            readable, _, _ = select.select([self.inotify_fd], [], [], 1.0)
+            if readable:
+                self.handle_events(os.read(self.inotify_fd, 65536))
+
+        flusher.join()
+
+        # Pick up whatever changed right before shutdown
+        while select.select([self.inotify_fd], [], [], 0)[0]:
+            self.handle_events(os.read(self.inotify_fd, 65536))
+
+        self.flush()
+        logger.info("Final write back complete")
+
+        os.close(self.inotify_fd)
+        for fd in self.backing_fds:
+            os.close(fd)
+
+
+def write_back() -> None:
+    """
+    Run the write-back daemon for the paths recorded before pivoting.
+
+    Returns:
+        None
+    """
+    with open(os.path.join(os.path.sep, WRITE_BACK_DIR, STATE_FILE)) as f:
+        entries = json.load(f)
+
+    wait_for_background_copy()
+    WriteBackDaemon(entries).run()
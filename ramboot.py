@@ -1,13 +1,28 @@
 from startup.initial_activations import initial_activations
 from finish.disks import hide_disks
-from setup.mounts.mounts import get_all_mounts
+from setup.mounts.mounts import get_all_mounts, record_discovery
 from finish.move_mounts import move_system_mounts
 from finish.pivot_root import pivot_root
 from setup.ramdisk.main_ramdisk import create_ramdisk
 from setup.ramdisk.copy_mounts import copy_all_mounts
 from setup.mounts.fstab import replace_fstab
+from setup.ramdisk.early_pivot import EarlyPivot
+from setup.ramdisk.write_back import WriteBack
+from postboot.profile_recorder import record_profile, start_profile_recorder
+from postboot.background_copy import complete_copy
+from postboot.write_back_daemon import write_back
+from postboot.reclaim import print_reclaim_status, run_reclaim, start_reclaim
+from postboot.stats import print_stats
+from postboot.boot_metrics import BootMetrics
+from postboot.boot_history import append_history, print_history
+from utils.phase_profiler import PhaseProfiler
+from utils.trace import Tracer
 
+import argparse
 import json
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator
 
 
 def boot() -> None:
@@ -17,12 +32,47 @@ def boot() -> None:
     Returns:
         None
     """
+    try:
+        boot_phases()
+    finally:
+        # Written last, so once the root is pivoted they land on the ramdisk
+        Tracer.save()
+        PhaseProfiler.save()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[Dict]:
+    """
+    Trace and, if enabled, profile a phase of the boot.
+
+    Args:
+        name (str): The name of the phase.
+
+    Yields:
+        Dict: The details of the phase span, to add results to.
+    """
+    with Tracer.span(name, "phase") as span, PhaseProfiler.profile(name):
+        yield span
+
+
+def boot_phases() -> None:
+    """
+    Run each phase of the boot in turn, tracing and profiling each one.
+
+    Returns:
+        None
+    """
+    # Collect the timings of each phase for the boot metrics
+    BootMetrics.start()
 
     # Attempt to activate/scan filesystems
-    initial_activations()
+    with phase("initial_activations"):
+        initial_activations()
 
     # Get all mounts mentioned in /etc/fstab
-    all_mounts = get_all_mounts()
+    with phase("get_all_mounts") as span:
+        all_mounts = get_all_mounts()
+        span["mounts"] = len(all_mounts)
 
     with open("/root/mounts.json", "a") as f:
         json.dump([mount.__dict__ for mount in all_mounts], f, indent=2)
@@ -31,22 +81,109 @@ def boot() -> None:
     physical_mounts = all_mounts.get_physical_mounts()
 
     # Create the ramdisk
-    ramdisk_base = create_ramdisk(physical_mounts)
+    with phase("create_ramdisk"):
+        ramdisk_base = create_ramdisk(physical_mounts)
 
     # Copy mounts to the ramdisk
-    copy_all_mounts(physical_mounts, ramdisk_base)
+    with phase("copy_all_mounts"):
+        copy_all_mounts(physical_mounts, ramdisk_base)
 
     # Fix fstab to prevent remounts
-    replace_fstab(all_mounts, ramdisk_base)
+    with phase("replace_fstab"):
+        replace_fstab(all_mounts, ramdisk_base)
 
     # Move dev, proc, sys, and run to ramdisk
-    move_system_mounts(ramdisk_base)
+    with phase("move_system_mounts"):
+        move_system_mounts(ramdisk_base)
+
+    # Record this boot while the disk is still the root
+    append_history(physical_mounts, ramdisk_base)
 
     # Pivot Root
-    pivot_root(ramdisk_base)
+    with phase("pivot_root"):
+        pivot_root(ramdisk_base)
+
+    with phase("start_background_tasks"):
+        # Copy whatever an early pivot left behind
+        EarlyPivot.start_background_copy()
+
+        # Write changes to configured paths back to disk
+        WriteBack.start()
+
+        # Return the memory of deleted files to the kernel
+        start_reclaim()
+
+        # Record the files opened while the system boots from the ramdisk
+        start_profile_recorder(physical_mounts)
 
     # Hide devices used for mounts
-    hide_disks(all_mounts)
+    with phase("hide_disks"):
+        hide_disks(all_mounts)
+
+    # Publish the boot metrics for the node_exporter textfile collector
+    BootMetrics.write()
+
+
+def main() -> None:
+    """
+    Parse the command line and run the requested command, booting into the ramdisk by default.
+
+    Returns:
+        None
+    """
+    logging.basicConfig(level=logging.INFO, format="ramboot: %(message)s")
+
+    parser = argparse.ArgumentParser(prog="ramboot")
+    subparsers = parser.add_subparsers(dest="command")
+
+    record_parser = subparsers.add_parser("record-profile", help="Record the files opened during boot")
+    record_parser.add_argument("--source", required=True, help="Source device of the root filesystem")
+    record_parser.add_argument("--fstype", required=True, help="Filesystem type of the root filesystem")
+    record_parser.add_argument("--options", default="", help="Mount options of the root filesystem")
+    record_parser.add_argument("mount_points", nargs="+", help="Mount points to watch")
+
+    subparsers.add_parser("complete-copy", help="Copy the mounts left pending by an early pivot")
+
+    subparsers.add_parser("write-back", help="Write changes to the configured paths back to disk")
+
+    subparsers.add_parser("reclaim", help="Periodically trim the ramdisk filesystems")
+    status_parser = subparsers.add_parser("reclaim-status", help="Show ramdisk memory against filesystem usage")
+    status_parser.add_argument("--json", action="store_true", help="Print JSON")
+
+    stats_parser = subparsers.add_parser("stats", help="Show what the ramdisk costs in RAM")
+    stats_parser.add_argument("--json", action="store_true", help="Print JSON")
+    stats_parser.add_argument("--depth", type=int, default=2, help="Directory levels to consider for top directories")
+    stats_parser.add_argument("--top", type=int, default=10, help="Number of top directories per filesystem")
+
+    history_parser = subparsers.add_parser("history", help="Show boot time trends and flag regressions")
+    history_parser.add_argument("--json", action="store_true", help="Print JSON")
+    history_parser.add_argument("--last", type=int, default=10, help="Number of recent boots to show")
+
+    record_commands_parser = subparsers.add_parser("record-commands",
+                                                   help="Record the commands run to discover mounts into a fixture")
+    record_commands_parser.add_argument("--output", required=True, help="Fixture file to write")
+
+    args = parser.parse_args()
+
+    if args.command == "record-profile":
+        record_profile(args.source, args.fstype, args.options, args.mount_points)
+    elif args.command == "complete-copy":
+        complete_copy()
+    elif args.command == "write-back":
+        write_back()
+    elif args.command == "reclaim":
+        run_reclaim()
+    elif args.command == "reclaim-status":
+        print_reclaim_status(args.json)
+    elif args.command == "stats":
+        print_stats(args.json, args.depth, args.top)
+    elif args.command == "history":
+        print_history(args.json, args.last)
+    elif args.command == "record-commands":
+        record_discovery(args.output)
+    else:
+        boot()
+
 
 if __name__ == "__main__":
-    boot()
\ No newline at end of file
+    main()
@@ -1,6 +1,8 @@
 import os
 from typing import List
 from setup.mounts.mount_info import MountInfo, AllMounts
+from setup.ramdisk.compressed_images import CompressedImages
+from setup.ramdisk.keep_on_disk import KeepOnDisk
 from utils.ramboot_config import RambootConfig
 
 
@@ -47,7 +49,8 @@ def get_mounts() -> List[MountInfo]:
 
 def replace_fstab(all_mounts: AllMounts, ramdisk_base: str) -> None:
     """
-    Replace the fstab file with entries for non-physical mounts.
+    Replace the fstab file with entries for non-physical mounts, the compressed image overlays and the subtrees kept
+    on disk.
 
     Args:
         all_mounts (AllMounts): An object containing all mount information.
@@ -58,6 +61,8 @@ def replace_fstab(all_mounts: AllMounts, ramdisk_base: str) -> None:
     """
     fstab_path = os.path.join(ramdisk_base, RambootConfig.get_fstab_file().lstrip(os.path.sep))
     fstab_lines = [mount.to_fstab_line() for mount in all_mounts if not mount.is_physical()]
+    fstab_lines += CompressedImages.get_fstab_lines()
+    fstab_lines += KeepOnDisk.get_fstab_lines()
 
     with open(fstab_path, "w") as f:
         f.writelines(line + os.linesep for line in fstab_lines)
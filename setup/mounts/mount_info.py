@@ -395,6 +395,19 @@ class AllMounts(Sequence):
         """
         return AllMounts([mount for mount in self.mount_list if mount.is_physical()])
 
+    def get_holder(self, path: str) -> MountInfo:
+        """
+        Get the deepest mount containing a path.
+
+        Args:
+            path (str): The absolute path to look up.
+
+        Returns:
+            MountInfo: The MountInfo object of the mount the path lives on.
+        """
+        holders = [mount for mount in self.mount_list if os.path.commonpath([path, mount.dest]) == mount.dest]
+        return max(holders, key=lambda mount: len(mount.dest))
+
     def get_root_mount(self) -> MountInfo:
         """
         Get the root mount from this collection.
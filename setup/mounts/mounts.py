@@ -1,8 +1,10 @@
+import json
 from typing import List
 
 from setup.mounts import fstab
 from setup.zfs import zfs
 from setup.mounts.mount_info import MountInfo, AllMounts
+from utils.command_replay import CommandReplay
 from utils.ramboot_config import RambootConfig
 
 
@@ -34,3 +36,28 @@ def get_all_mounts() -> AllMounts:
 
     # TODO: Include ZFS
     return AllMounts(all_mounts)
+
+
+def record_discovery(output: str) -> None:
+    """
+    Discover all mounts on this host, recording the fstab and the output of every command run into a fixture file.
+
+    The fixture can be replayed to measure discovery offline.
+
+    Args:
+        output (str): The fixture file to write.
+
+    Returns:
+        None
+    """
+    CommandReplay.record()
+
+    try:
+        all_mounts = get_all_mounts()
+    finally:
+        fixture = CommandReplay.stop()
+
+    with open(output, "w") as f:
+        json.dump(fixture, f, indent=2)
+
+    print(f"Recorded {len(fixture['commands'])} commands discovering {len(all_mounts)} mounts to {output}")
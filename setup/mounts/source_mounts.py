@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from setup.mounts.mount_info import MountInfo
+from utils.shell_commands import run_command
+
+
+def mount_source(mount: MountInfo, target: str | None = None, read_only: bool = False) -> str:
+    """
+    Mount the source filesystem to a temporary directory for copying.
+
+    This function mounts the source filesystem to a temporary mount point, handling
+    special cases for `btrfs` and `zfs` filesystems.
+
+    Args:
+        mount (MountInfo): The mount point information that needs to be mounted temporarily.
+        target (str | None): Where to mount the source, a temporary directory is created if None.
+        read_only (bool): Whether to mount the source read-only.
+
+    Returns:
+        str: The path to the temporary mount point.
+    """
+    # Create Source Mount Point
+    if target is None:
+        temp_mount_point = tempfile.mkdtemp()
+    else:
+        os.makedirs(target, exist_ok=True)
+        temp_mount_point = target
+
+    options = ["ro"] if read_only else []
+
+    # If we have a btrfs, we need to handle subvols
+    if mount.fstype == "btrfs":
+        run_command(["mount", "--options", ",".join(mount.fsopts + options), mount.source, temp_mount_point])
+
+    # If we have a zfs, we need to handle volumes via zfsutil
+    elif mount.fstype == "zfs":
+        run_command(["mount", "--types", "zfs", "--options", ",".join(["zfsutil"] + options), mount.source,
+                     temp_mount_point])
+
+    # Otherwise, mount normally
+    elif read_only:
+        run_command(["mount", "--options", "ro", mount.source, temp_mount_point])
+    else:
+        run_command(["mount", mount.source, temp_mount_point])
+
+    return temp_mount_point
+
+
+def cleanup_mount(temp_mount_point: str) -> None:
+    """
+    Unmount and clean up the temporary mount point.
+
+    This function unmounts the source filesystem from the temporary mount point and
+    then removes the temporary directory.
+
+    Args:
+        temp_mount_point (str): The path to the temporary mount point.
+
+    Returns:
+        None
+    """
+    # Unmount Source
+    run_command(["umount", "--force", temp_mount_point])
+
+    # Cleanup Source
+    os.rmdir(temp_mount_point)
+
+
+@contextmanager
+def mounted_source(mount: MountInfo) -> Iterator[str]:
+    """
+    Make the source filesystem of a mount available for reading.
+
+    Root is already mounted at `/`, everything else is mounted to a temporary directory for the duration.
+
+    Args:
+        mount (MountInfo): The mount point information that needs to be read.
+
+    Yields:
+        str: The path the source filesystem can be read from.
+    """
+    if mount.is_root():
+        yield os.path.sep
+        return
+
+    temp_mount_point = mount_source(mount)
+
+    try:
+        yield temp_mount_point
+    finally:
+        cleanup_mount(temp_mount_point)
+
+
+@contextmanager
+def masked_source(source_root: str, rel_paths: List[str], bind: bool = False) -> Iterator[str]:
+    """
+    Provide a view of a source filesystem with some directories hidden behind empty tmpfs mounts.
+
+    The source is bind mounted (without its submounts) to a temporary directory and the tmpfs mounts are placed
+    inside that view, so the live filesystem is never modified.  Tools staying on one filesystem, like
+    `cp --one-file-system`, keep the hidden directories themselves but not their contents.
+
+    Args:
+        source_root (str): The root of the source filesystem.
+        rel_paths (List[str]): The directories to hide, relative to the source root.
+        bind (bool): Whether to provide the view even if nothing needs hiding, for tools that cross filesystems.
+
+    Yields:
+        str: The path of the masked view, or the source root itself if nothing needs hiding and bind is not set.
+    """
+    rel_paths = [rel_path for rel_path in rel_paths if os.path.isdir(os.path.join(source_root, rel_path))]
+
+    if not rel_paths and not bind:
+        yield source_root
+        return
+
+    view = tempfile.mkdtemp()
+    run_command(["mount", "--bind", source_root, view])
+
+    mask_points = []
+    for rel_path in rel_paths:
+        mask_point = os.path.join(view, rel_path)
+        mask_stat = os.stat(mask_point)
+
+        # Keep the ownership and permissions of the hidden directory, copies of it should look the same
+        options = f"size=1m,mode={mask_stat.st_mode & 0o7777:o},uid={mask_stat.st_uid},gid={mask_stat.st_gid}"
+        run_command(["mount", "--types", "tmpfs", "--options", options, "tmpfs", mask_point])
+        mask_points.append(mask_point)
+
+    try:
+        yield view
+    finally:
+        for mask_point in reversed(mask_points):
+            run_command(["umount", mask_point])
+
+        run_command(["umount", view])
+        os.rmdir(view)
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import gzip
+import logging
+import os
+import stat
+import time
+from typing import Callable, Dict, Iterable, List
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.ramdisk.file_copy import apply_metadata, copy_entry
+from utils.ramboot_config import RambootConfig
+
+logger = logging.getLogger(__name__)
+
+
+def write_profile(profile_path: str, paths: Iterable[str]) -> None:
+    """
+    Write an access profile, one absolute path per line, sorted and gzip compressed.
+
+    Args:
+        profile_path (str): The file to write.
+        paths (Iterable[str]): The absolute paths of the files opened during boot.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+    temp_path = f"{profile_path}.tmp"
+
+    with gzip.open(temp_path, "wb") as f:
+        for path in sorted(set(paths)):
+            f.write(os.fsencode(path) + b"\n")
+
+    os.replace(temp_path, profile_path)
+
+
+def read_profile(profile_path: str) -> List[str]:
+    """
+    Read an access profile.
+
+    Args:
+        profile_path (str): The file to read.
+
+    Returns:
+        List[str]: The absolute paths in the profile, or an empty list if there is no profile.
+    """
+    if not os.path.isfile(profile_path):
+        return []
+
+    with gzip.open(profile_path, "rb") as f:
+        return [os.fsdecode(line.rstrip(b"\n")) for line in f if line.strip()]
+
+
+def make_parents(ramdisk_copy_point: str, rel_path: str) -> List[str]:
+    """
+    Create the missing directories leading to a path on the ramdisk.
+
+    Args:
+        ramdisk_copy_point (str): The directory the mount is copied to on the RAM disk.
+        rel_path (str): The path about to be copied, relative to the copy point.
+
+    Returns:
+        List[str]: The directories created, relative to the copy point.
+    """
+    missing = []
+    parent = os.path.dirname(rel_path)
+
+    while parent and not os.path.isdir(os.path.join(ramdisk_copy_point, parent)):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+
+    for rel_dir in reversed(missing):
+        os.mkdir(os.path.join(ramdisk_copy_point, rel_dir))
+
+    return missing
+
+
+class AccessProfile:
+    """
+    The files opened during a previous boot, copied ahead of everything else so the boot-critical set is on the
+    ramdisk as early as possible.
+    """
+
+    _paths: Dict[str, List[str]] | None = None
+    _critical_files: int = 0
+    _critical_bytes: int = 0
+    _critical_seconds: float = 0.0
+
+    @classmethod
+    def get_rel_paths(cls, mount: MountInfo, all_mounts: AllMounts) -> List[str]:
+        """
+        Get the profiled files living on a mount, relative to the mount.
+
+        Args:
+            mount (MountInfo): The mount to check.
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            List[str]: The profiled files relative to the mount root.
+        """
+        if cls._paths is None:
+            cls._paths = {}
+
+            if RambootConfig.get_profile_use():
+                for path in read_profile(RambootConfig.get_profile_path()):
+                    holder = all_mounts.get_holder(path)
+                    cls._paths.setdefault(holder.dest, []).append(os.path.relpath(path, holder.dest))
+
+        return cls._paths.get(mount.dest, [])
+
+    @classmethod
+    def copy_critical(cls, mount: MountInfo, all_mounts: AllMounts, source_root: str, ramdisk_copy_point: str,
+                      masked_paths: List[str], exclude: Callable[[str, bool], bool] | None = None) -> None:
+        """
+        Copy the profiled files of a mount, along with the directories leading to them.
+
+        Files in masked directories and excluded files are skipped, they are not part of the copy.  Directories
+        created along the way take the metadata of their source, they may be served as they are after an early pivot.
+
+        Args:
+            mount (MountInfo): The mount being copied.
+            all_mounts (AllMounts): All mounts being copied.
+            source_root (str): The path the mount's source filesystem can be read from.
+            ramdisk_copy_point (str): The matching directory on the RAM disk.
+            masked_paths (List[str]): Directories, relative to the mount, whose contents are not copied.
+            exclude (Callable[[str, bool], bool] | None): The exclude callback used for the copy.
+
+        Returns:
+            None
+        """
+        start = time.monotonic()
+        created_dirs = []
+
+        for rel_path in cls.get_rel_paths(mount, all_mounts):
+            if any(rel_path == masked or rel_path.startswith(masked + os.path.sep) for masked in masked_paths):
+                continue
+
+            if exclude is not None and exclude(rel_path, False):
+                continue
+
+            source = os.path.join(source_root, rel_path)
+
+            try:
+                entry_stat = os.lstat(source)
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    continue
+
+                created_dirs.extend(make_parents(ramdisk_copy_point, rel_path))
+                cls._critical_bytes += copy_entry(source, os.path.join(ramdisk_copy_point, rel_path), entry_stat)
+                cls._critical_files += 1
+            except OSError:
+                # Files opened during a previous boot may be gone by now
+                continue
+
+        # Once everything is in place, so copying into a directory does not change its timestamps afterwards
+        for rel_dir in created_dirs:
+            source = os.path.join(source_root, rel_dir)
+
+            try:
+                apply_metadata(os.path.join(ramdisk_copy_point, rel_dir), os.lstat(source), source)
+            except OSError:
+                continue
+
+        cls._critical_seconds += time.monotonic() - start
+
+    @classmethod
+    def has_profile(cls, all_mounts: AllMounts) -> bool:
+        """
+        Check if there is an access profile to copy ahead of everything else.
+
+        Args:
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            bool: True if any mount has profiled files, False otherwise.
+        """
+        return any(cls.get_rel_paths(mount, all_mounts) for mount in all_mounts)
+
+    @classmethod
+    def log_critical_complete(cls) -> None:
+        """
+        Report that the boot-critical set is on the ramdisk.
+
+        Returns:
+            None
+        """
+        logger.info("Boot-critical set complete: %d files, %d bytes in %.1fs",
+                    cls._critical_files, cls._critical_bytes, cls._critical_seconds)
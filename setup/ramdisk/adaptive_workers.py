@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from setup.mounts.mount_info import AllMounts
+from utils.ramboot_config import RambootConfig
+from utils.topology import get_topology_fingerprint
+from utils.trace import Tracer
+
+logger = logging.getLogger(__name__)
+
+# Each file costs about as much as copying this many bytes, so small-file and large-file throughput add up
+FILE_COST_BYTES = 64 * 1024
+
+# Throughput changes smaller than this fraction are taken as noise
+TOLERANCE = 0.05
+
+# Learned worker counts are kept for this many topologies
+TOPOLOGY_LIMIT = 20
+
+
+class ConcurrencyLimit:
+    """
+    A semaphore whose number of permits can be changed while it is in use.
+
+    Lowering the limit does not interrupt holders, new acquirers wait until enough permits are released.
+    """
+
+    def __init__(self, limit: int):
+        """
+        Initialize the limit with no permits held.
+
+        Args:
+            limit (int): The number of permits.
+        """
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def set_limit(self, limit: int) -> None:
+        """
+        Change the number of permits.
+
+        Args:
+            limit (int): The new number of permits.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def __enter__(self) -> ConcurrencyLimit:
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+
+            self.active += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class WorkerController:
+    """
+    Hill-climbs the number of active copy workers on the throughput measured over short windows.
+
+    Each window the limit moves one step in the current direction.  When throughput drops, the direction reverses;
+    when it holds steady, the limit stays put until it changes.  The step is a quarter of the limit, so large limits
+    are explored quickly.  The limit giving the best throughput is kept as the starting point for the next boot.
+    """
+
+    def __init__(self, name: str, stats, start: int, min_workers: int, max_workers: int, interval: float):
+        """
+        Initialize a controller for a copy.
+
+        Args:
+            name (str): The name of the copy, such as its destination.
+            stats (CopyStats): The counters of the copy, read every window.
+            start (int): The number of workers to start with.
+            min_workers (int): The fewest workers to use.
+            max_workers (int): The most workers to use.
+            interval (float): The length of a measurement window in seconds.
+        """
+        self.name = name
+        self.stats = stats
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.limit = ConcurrencyLimit(min(max_workers, max(min_workers, start)))
+        self.best: Tuple[float, int] = (0.0, self.limit.limit)
+        self.history: List[int] = [self.limit.limit]
+        self.stop = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.started = 0
+
+    def get_work(self) -> int:
+        """
+        Get the work done so far, as bytes plus a fixed cost per file.
+
+        Returns:
+            int: The work done.
+        """
+        return self.stats.bytes_copied + self.stats.files_copied * FILE_COST_BYTES
+
+    def adjust(self) -> None:
+        """
+        Move the limit every window until the copy is done.
+
+        Returns:
+            None
+        """
+        last_work = self.get_work()
+        last_rate = None
+        direction = 1
+
+        while not self.stop.wait(self.interval):
+            work = self.get_work()
+            rate = (work - last_work) / self.interval
+            last_work = work
+            workers = self.limit.limit
+
+            self.best = max(self.best, (rate, workers))
+
+            if last_rate is not None and rate < last_rate * (1 - TOLERANCE):
+                direction = -direction
+            elif last_rate is not None and rate <= last_rate * (1 + TOLERANCE):
+                last_rate = rate
+                continue
+
+            last_rate = rate
+            step = max(1, workers // 4)
+            new_workers = min(self.max_workers, max(self.min_workers, workers + direction * step))
+
+            # Bounce off the bounds instead of sitting against them
+            if new_workers == workers:
+                direction = -direction
+                continue
+
+            self.limit.set_limit(new_workers)
+            self.history.append(new_workers)
+
+    def __enter__(self) -> WorkerController:
+        self.started = time.perf_counter_ns()
+        self.thread = threading.Thread(target=self.adjust, name="copy-controller", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop.set()
+        self.thread.join()
+
+        rate, workers = self.best
+        Tracer.add_span("copy workers", "copy", self.started, time.perf_counter_ns(),
+                        {"destination": self.name, "workers": self.history, "best": workers}, self.thread)
+        logger.info("%s: copied with %d to %d workers, best %d at %.1f MB/s equivalent, learned for the next boot",
+                    self.name, min(self.history), max(self.history), workers, rate / 10 ** 6)
+        AdaptiveWorkers.record(self.name, workers)
+
+
+class AdaptiveWorkers:
+    """
+    Adapts the number of copy workers of the builtin engine to the hardware while copying, and remembers the best
+    number per mount for the next boot on the same topology.
+    """
+
+    _fingerprint: str | None = None
+    _learned: Dict[str, int] = {}
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        """
+        Check if the number of copy workers is adapted while copying.
+
+        Returns:
+            bool: True if adaptive copy workers are configured, False otherwise.
+        """
+        return RambootConfig.get_copy_adaptive()
+
+    @classmethod
+    def read_state(cls) -> Dict[str, Dict[str, int]]:
+        """
+        Read the learned worker counts of every topology.
+
+        Returns:
+            Dict[str, Dict[str, int]]: The worker count per copy destination, by topology fingerprint.
+        """
+        try:
+            with open(RambootConfig.get_copy_workers_file()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @classmethod
+    def set_mounts(cls, physical_mounts: AllMounts) -> None:
+        """
+        Load the worker counts learned on previous boots of this topology.
+
+        Args:
+            physical_mounts (AllMounts): The physical mounts being copied.
+
+        Returns:
+            None
+        """
+        if not cls.is_enabled():
+            return
+
+        cls._fingerprint = get_topology_fingerprint(physical_mounts)
+        cls._learned = dict(cls.read_state().get(cls._fingerprint, {}))
+
+    @classmethod
+    def controller(cls, name: str, stats) -> WorkerController:
+        """
+        Create the controller for a copy, starting from the count learned for it or the configured one.
+
+        Args:
+            name (str): The name of the copy, its destination on the ramdisk.
+            stats (CopyStats): The counters of the copy.
+
+        Returns:
+            WorkerController: The controller, to be entered for the duration of the copy.
+        """
+        start = cls._learned.get(name, RambootConfig.get_copy_workers())
+        return WorkerController(name, stats, start, max(1, RambootConfig.get_copy_min_workers()),
+                                max(1, RambootConfig.get_copy_max_workers()), RambootConfig.get_copy_adapt_interval())
+
+    @classmethod
+    def record(cls, name: str, workers: int) -> None:
+        """
+        Remember the best worker count of a copy.
+
+        Args:
+            name (str): The name of the copy, its destination on the ramdisk.
+            workers (int): The worker count that gave the best throughput.
+
+        Returns:
+            None
+        """
+        cls._learned[name] = workers
+
+    @classmethod
+    def save(cls) -> None:
+        """
+        Write the learned worker counts to disk, while the disk is still the root.
+
+        Returns:
+            None
+        """
+        if not cls.is_enabled() or cls._fingerprint is None or not cls._learned:
+            return
+
+        path = RambootConfig.get_copy_workers_file()
+        state = cls.read_state()
+        state.pop(cls._fingerprint, None)
+        state[cls._fingerprint] = cls._learned
+
+        # Dicts keep their insertion order, the topologies seen least recently go first
+        state = dict(list(state.items())[-TOPOLOGY_LIMIT:])
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(state, f, indent=2)
+
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning("Unable to save the learned copy workers to %s: %s", path, e)
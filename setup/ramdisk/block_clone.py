@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Dict, Iterator, Set
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.ramdisk.early_pivot import EarlyPivot
+from setup.ramdisk.exclusions import ExclusionRules
+from setup.ramdisk.masked_paths import get_masked_paths
+from setup.ramdisk.ramdisk_part_info import AllRamdiskPartInfo, RamdiskPartInfo
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import run_command
+
+logger = logging.getLogger(__name__)
+
+# The name of the copy strategy for cloned mounts, which only describes the copy already made
+CLONE_STRATEGY = "clone"
+
+# Both only read and write the blocks in use and keep the UUID of the source
+CLONE_CMDS = {
+    "ext2": ["e2image", "-ra"],
+    "ext3": ["e2image", "-ra"],
+    "ext4": ["e2image", "-ra"],
+    "xfs": ["xfs_copy", "-d"],
+}
+
+# ext filesystems are grown before they are mounted, resize2fs insists on a fresh check first
+CHECK_EXT_CMD = ["e2fsck", "-f", "-p"]
+GROW_EXT_CMD = ["resize2fs"]
+
+# xfs can only be grown while mounted
+GROW_XFS_CMD = ["xfs_growfs"]
+
+# Clones get a UUID of their own, xfs refuses to mount a second filesystem with the UUID of one already mounted
+NEW_UUID_CMDS = {
+    "ext2": ["tune2fs", "-U", "random"],
+    "ext3": ["tune2fs", "-U", "random"],
+    "ext4": ["tune2fs", "-U", "random"],
+    "xfs": ["xfs_admin", "-U", "generate"],
+}
+
+# Clears what a failed clone left on a partition, mkfs.xfs refuses to format over an existing filesystem
+WIPE_CMD = ["wipefs", "--all"]
+
+
+def get_device_bytes(device: str) -> int:
+    """
+    Get the size of a block device.
+
+    Args:
+        device (str): The block device.
+
+    Returns:
+        int: The size in bytes.
+    """
+    fd = os.open(device, os.O_RDONLY)
+
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def read_only_source(mount: MountInfo) -> Iterator[bool]:
+    """
+    Keep the source of a mount from changing while it is cloned.
+
+    Other sources are not mounted before the copy, the root is remounted read-only for the duration.
+
+    Args:
+        mount (MountInfo): The mount being cloned.
+
+    Yields:
+        bool: True if the source cannot change, False if the root could not be remounted read-only.
+    """
+    if mount.dest != os.path.sep:
+        yield True
+        return
+
+    if run_command(["mount", "--options", "remount,ro", os.path.sep]).returncode != 0:
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        run_command(["mount", "--options", "remount,rw", os.path.sep])
+
+
+class BlockClone:
+    """
+    Clones the blocks in use by a source filesystem straight onto its ramdisk partition, instead of formatting the
+    partition and copying the mount file by file.
+
+    Only whole ext2/3/4 and xfs mounts are cloned, onto partitions of the same filesystem, since a block copy cannot
+    leave masked subtrees or excluded paths out.  The filesystem is grown to the partition and given a UUID of its own
+    afterwards, so it can be mounted next to its source.
+    """
+
+    _planned: Dict[int, MountInfo] = {}
+    _cloned: Set[str] = set()
+
+    @classmethod
+    def is_wanted(cls, mount: MountInfo) -> bool:
+        """
+        Check if a mount should be cloned, when it can be.
+
+        Args:
+            mount (MountInfo): The mount to check.
+
+        Returns:
+            bool: True if the clone strategy is configured for the mount, or picked automatically, False otherwise.
+        """
+        override = RambootConfig.get_copy_strategies().get(mount.dest)
+        if override is not None:
+            return override == CLONE_STRATEGY
+
+        return RambootConfig.get_copy_engine() in {"auto", CLONE_STRATEGY}
+
+    @classmethod
+    def get_skip_reason(cls, mount: MountInfo, part_info: RamdiskPartInfo, physical_mounts: AllMounts) -> str | None:
+        """
+        Check why a mount cannot be cloned onto its partition.
+
+        Args:
+            mount (MountInfo): The mount to check.
+            part_info (RamdiskPartInfo): The ramdisk partition of the mount.
+            physical_mounts (AllMounts): The physical mounts being copied.
+
+        Returns:
+            str | None: Why the mount cannot be cloned, or None if it can.
+        """
+        if mount.fstype not in CLONE_CMDS:
+            return f"{mount.fstype} cannot be cloned"
+
+        if part_info.fstype != mount.fstype:
+            return f"the partition is {part_info.fstype}"
+
+        if get_masked_paths(mount, physical_mounts):
+            return "parts of it are packed into images, kept on disk or hold the image cache"
+
+        if ExclusionRules.get_exclude(mount) is not None:
+            return "it has exclusion rules"
+
+        if shutil.which(CLONE_CMDS[mount.fstype][0]) is None:
+            return f"{CLONE_CMDS[mount.fstype][0]} is not installed"
+
+        return None
+
+    @classmethod
+    def plan(cls, physical_mounts: AllMounts, all_ramdisk_partitions: AllRamdiskPartInfo) -> None:
+        """
+        Pick the partitions to clone rather than format.
+
+        Args:
+            physical_mounts (AllMounts): The physical mounts being copied.
+            all_ramdisk_partitions (AllRamdiskPartInfo): The partitions of the ramdisk, one per mount.
+
+        Returns:
+            None
+        """
+        # An early pivot serves mounts from their sources through overlays until the background copy is done
+        if EarlyPivot.is_enabled():
+            return
+
+        mounts = {mount.dest: mount for mount in physical_mounts}
+
+        for part_info in all_ramdisk_partitions:
+            mount = mounts[part_info.destination]
+
+            if not cls.is_wanted(mount):
+                continue
+
+            reason = cls.get_skip_reason(mount, part_info, physical_mounts)
+            if reason is not None:
+                logger.info("%s: not cloning, %s", mount.dest, reason)
+                continue
+
+            cls._planned[part_info.order] = mount
+
+    @classmethod
+    def clone(cls, part_info: RamdiskPartInfo, device: str) -> bool:
+        """
+        Clone the source of a partition onto it, if planned, grow it to the partition and give it a new UUID.
+
+        A partition left with a failed clone is wiped, to be formatted like any other.
+
+        Args:
+            part_info (RamdiskPartInfo): The ramdisk partition.
+            device (str): The block device of the partition.
+
+        Returns:
+            bool: True if the partition holds the clone and needs no formatting, False otherwise.
+        """
+        mount = cls._planned.get(part_info.order)
+        if mount is None:
+            return False
+
+        if get_device_bytes(mount.source) > get_device_bytes(device):
+            logger.info("%s: not cloning, the partition is smaller than %s", mount.dest, mount.source)
+            return False
+
+        with read_only_source(mount) as read_only:
+            if not read_only:
+                logger.warning("%s: unable to remount read-only, copying file by file instead", mount.dest)
+                return False
+
+            result = run_command(CLONE_CMDS[mount.fstype] + [mount.source, device])
+
+        if result.returncode != 0:
+            logger.warning("%s: failed to clone %s, copying file by file instead", mount.dest, mount.source)
+            run_command(WIPE_CMD + [device])
+            return False
+
+        if mount.fstype != "xfs":
+            # e2fsck exits with 1 when it fixed something
+            if run_command(CHECK_EXT_CMD + [device]).returncode > 1 \
+                    or run_command(GROW_EXT_CMD + [device]).returncode != 0:
+                logger.warning("%s: failed to grow the clone, copying file by file instead", mount.dest)
+                run_command(WIPE_CMD + [device])
+                return False
+
+        if run_command(NEW_UUID_CMDS[mount.fstype] + [device]).returncode != 0:
+            logger.warning("%s: failed to give the clone a new UUID, copying file by file instead", mount.dest)
+            run_command(WIPE_CMD + [device])
+            return False
+
+        logger.info("%s: cloned the used blocks of %s onto %s", mount.dest, mount.source, device)
+        cls._cloned.add(mount.dest)
+        return True
+
+    @classmethod
+    def grow(cls, part_info: RamdiskPartInfo, mount_point: str) -> None:
+        """
+        Grow a cloned filesystem that can only be grown once mounted to its partition.
+
+        Args:
+            part_info (RamdiskPartInfo): The ramdisk partition.
+            mount_point (str): Where the partition is mounted.
+
+        Returns:
+            None
+        """
+        if part_info.destination not in cls._cloned or part_info.fstype != "xfs":
+            return
+
+        if run_command(GROW_XFS_CMD + [mount_point]).returncode != 0:
+            logger.warning("%s: failed to grow the clone, it keeps the size of its source", part_info.destination)
+
+    @classmethod
+    def discard(cls, dest: str) -> None:
+        """
+        Forget the clone of a mount that could not be mounted, so it is copied file by file instead.
+
+        Args:
+            dest (str): The mount point.
+
+        Returns:
+            None
+        """
+        cls._cloned.discard(dest)
+
+    @classmethod
+    def is_cloned(cls, dest: str) -> bool:
+        """
+        Check if a mount was cloned onto its partition, and needs no copying.
+
+        Args:
+            dest (str): The mount point.
+
+        Returns:
+            bool: True if the mount was cloned, False otherwise.
+        """
+        return dest in cls._cloned
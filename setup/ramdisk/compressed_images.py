@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import stat
+from typing import Dict, List
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.mounts.source_mounts import mounted_source
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+from utils.shell_commands import run_command
+
+logger = logging.getLogger(__name__)
+
+# Relative to the ramdisk base, a tmpfs holding images, their read-only mount points and the overlay upper layers
+OVERLAY_DIR = ".ramboot/overlay"
+
+
+def get_pack_cmd(source: str, image: str) -> List[str]:
+    """
+    Build the command packing a directory into a compressed image.
+
+    Args:
+        source (str): The directory to pack.
+        image (str): The image file to create.
+
+    Returns:
+        List[str]: The command to run.
+    """
+    compression = RambootConfig.get_compressed_image_compression()
+
+    if RambootConfig.get_compressed_image_format() == "erofs":
+        return ["mkfs.erofs", f"-z{compression}", image, source]
+
+    return ["mksquashfs", source, image, "-noappend", "-no-progress", "-comp", compression]
+
+
+def get_tmpfs_options() -> str:
+    """
+    Build the mount options of the tmpfs holding images and overlay layers.
+
+    Returns:
+        str: The tmpfs mount options.
+    """
+    options = "mode=0700"
+    tmpfs_size = RambootConfig.get_compressed_image_tmpfs_size()
+
+    if tmpfs_size is not None:
+        options += f",size={tmpfs_size}"
+
+    return options
+
+
+def get_image_name(path: str) -> str:
+    """
+    Turn a subtree path into a flat name for its image and overlay directories.
+
+    Args:
+        path (str): The absolute path of the subtree, e.g. /usr/share.
+
+    Returns:
+        str: The flat name, e.g. usr-share.
+    """
+    return path.strip(os.path.sep).replace(os.path.sep, "-")
+
+
+class CompressedImages:
+    """
+    Packs configured subtrees into read-only compressed images held in RAM, with a tmpfs overlay for writes.
+
+    Subtrees are packed from their source at boot, hidden from the normal copy, and mounted back into place on the
+    ramdisk through overlayfs.
+    """
+
+    _reserved_bytes: Dict[str, int] = {}
+    _packed: List[str] = []
+
+    @classmethod
+    def get_paths(cls, all_mounts: AllMounts) -> List[str]:
+        """
+        Get the configured subtrees that can be packed.
+
+        Subtrees with other mounts below them are skipped, the overlay would hide those mounts.
+
+        Args:
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            List[str]: The normalized absolute paths of the subtrees.
+        """
+        paths = []
+
+        for path in RambootConfig.get_compressed_image_paths():
+            path = os.path.normpath(path)
+            nested = [mount.dest for mount in all_mounts
+                      if mount.dest != path and os.path.commonpath([path, mount.dest]) == path]
+
+            if path == os.path.sep:
+                logger.warning("Not packing %s, the root cannot be packed", path)
+                continue
+
+            if nested:
+                logger.warning("Not packing %s, it holds other mounts", path)
+                continue
+
+            paths.append(path)
+
+        return paths
+
+    @classmethod
+    def get_rel_paths(cls, mount: MountInfo, all_mounts: AllMounts) -> List[str]:
+        """
+        Get the packed subtrees that live on a mount, relative to the mount.
+
+        Args:
+            mount (MountInfo): The mount to check.
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            List[str]: The packed subtrees relative to the mount root, "." if the whole mount is packed.
+        """
+        return [os.path.relpath(path, mount.dest) for path in cls.get_paths(all_mounts)
+                if all_mounts.get_holder(path).dest == mount.dest]
+
+    @classmethod
+    def is_fully_packed(cls, mount: MountInfo, all_mounts: AllMounts) -> bool:
+        """
+        Check if a mount is packed as a whole, so it does not need copying.
+
+        Args:
+            mount (MountInfo): The mount to check.
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            bool: True if the whole mount is packed, False otherwise.
+        """
+        return os.curdir in cls.get_rel_paths(mount, all_mounts)
+
+    @classmethod
+    def estimate(cls, physical_mounts: AllMounts) -> None:
+        """
+        Measure how much space the packed subtrees would have taken on the ramdisk.
+
+        Args:
+            physical_mounts (AllMounts): An object containing all the physical mounts.
+
+        Returns:
+            None
+        """
+        cls._reserved_bytes = {}
+
+        for mount in physical_mounts:
+            rel_paths = cls.get_rel_paths(mount, physical_mounts)
+
+            if not rel_paths:
+                continue
+
+            with mounted_source(mount) as source_root:
+                for rel_path in rel_paths:
+                    scan = parallel_scan(os.path.join(source_root, rel_path), RambootConfig.get_scan_workers())
+                    used = sum(entry_stat.st_blocks * 512 for _, entry_stat in scan)
+                    cls._reserved_bytes[mount.dest] = cls._reserved_bytes.get(mount.dest, 0) + used
+
+    @classmethod
+    def get_reserved_gb(cls, mount: MountInfo | None = None) -> int:
+        """
+        Get the space, in whole gigabytes, that no longer needs to be allocated on the ramdisk.
+
+        Args:
+            mount (MountInfo | None): The mount to check, or None for all mounts.
+
+        Returns:
+            int: The reserved space in gigabytes, rounded down.
+        """
+        if mount is None:
+            reserved = sum(cls._reserved_bytes.values())
+        else:
+            reserved = cls._reserved_bytes.get(mount.dest, 0)
+
+        return math.floor(float(reserved) / 1024 ** 3)
+
+    @classmethod
+    def prepare(cls, ramdisk_base: str) -> None:
+        """
+        Mount the tmpfs holding the images and overlay layers, if any subtrees are configured.
+
+        Args:
+            ramdisk_base (str): The base directory on the RAM disk.
+
+        Returns:
+            None
+        """
+        cls._packed = []
+
+        if not RambootConfig.get_compressed_image_paths():
+            return
+
+        overlay_dir = os.path.join(ramdisk_base, OVERLAY_DIR)
+        os.makedirs(overlay_dir, exist_ok=True)
+
+        run_command(["mount", "--types", "tmpfs", "--options", get_tmpfs_options(), "tmpfs", overlay_dir])
+
+        for sub_dir in ("images", "lower", "upper", "work"):
+            os.makedirs(os.path.join(overlay_dir, sub_dir), exist_ok=True)
+
+    @classmethod
+    def build(cls, mount: MountInfo, all_mounts: AllMounts, source_root: str, ramdisk_base: str) -> None:
+        """
+        Pack the subtrees living on a mount into compressed images.
+
+        Args:
+            mount (MountInfo): The mount being copied.
+            all_mounts (AllMounts): All mounts being copied.
+            source_root (str): The path the mount's source filesystem can be read from.
+            ramdisk_base (str): The base directory on the RAM disk.
+
+        Returns:
+            None
+        """
+        overlay_dir = os.path.join(ramdisk_base, OVERLAY_DIR)
+
+        for rel_path in cls.get_rel_paths(mount, all_mounts):
+            path = os.path.normpath(os.path.join(mount.dest, rel_path))
+            image = os.path.join(overlay_dir, "images", get_image_name(path))
+
+            result = run_command(get_pack_cmd(os.path.join(source_root, rel_path), image))
+
+            if result.returncode != 0:
+                logger.warning("Failed to pack %s into a compressed image", path)
+                continue
+
+            cls._packed.append(path)
+
+    @classmethod
+    def is_packed(cls, path: str) -> bool:
+        """
+        Check if a subtree was packed into a compressed image during this boot.
+
+        Args:
+            path (str): The absolute path of the subtree.
+
+        Returns:
+            bool: True if the subtree was packed, False otherwise.
+        """
+        return path in cls._packed
+
+    @classmethod
+    def mount_all(cls, ramdisk_base: str) -> None:
+        """
+        Mount every packed image read-only and overlay it, writable, onto its place on the ramdisk.
+
+        Args:
+            ramdisk_base (str): The base directory on the RAM disk.
+
+        Returns:
+            None
+        """
+        overlay_dir = os.path.join(ramdisk_base, OVERLAY_DIR)
+        image_fstype = RambootConfig.get_compressed_image_format()
+
+        for path in cls._packed:
+            name = get_image_name(path)
+            image = os.path.join(overlay_dir, "images", name)
+            lower, upper, work = (os.path.join(overlay_dir, sub_dir, name) for sub_dir in ("lower", "upper", "work"))
+
+            for directory in (lower, upper, work):
+                os.makedirs(directory, exist_ok=True)
+
+            # The copy left an empty directory, carry over its ownership and permissions to the writable layer
+            target = os.path.join(ramdisk_base, path.lstrip(os.path.sep))
+            os.makedirs(target, exist_ok=True)
+            target_stat = os.stat(target)
+            os.chown(upper, target_stat.st_uid, target_stat.st_gid)
+            os.chmod(upper, stat.S_IMODE(target_stat.st_mode))
+
+            run_command(["mount", "--types", image_fstype, "--options", "loop,ro", image, lower])
+            run_command(["mount", "--types", "overlay", "--options",
+                         f"lowerdir={lower},upperdir={upper},workdir={work}", "overlay", target])
+
+            logger.info("%s packed into a %d byte %s image", path, os.path.getsize(image), image_fstype)
+
+    @classmethod
+    def get_fstab_lines(cls) -> List[str]:
+        """
+        Build fstab lines describing the compressed image mounts, as seen after the root is pivoted.
+
+        Returns:
+            List[str]: The fstab lines, ordered so every mount comes after the mounts it depends on.
+        """
+        if not cls._packed:
+            return []
+
+        overlay_dir = os.path.join(os.path.sep, OVERLAY_DIR)
+        image_fstype = RambootConfig.get_compressed_image_format()
+        lines = [f"tmpfs\t{overlay_dir}\ttmpfs\t{get_tmpfs_options()}\t0\t0"]
+
+        for path in cls._packed:
+            name = get_image_name(path)
+            image = os.path.join(overlay_dir, "images", name)
+            lower, upper, work = (os.path.join(overlay_dir, sub_dir, name) for sub_dir in ("lower", "upper", "work"))
+
+            lines.append(f"{image}\t{lower}\t{image_fstype}\tloop,ro\t0\t0")
+            lines.append(f"overlay\t{path}\toverlay\tlowerdir={lower},upperdir={upper},workdir={work}\t0\t0")
+
+        return lines
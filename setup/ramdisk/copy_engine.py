@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import logging
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Tuple
+
+from setup.ramdisk.adaptive_workers import AdaptiveWorkers
+from setup.ramdisk.file_copy import copy_entry, remove_path
+from setup.ramdisk.hardlink_table import HardlinkTable
+from setup.ramdisk.metadata_queue import METADATA_QUEUE_LIMIT, MetadataQueue, PendingDirectories
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+from utils.trace import Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class CopyStats:
+    """
+    Thread safe counters for a tree copy.
+
+    Attributes:
+        bytes_copied (int): The number of data bytes copied.
+        files_copied (int): The number of non-directory entries copied.
+        errors (int): The number of entries that failed to copy.
+        data_seconds (float): The seconds spent creating entries and writing their data.
+        metadata_seconds (float): The seconds spent applying metadata once the data was written.
+    """
+
+    def __init__(self):
+        """
+        Initialize a CopyStats object with all counters at zero.
+        """
+        self.bytes_copied: int = 0
+        self.files_copied: int = 0
+        self.errors: int = 0
+        self.data_seconds: float = 0.0
+        self.metadata_seconds: float = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, copied_bytes: int) -> None:
+        """
+        Count a copied entry.
+
+        Args:
+            copied_bytes (int): The number of data bytes copied for the entry.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.bytes_copied += copied_bytes
+            self.files_copied += 1
+
+    def add_error(self) -> None:
+        """
+        Count an entry that failed to copy.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.errors += 1
+
+
+def apply_deferred(source_root: str, dest_root: str, deferred: MetadataQueue, stats: CopyStats) -> None:
+    """
+    Apply queued file metadata with a pool of metadata workers, in path-sorted batches, timing it.
+
+    Args:
+        source_root (str): The directory copied from.
+        dest_root (str): The directory copied into.
+        deferred (MetadataQueue): Entries whose data is written.
+        stats (CopyStats): The counters of the copy, the seconds taken are added to its metadata phase.
+
+    Returns:
+        None
+    """
+    start = time.perf_counter()
+    deferred.apply_all(source_root, dest_root, max(1, RambootConfig.get_copy_workers()),
+                       lambda source, e: report_metadata_error(source, e, stats))
+    stats.metadata_seconds += time.perf_counter() - start
+
+
+def report_metadata_error(source: str, e: OSError, stats: CopyStats) -> None:
+    """
+    Log and count an entry whose metadata could not be applied.
+
+    Args:
+        source (str): The source path of the entry.
+        e (OSError): The error.
+        stats (CopyStats): The counters of the copy.
+
+    Returns:
+        None
+    """
+    logger.warning("Failed to set metadata on %s: %s", source, e)
+    stats.add_error()
+
+
+def finish_tree(source_root: str, dest_root: str, dirs: PendingDirectories, links: HardlinkTable, stats: CopyStats,
+                started: float, deferred: MetadataQueue | None = None) -> None:
+    """
+    Link the other names of hardlinked files and apply the deferred metadata, once the data of a tree is copied.
+
+    File metadata still queued is applied by a pool of metadata workers in path-sorted batches, then the metadata of
+    the directories still pending, children first, since writing into a directory changes its timestamps.  The
+    seconds of both phases are recorded in the counters.
+
+    Args:
+        source_root (str): The directory copied from.
+        dest_root (str): The directory copied into.
+        dirs (PendingDirectories): The directories whose metadata is not applied yet.
+        links (HardlinkTable): The names of hardlinked files waiting to be linked.
+        stats (CopyStats): The counters of the copy.
+        started (float): When the copy started, from time.perf_counter.
+        deferred (MetadataQueue | None): The entries whose metadata was deferred, if any.
+
+    Returns:
+        None
+    """
+    for first_link, rel_path in links.get_links():
+        try:
+            remove_path(os.path.join(dest_root, rel_path))
+            os.link(os.path.join(dest_root, first_link), os.path.join(dest_root, rel_path))
+            stats.add(0)
+        except OSError as e:
+            logger.warning("Failed to link %s: %s", os.path.join(source_root, rel_path), e)
+            stats.add_error()
+
+    # Metadata applied while copying counts towards its own phase
+    stats.data_seconds = time.perf_counter() - started - stats.metadata_seconds
+
+    with Tracer.span("metadata", "copy", source=source_root,
+                     entries=len(dirs) + (len(deferred) if deferred is not None else 0)):
+        if deferred is not None:
+            apply_deferred(source_root, dest_root, deferred, stats)
+
+        start = time.perf_counter()
+        dirs.finish()
+        stats.metadata_seconds += time.perf_counter() - start
+    logger.debug("%s: copied data in %.2fs, applied metadata in %.2fs, %d hardlinks tracked in %d KB", source_root,
+                 stats.data_seconds, stats.metadata_seconds, len(links), links.get_bytes() // 1024)
+
+
+def copy_tree(source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None = None,
+              keep_existing: bool = False, inode_order: bool = False) -> CopyStats:
+    """
+    Copy a directory tree, staying on one filesystem and preserving metadata and hardlinks, like `cp --archive`.
+
+    The tree is walked with a pool of scanners, directories are created as they are found and everything else is
+    copied by a pool of copy workers.  With deferred metadata, the workers only write data and the metadata of the
+    entries they wrote is applied in batches, whenever enough is queued and once they are done, see finish_tree.
+    The metadata of a directory is applied as soon as everything inside it is written, and only the names of
+    hardlinked files are remembered, so memory stays bound by the depth of the tree and the number of workers.  With
+    adaptive copy workers, how many workers copy at once follows the measured throughput.  In inode order, files are
+    only copied once the whole tree has been scanned, which takes memory for every file.
+
+    Args:
+        source_root (str): The directory to copy from.
+        dest_root (str): The directory to copy into.
+        exclude (Callable[[str, bool], bool] | None): Called with a relative path and whether it is a directory,
+            returning True if it should not be copied.  Excluded directories are created empty.
+        keep_existing (bool): Whether to leave files already at the destination alone, like `cp --no-clobber`.
+        inode_order (bool): Whether to copy files sorted by inode number instead of in scan order.
+
+    Returns:
+        CopyStats: The counters of the copy.
+    """
+    started = time.perf_counter()
+    stats = CopyStats()
+    workers = max(1, RambootConfig.get_copy_workers())
+    deferred = MetadataQueue() if RambootConfig.get_copy_defer_metadata() else None
+
+    # When adapting, the pool holds the most workers allowed and the controller limits how many copy at once
+    controller = AdaptiveWorkers.controller(dest_root, stats) if AdaptiveWorkers.is_enabled() else None
+    if controller is not None:
+        workers = controller.max_workers
+    limit = controller.limit if controller is not None else nullcontext()
+
+    # Bound the number of queued copies so memory does not grow with the size of the tree
+    slots = threading.BoundedSemaphore(workers * 64)
+
+    dirs = PendingDirectories(source_root, dest_root, lambda source, e: report_metadata_error(source, e, stats))
+    dirs.add("", os.lstat(source_root))
+    links = HardlinkTable()
+    pending: List[Tuple[str, os.stat_result]] = []
+
+    # When tracing, each copy worker is shown as one span from its first to its last file
+    traced = Tracer.is_enabled()
+    worker_spans: Dict[int, List] = {}
+
+    def copy_one(rel_path: str, entry_stat: os.stat_result) -> None:
+        start = time.perf_counter_ns() if traced else 0
+
+        try:
+            if keep_existing and os.path.lexists(os.path.join(dest_root, rel_path)):
+                return
+
+            with limit:
+                copied = copy_entry(os.path.join(source_root, rel_path), os.path.join(dest_root, rel_path),
+                                    entry_stat, metadata=deferred is None)
+            stats.add(copied)
+
+            if deferred is not None:
+                deferred.add(rel_path, entry_stat)
+
+            if traced:
+                worker = worker_spans.setdefault(threading.get_ident(), [threading.current_thread(), start, 0, 0, 0])
+                worker[2:] = [time.perf_counter_ns(), worker[3] + 1, worker[4] + copied]
+        except OSError as e:
+            logger.warning("Failed to copy %s: %s", os.path.join(source_root, rel_path), e)
+            stats.add_error()
+        finally:
+            dirs.release(rel_path)
+            slots.release()
+
+    def flush_metadata() -> None:
+        # Everything queued has its data written, so its metadata can be applied while other files are copied
+        if deferred is not None and len(deferred) >= METADATA_QUEUE_LIMIT:
+            apply_deferred(source_root, dest_root, deferred.take(), stats)
+
+    os.makedirs(dest_root, exist_ok=True)
+
+    with controller or nullcontext(), \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="copy") as executor:
+        for rel_path, entry_stat in parallel_scan(source_root, RambootConfig.get_scan_workers(), exclude=exclude,
+                                                  on_scanned=dirs.scanned):
+            # Directories always arrive before their contents
+            if stat.S_ISDIR(entry_stat.st_mode):
+                os.makedirs(os.path.join(dest_root, rel_path), exist_ok=True)
+                dirs.add(rel_path, entry_stat)
+                continue
+
+            # The parent waits until the entry is written, or for good if it is linked once everything is copied
+            dirs.hold(rel_path)
+
+            # Copy the first name of each hardlinked file, link the rest once everything is copied
+            if entry_stat.st_nlink > 1 and not links.add(rel_path, entry_stat):
+                continue
+
+            if inode_order:
+                pending.append((rel_path, entry_stat))
+                continue
+
+            slots.acquire()
+            executor.submit(copy_one, rel_path, entry_stat)
+            flush_metadata()
+
+        # Inode numbers roughly follow the on-disk layout of most filesystems, reading in their order cuts seeks
+        for rel_path, entry_stat in sorted(pending, key=lambda item: item[1].st_ino):
+            slots.acquire()
+            executor.submit(copy_one, rel_path, entry_stat)
+            flush_metadata()
+
+    for thread, start, end, files, copied_bytes in worker_spans.values():
+        Tracer.add_span("copy worker", "copy", start, end, {"source": source_root, "files": files,
+                                                            "bytes": copied_bytes}, thread)
+
+    finish_tree(source_root, dest_root, dirs, links, stats, started, deferred)
+
+    return stats
@@ -1,10 +1,35 @@
+from __future__ import annotations
+
+import logging
 import os
-import subprocess
-import tempfile
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
 
 from setup.mounts.mount_info import MountInfo, AllMounts
-
-COPY_CMD = ["cp", "--archive", "--one-file-system"]
+from setup.mounts.source_mounts import cleanup_mount, masked_source, mount_source, mounted_source
+from setup.ramdisk.access_profile import AccessProfile
+from setup.ramdisk.adaptive_workers import AdaptiveWorkers
+from setup.ramdisk.block_clone import BlockClone
+from setup.ramdisk.compressed_images import CompressedImages
+from setup.ramdisk.copy_engine import CopyStats
+from setup.ramdisk.copy_progress import CopyProgress
+from setup.ramdisk.copy_strategies import CopyStrategies, get_prebuilt_stats
+from setup.ramdisk.dedup import Deduplicator
+from setup.ramdisk.early_pivot import EarlyPivot
+from setup.ramdisk.exclusions import ExclusionRules
+from setup.ramdisk.keep_on_disk import KeepOnDisk
+from setup.ramdisk.masked_paths import get_masked_paths
+from setup.ramdisk.mkfs_populate import MkfsPopulate
+from setup.ramdisk.write_back import WriteBack
+from setup.ramdisk.file_copy import apply_metadata, copy_entry, remove_path
+from setup.ramdisk.image_cache import ImageCache, ManifestEntry, entry_bytes, manifest_entry
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+from utils.trace import Tracer
+
+logger = logging.getLogger(__name__)
 
 
 def create_copy_point(mount: MountInfo, ramdisk_base: str) -> str:
@@ -27,127 +52,439 @@ def create_copy_point(mount: MountInfo, ramdisk_base: str) -> str:
     return ramdisk_copy_point
 
 
-def mount_source(mount: MountInfo) -> str:
+def copy_from_source(temp_mount_point: str, ramdisk_copy_point: str,
+                     exclude: Callable[[str, bool], bool] | None = None, keep_existing: bool = False,
+                     strategy: str | None = None) -> CopyStats:
     """
-    Mount the source filesystem to a temporary directory for copying.
+    Copy the contents of the source mount point to the RAM disk.
 
-    This function mounts the source filesystem to a temporary mount point, handling
-    special cases for `btrfs` and `zfs` filesystems.
+    This function copies the contents of the mounted source filesystem to the destination
+    directory on the RAM disk with a copy strategy.  Without one, the configured engine is used,
+    unless exclusion rules apply that it cannot honor.
 
     Args:
-        mount (MountInfo): The mount point information that needs to be mounted temporarily.
+        temp_mount_point (str): The path to the temporary mount point.
+        ramdisk_copy_point (str): The path to the destination directory on the RAM disk.
+        exclude (Callable[[str, bool], bool] | None): Called with a relative path and whether it is a directory,
+            returning True if it should not be copied.
+        keep_existing (bool): Whether to leave files already on the RAM disk alone, such as the boot-critical set.
+        strategy (str | None): The name of the copy strategy, as picked by CopyStrategies.select.
 
     Returns:
-        str: The path to the temporary mount point.
+        CopyStats: The counters of the copy.  For `cp` they are estimated from the blocks and inodes the RAM disk
+            filesystem gained.
     """
-    # Create Source Mount Point
-    temp_mount_point = tempfile.mkdtemp()
+    copy_strategy = CopyStrategies.get(strategy or CopyStrategies.get_default(exclude))
 
-    # If we have a btrfs, we need to handle subvols
-    if mount.fstype == "btrfs":
-        subprocess.run(["mount", "--options", ",".join(mount.fsopts), mount.source, temp_mount_point])
+    with Tracer.span(copy_strategy.name, "copy", source=temp_mount_point) as span, \
+            CopyProgress(ramdisk_copy_point, temp_mount_point, ramdisk_copy_point, exclude):
+        stats = copy_strategy.copy(temp_mount_point, ramdisk_copy_point, exclude, keep_existing)
+        span.update(files=stats.files_copied, bytes=stats.bytes_copied, errors=stats.errors,
+                    data_seconds=round(stats.data_seconds, 3), metadata_seconds=round(stats.metadata_seconds, 3))
 
-    # If we have a zfs, we need to handle volumes via zfsutil
-    elif mount.fstype == "zfs":
-        subprocess.run(["mount", "--types", "zfs", "--options", "zfsutil", mount.source, temp_mount_point])
+    return stats
 
-    # Otherwise, mount normally
-    else:
-        subprocess.run(["mount", mount.source, temp_mount_point])
 
-    return temp_mount_point
+def record_manifest(mount: MountInfo, source_root: str, exclude: Callable[[str, bool], bool] | None = None) -> None:
+    """
+    Scan a source and record its entries for the image cache manifest.
 
+    Args:
+        mount (MountInfo): The mount being copied.
+        source_root (str): The root of the (masked) source being copied.
+        exclude (Callable[[str, bool], bool] | None): The exclude callback used for the copy.
 
-def copy_from_source(temp_mount_point: str, ramdisk_copy_point: str) -> None:
+    Returns:
+        None
     """
-    Copy the contents of the source mount point to the RAM disk.
+    if not ImageCache.is_enabled():
+        return
 
-    This function copies the contents of the mounted source filesystem to the destination
-    directory on the RAM disk. It ensures that the copying process behaves as expected
-    by appending `/.` to the source path.
+    scan = parallel_scan(source_root, RambootConfig.get_scan_workers(), exclude=exclude)
+    ImageCache.record(mount, {rel_path: manifest_entry(entry_stat) for rel_path, entry_stat in scan})
+
+
+def is_prebuilt(mount: MountInfo) -> bool:
+    """
+    Check if the partition of a mount was cloned or built populated, leaving nothing to copy.
 
     Args:
-        temp_mount_point (str): The path to the temporary mount point.
-        ramdisk_copy_point (str): The path to the destination directory on the RAM disk.
+        mount (MountInfo): The mount to check.
 
     Returns:
-        None
+        bool: True if the partition already holds the mount, False otherwise.
     """
-    # cp behaves weirdly when you copy to an existing directory, adding /. to the end gives us the behavior we want
-    copy_temp_mount_point = f"{temp_mount_point}{os.path.sep}."
-    subprocess.run(COPY_CMD + [copy_temp_mount_point, ramdisk_copy_point])
+    return BlockClone.is_cloned(mount.dest) or MkfsPopulate.is_populated(mount.dest)
 
 
-def cleanup_mount(temp_mount_point: str) -> None:
+def count_prebuilt_mount(mount: MountInfo, ramdisk_copy_point: str, masked_paths: List[str] = (),
+                         exclude: Callable[[str, bool], bool] | None = None) -> CopyStats:
     """
-    Unmount and clean up the temporary mount point.
+    Record the strategy of a prebuilt mount and count what its partition holds, without copying anything.
 
-    This function unmounts the source filesystem from the temporary mount point and
-    then removes the temporary directory.
+    The source is only read to record the image cache manifest.
 
     Args:
-        temp_mount_point (str): The path to the temporary mount point.
+        mount (MountInfo): The prebuilt mount.
+        ramdisk_copy_point (str): Where its partition is mounted on the RAM disk.
+        masked_paths (List[str]): Directories, relative to the mount, whose contents were not copied.
+        exclude (Callable[[str, bool], bool] | None): The exclude callback of the mount.
 
     Returns:
-        None
+        CopyStats: The bytes and inodes in use on the partition.
     """
-    # Unmount Source
-    subprocess.run(["umount", "--force", temp_mount_point])
+    CopyStrategies.select(mount, ramdisk_copy_point, exclude)
+
+    if ImageCache.is_enabled():
+        with mounted_source(mount) as source_root, masked_source(source_root, list(masked_paths)) as source_view:
+            record_manifest(mount, source_view, exclude)
 
-    # Cleanup Source
-    os.rmdir(temp_mount_point)
+    return get_prebuilt_stats(ramdisk_copy_point)
 
 
-def copy_mount(mount: MountInfo, ramdisk_base: str) -> None:
+def copy_mount(mount: MountInfo, ramdisk_base: str, masked_paths: List[str] = (),
+               keep_existing: bool = False) -> CopyStats:
     """
     Copy the contents of a specific mount point to the RAM disk.
 
     This function manages the entire process of copying a mount point to the RAM disk.
     It creates the destination directory, mounts the source, copies the contents,
-    and then cleans up the temporary resources.
+    and then cleans up the temporary resources.  Cloned and populated partitions already
+    hold the mount and are only counted, see count_prebuilt_mount.
 
     Args:
         mount (MountInfo): The mount point information to be copied.
         ramdisk_base (str): The base directory on the RAM disk.
+        masked_paths (List[str]): Directories, relative to the mount, whose contents should not be copied.
+        keep_existing (bool): Whether to leave files already on the RAM disk alone, such as the boot-critical set.
 
     Returns:
-        None
+        CopyStats: The counters of the copy.
     """
     # Make sure ramdisk destination exists
     ramdisk_copy_point = create_copy_point(mount, ramdisk_base)
+    exclude = ExclusionRules.get_exclude(mount)
+
+    if is_prebuilt(mount):
+        return count_prebuilt_mount(mount, ramdisk_copy_point, masked_paths, exclude)
 
     # Mount source to temporary mount point
     temp_mount_point = mount_source(mount)
 
-    # Copy from temp mount to ramdisk point
-    copy_from_source(temp_mount_point, ramdisk_copy_point)
+    with masked_source(temp_mount_point, list(masked_paths)) as source_view:
+        # Copy from temp mount to ramdisk point
+        strategy = CopyStrategies.select(mount, source_view, exclude)
+        stats = copy_from_source(source_view, ramdisk_copy_point, exclude, keep_existing, strategy)
+
+        # Remember what was copied for the next image
+        record_manifest(mount, source_view, exclude)
 
     # Unmount and remove temporary mount point
     cleanup_mount(temp_mount_point)
 
+    return stats
+
 
-def copy_root_mount(ramdisk_base: str) -> None:
+def copy_root_mount(ramdisk_base: str, root_mount: MountInfo | None = None, masked_paths: List[str] = (),
+                    keep_existing: bool = False) -> CopyStats:
     """
     Copy the root filesystem to the RAM disk.
 
-    This function copies the contents of the root filesystem (`/`) to the RAM disk.
-    It uses the `cp` command to perform an archive copy, ensuring that all files
-    and directories are replicated.
+    This function copies the contents of the root filesystem (`/`) to the RAM disk,
+    ensuring that all files and directories are replicated.
+
+    Args:
+        ramdisk_base (str): The base directory on the RAM disk.
+        root_mount (MountInfo | None): The root mount information, used to record the image cache manifest.
+        masked_paths (List[str]): Directories, relative to `/`, whose contents should not be copied.
+        keep_existing (bool): Whether to leave files already on the RAM disk alone, such as the boot-critical set.
+
+    Returns:
+        CopyStats: The counters of the copy.
+    """
+    exclude = ExclusionRules.get_exclude(root_mount) if root_mount is not None else None
+
+    if root_mount is not None and is_prebuilt(root_mount):
+        return count_prebuilt_mount(root_mount, ramdisk_base, masked_paths, exclude)
+
+    with masked_source(os.path.sep, list(masked_paths)) as source_view:
+        strategy = CopyStrategies.select(root_mount, source_view, exclude) if root_mount is not None else None
+        stats = copy_from_source(source_view, ramdisk_base, exclude, keep_existing, strategy)
+
+        if root_mount is not None:
+            record_manifest(root_mount, source_view, exclude)
+
+    return stats
+
+
+def diff_source(source_root: str, old_entries: Dict[str, ManifestEntry],
+                exclude: Callable[[str, bool], bool] | None = None) \
+        -> Tuple[Dict[str, ManifestEntry], List[Tuple[str, os.stat_result]], Dict[str, os.stat_result], List[str],
+                 int]:
+    """
+    Compare a live source tree against the manifest entries of the restored image.
+
+    Entries are compared on type, size, mtime, ctime and inode.  Entries still present are removed from
+    `old_entries`, so whatever remains afterwards has been deleted from the source.  Directories that changed in
+    place only need their metadata fixed, and chown moves the ctime, so owner changes are caught as well.
+
+    Args:
+        source_root (str): The root of the source being restored.
+        old_entries (Dict[str, ManifestEntry]): The manifest entries from the restored image, consumed in place.
+        exclude (Callable[[str, bool], bool] | None): The exclude callback used for the copy.
+
+    Returns:
+        Tuple: The new manifest entries, the added or changed entries, the stat of every directory, the
+            directories whose metadata changed in place and the bytes already present in the restored image.
+    """
+    new_entries = {}
+    changed = []
+    stale_dirs = []
+    dir_stats = {"": os.lstat(source_root)}
+    unchanged_bytes = 0
+
+    for rel_path, entry_stat in parallel_scan(source_root, RambootConfig.get_scan_workers(), exclude=exclude):
+        entry = manifest_entry(entry_stat)
+        new_entries[rel_path] = entry
+        old_entry = old_entries.pop(rel_path, None)
+
+        if stat.S_ISDIR(entry_stat.st_mode):
+            dir_stats[rel_path] = entry_stat
+
+        if old_entry == entry:
+            unchanged_bytes += entry_bytes(entry)
+        elif old_entry is not None and stat.S_ISDIR(old_entry[0]) and stat.S_ISDIR(entry_stat.st_mode):
+            # Directory contents are handled entry by entry, only the metadata needs fixing
+            stale_dirs.append(rel_path)
+        else:
+            changed.append((rel_path, entry_stat))
+
+    return new_entries, changed, dir_stats, stale_dirs, unchanged_bytes
+
+
+def delta_copy(source_root: str, ramdisk_copy_point: str, changed: List[Tuple[str, os.stat_result]],
+               deleted: List[str], dir_stats: Dict[str, os.stat_result], stale_dirs: List[str] = ()) -> int:
+    """
+    Bring a restored ramdisk copy up to date with its source.
+
+    Deletions are applied first, then directories are created parents first, files are copied in parallel and
+    finally directory metadata is reapplied children first.
+
+    Args:
+        source_root (str): The root of the source being restored.
+        ramdisk_copy_point (str): The matching directory on the RAM disk.
+        changed (List[Tuple[str, os.stat_result]]): The added or changed entries.
+        deleted (List[str]): The entries no longer present in the source.
+        dir_stats (Dict[str, os.stat_result]): The stat of every directory in the source.
+        stale_dirs (List[str]): Directories present on both sides whose mode, owner or timestamps changed.
+
+    Returns:
+        int: The number of bytes copied from the source.
+    """
+    # Children sort after their parents, so reverse order removes children first
+    for rel_path in sorted(deleted, reverse=True):
+        remove_path(os.path.join(ramdisk_copy_point, rel_path))
+
+    dirs = sorted(rel_path for rel_path, entry_stat in changed if stat.S_ISDIR(entry_stat.st_mode))
+    for rel_path in dirs:
+        copy_entry(os.path.join(source_root, rel_path), os.path.join(ramdisk_copy_point, rel_path),
+                   dir_stats[rel_path])
+
+    # Copy the first name of each hardlinked file, link the rest once it exists
+    files = []
+    links = []
+    first_names: Dict[Tuple[int, int], str] = {}
+    for rel_path, entry_stat in changed:
+        if stat.S_ISDIR(entry_stat.st_mode):
+            continue
+
+        if stat.S_ISREG(entry_stat.st_mode) and entry_stat.st_nlink > 1:
+            key = (entry_stat.st_dev, entry_stat.st_ino)
+
+            if key in first_names:
+                links.append((first_names[key], rel_path))
+                continue
+
+            first_names[key] = rel_path
+
+        files.append((rel_path, entry_stat))
+
+    with ThreadPoolExecutor(max_workers=RambootConfig.get_copy_workers()) as executor:
+        copied = sum(executor.map(
+            lambda item: copy_entry(os.path.join(source_root, item[0]), os.path.join(ramdisk_copy_point, item[0]),
+                                    item[1]),
+            files))
+
+    for first_name, rel_path in links:
+        dest = os.path.join(ramdisk_copy_point, rel_path)
+        remove_path(dest)
+        os.link(os.path.join(ramdisk_copy_point, first_name), dest)
+
+    # Writing into a directory changes its timestamps, so fix up every directory that was touched
+    touched = set(dirs).union(stale_dirs)
+    for rel_path in [rel_path for rel_path, _ in changed] + deleted:
+        parent = os.path.dirname(rel_path)
+        touched.add(parent)
+
+    for rel_path in sorted(touched, reverse=True):
+        if rel_path in dir_stats:
+            apply_metadata(os.path.join(ramdisk_copy_point, rel_path), dir_stats[rel_path],
+                           os.path.join(source_root, rel_path))
+
+    return copied
+
+
+def delta_copy_mount(mount: MountInfo, ramdisk_base: str, masked_paths: List[str] = ()) -> Tuple[int, int]:
+    """
+    Update a mount restored from the cached image with the changes made on its source since the image was taken.
+
+    Args:
+        mount (MountInfo): The mount point information to be updated.
+        ramdisk_base (str): The base directory on the RAM disk.
+        masked_paths (List[str]): Directories, relative to the mount, whose contents should not be copied.
+
+    Returns:
+        Tuple[int, int]: The bytes restored from the image and the bytes copied from the source.
+    """
+    ramdisk_copy_point = create_copy_point(mount, ramdisk_base)
+
+    with mounted_source(mount) as source_root, masked_source(source_root, list(masked_paths)) as source_view:
+        old_entries = dict(ImageCache.get_restored_entries(mount))
+        new_entries, changed, dir_stats, stale_dirs, restored_bytes = diff_source(source_view, old_entries,
+                                                                                  ExclusionRules.get_exclude(mount))
+        deleted = list(old_entries)
+
+        copied_bytes = delta_copy(source_view, ramdisk_copy_point, changed, deleted, dir_stats, stale_dirs)
+        ImageCache.record(mount, new_entries)
+
+    logger.info("%s: %d entries added or changed, %d deleted", mount.dest, len(changed), len(deleted))
+
+    return restored_bytes, copied_bytes
+
+
+def build_compressed_images(all_mounts: AllMounts, ramdisk_base: str) -> None:
+    """
+    Pack the configured subtrees of every mount into compressed images on the RAM disk.
+
+    Args:
+        all_mounts (AllMounts): A collection of all mount point information.
+        ramdisk_base (str): The base directory on the RAM disk.
+
+    Returns:
+        None
+    """
+    CompressedImages.prepare(ramdisk_base)
+
+    for mount in all_mounts:
+        if not CompressedImages.get_rel_paths(mount, all_mounts):
+            continue
+
+        with mounted_source(mount) as source_root:
+            CompressedImages.build(mount, all_mounts, source_root, ramdisk_base)
+
+
+def copy_boot_critical(all_mounts: AllMounts, ramdisk_base: str) -> bool:
+    """
+    Copy the files opened during a previous boot ahead of everything else.
+
+    When pivoting early they are copied into the overlay upper directories, to be served from the ramdisk right away.
+
+    Args:
+        all_mounts (AllMounts): A collection of all mount point information.
+        ramdisk_base (str): The base directory on the RAM disk.
+
+    Returns:
+        bool: True if a boot-critical set was copied, False if there is no access profile.
+    """
+    if not AccessProfile.has_profile(all_mounts):
+        return False
+
+    for mount in all_mounts:
+        if CompressedImages.is_fully_packed(mount, all_mounts) or KeepOnDisk.is_whole_mount(mount, all_mounts):
+            continue
+
+        # Cloned and populated mounts are already complete
+        if is_prebuilt(mount) or not AccessProfile.get_rel_paths(mount, all_mounts):
+            continue
+
+        ramdisk_copy_point = create_copy_point(mount, ramdisk_base)
+        if EarlyPivot.is_enabled():
+            ramdisk_copy_point = EarlyPivot.get_upper_dir(ramdisk_copy_point)
+
+        with mounted_source(mount) as source_root:
+            AccessProfile.copy_critical(mount, all_mounts, source_root, ramdisk_copy_point,
+                                        get_masked_paths(mount, all_mounts), ExclusionRules.get_exclude(mount))
+
+    AccessProfile.log_critical_complete()
+    return True
+
+
+def get_nested_paths(mount: MountInfo, all_mounts: AllMounts) -> List[str]:
+    """
+    Get the mount points of other mounts below a mount, relative to it.
 
     Args:
+        mount (MountInfo): The mount to check.
+        all_mounts (AllMounts): A collection of all mount point information.
+
+    Returns:
+        List[str]: The nested mount points relative to the mount root.
+    """
+    return [os.path.relpath(other.dest, mount.dest) for other in all_mounts
+            if other.dest != mount.dest and os.path.commonpath([other.dest, mount.dest]) == mount.dest]
+
+
+def prepare_early_pivot(all_mounts: AllMounts, ramdisk_base: str) -> None:
+    """
+    Copy only the boot-critical set and serve everything else from the source filesystems until it is copied.
+
+    Compressed images and subtrees kept on disk are mounted on top of the overlays as usual.  Deduplication and the
+    image cache are skipped, the ramdisk is not complete until the background copy is.
+
+    Args:
+        all_mounts (AllMounts): A collection of all mount point information.
         ramdisk_base (str): The base directory on the RAM disk.
 
     Returns:
         None
     """
-    subprocess.run(COPY_CMD + ["/.", ramdisk_base])
+    with Tracer.span("copy_boot_critical", "phase"):
+        copied_critical = copy_boot_critical(all_mounts, ramdisk_base)
+
+    if not copied_critical:
+        logger.warning("No access profile, everything is read from disk until the background copy reaches it")
+
+    pending_mounts = [mount for mount in all_mounts
+                      if not CompressedImages.is_fully_packed(mount, all_mounts)
+                      and not KeepOnDisk.is_whole_mount(mount, all_mounts)]
+
+    EarlyPivot.mount_all(pending_mounts, {mount.dest: get_masked_paths(mount, all_mounts) for mount in pending_mounts},
+                         ramdisk_base)
+
+    # Built once the overlays are in place, which would otherwise hide the images
+    build_compressed_images(all_mounts, ramdisk_base)
+
+    for mount in all_mounts:
+        if mount not in pending_mounts:
+            create_copy_point(mount, ramdisk_base)
+
+    ExclusionRules.log_summary()
+    CompressedImages.mount_all(ramdisk_base)
+    KeepOnDisk.mount_all(all_mounts, ramdisk_base)
+    WriteBack.mount_all(all_mounts, ramdisk_base)
 
 
 def copy_all_mounts(all_mounts: AllMounts, ramdisk_base: str) -> None:
     """
     Copy all mounted filesystems to the RAM disk.
 
-    This function iterates through all the mount points and copies each one to the RAM disk.
+    This function iterates through all the mount points and copies each one to the RAM disk.  If the RAM disk was
+    restored from the cached image, only the changes since the image was taken are copied.  Otherwise the
+    boot-critical set from the access profile is copied first, then everything else, and the image cache is
+    refreshed.  Copied mounts are deduplicated in the background while the next one is copied.  Subtrees packed into
+    compressed images, subtrees kept on disk and the sources of written back paths are mounted once everything else
+    is in place.  When pivoting early, only the boot-critical set is copied and the rest is left to the background
+    copy.
 
     Args:
         all_mounts (AllMounts): A collection of all mount point information.
@@ -156,9 +493,80 @@ def copy_all_mounts(all_mounts: AllMounts, ramdisk_base: str) -> None:
     Returns:
         None
     """
+    # Start each copy from the number of workers learned on the previous boot
+    AdaptiveWorkers.set_mounts(all_mounts)
+
+    if EarlyPivot.is_enabled():
+        prepare_early_pivot(all_mounts, ramdisk_base)
+        return
+
+    with Tracer.span("build_compressed_images", "phase"):
+        build_compressed_images(all_mounts, ramdisk_base)
+
+    start = time.monotonic()
+
+    # A restored image already holds the boot-critical set
+    with Tracer.span("copy_boot_critical", "phase"):
+        copied_critical = not ImageCache.is_restored() and copy_boot_critical(all_mounts, ramdisk_base)
+
+    deduplicator = Deduplicator(ramdisk_base) if RambootConfig.get_dedup_enabled() else None
+    restored_bytes = 0
+    copied_bytes = 0
+
     for mount in all_mounts:
-        # Root is a special case
-        if mount.dest == "/":
-            copy_root_mount(ramdisk_base)
+        # Packed and kept mounts only need an empty directory to mount onto
+        if CompressedImages.is_fully_packed(mount, all_mounts) or KeepOnDisk.is_whole_mount(mount, all_mounts):
+            create_copy_point(mount, ramdisk_base)
+            continue
+
+        with Tracer.span(mount.dest, "mount", source=mount.source, fstype=mount.fstype) as span:
+            # Only copy what changed since the cached image was taken
+            if ImageCache.is_restored():
+                restored, copied = delta_copy_mount(mount, ramdisk_base, get_masked_paths(mount, all_mounts))
+                restored_bytes += restored
+                copied_bytes += copied
+                span.update(restored_bytes=restored, bytes=copied)
+
+            # Root is a special case
+            elif mount.dest == "/":
+                stats = copy_root_mount(ramdisk_base, mount, get_masked_paths(mount, all_mounts), copied_critical)
+                span.update(files=stats.files_copied, bytes=stats.bytes_copied,
+                            data_seconds=round(stats.data_seconds, 3),
+                            metadata_seconds=round(stats.metadata_seconds, 3))
+            else:
+                stats = copy_mount(mount, ramdisk_base, get_masked_paths(mount, all_mounts), copied_critical)
+                span.update(files=stats.files_copied, bytes=stats.bytes_copied,
+                            data_seconds=round(stats.data_seconds, 3),
+                            metadata_seconds=round(stats.metadata_seconds, 3))
+
+            choice = CopyStrategies.get_choice(mount.dest)
+            if choice is not None:
+                strategy, reason = choice
+                span.update(strategy=strategy, reason=reason)
+
+        if deduplicator is not None:
+            deduplicator.add_tree(create_copy_point(mount, ramdisk_base), get_nested_paths(mount, all_mounts))
+
+    if deduplicator is not None:
+        with Tracer.span("dedup", "phase"):
+            deduplicator.finish()
+
+    logger.info("Full copy complete in %.1fs", time.monotonic() - start)
+    ExclusionRules.log_summary()
+    AdaptiveWorkers.save()
+
+    with Tracer.span("save_image_cache", "phase"):
+        if not ImageCache.is_restored():
+            ImageCache.save()
         else:
-            copy_mount(mount, ramdisk_base)
+            logger.info("Restored %d bytes from the cached image, copied %d bytes from the source",
+                        restored_bytes, copied_bytes)
+
+            # Refresh the image once the delta gets too large to be worth replaying every boot
+            if copied_bytes > restored_bytes * RambootConfig.get_image_cache_refresh_ratio():
+                ImageCache.save()
+
+    with Tracer.span("mount_overlays", "phase"):
+        CompressedImages.mount_all(ramdisk_base)
+        KeepOnDisk.mount_all(all_mounts, ramdisk_base)
+        WriteBack.mount_all(all_mounts, ramdisk_base)
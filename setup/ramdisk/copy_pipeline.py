@@ -0,0 +1,457 @@
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import stat
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+from setup.ramdisk.copy_engine import CopyStats, finish_tree, report_metadata_error
+from setup.ramdisk.file_copy import copy_entry, remove_path
+from setup.ramdisk.hardlink_table import HardlinkTable
+from setup.ramdisk.metadata_queue import PendingDirectories
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+
+logger = logging.getLogger(__name__)
+
+# A batch is handed to a reader once it holds this many bytes or entries
+BATCH_BYTES = 4 * 1024 ** 2
+BATCH_ENTRIES = 256
+
+# Files larger than this are not buffered, a writer copies them straight from the source
+LARGE_FILE_BYTES = 1024 ** 2
+
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+class ByteBudget:
+    """
+    Limits the bytes held in buffers at once.
+
+    A request larger than the whole budget is let through once nothing else is held, so it cannot wait forever.
+    """
+
+    def __init__(self, limit: int):
+        """
+        Initialize the budget with nothing held.
+
+        Args:
+            limit (int): The most bytes held at once.
+        """
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        """
+        Wait until a buffer fits in the budget, and hold it.
+
+        Args:
+            size (int): The size of the buffer in bytes.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            while self.used and self.used + size > self.limit:
+                self._condition.wait()
+
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size: int) -> None:
+        """
+        Give a buffer back to the budget.
+
+        Args:
+            size (int): The size of the buffer in bytes.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class Record:
+    """
+    An entry read from the source, whose file contents, if any, are packed in the buffer of its batch.
+
+    Attributes:
+        rel_path (str): The path of the entry relative to the root.
+        stat (os.stat_result): The lstat result of the entry.
+        offset (int): Where the contents start in the buffer.
+        length (int | None): The length of the contents, None if a writer has to copy the entry from the source.
+        xattrs (List[Tuple[str, bytes]]): The extended attributes of a buffered file.
+    """
+
+    __slots__ = ("rel_path", "stat", "offset", "length", "xattrs")
+
+    def __init__(self, rel_path: str, entry_stat: os.stat_result):
+        """
+        Initialize a record that is copied from the source until its contents are read.
+
+        Args:
+            rel_path (str): The path of the entry relative to the root.
+            entry_stat (os.stat_result): The lstat result of the entry.
+        """
+        self.rel_path = rel_path
+        self.stat = entry_stat
+        self.offset = 0
+        self.length = None
+        self.xattrs: List[Tuple[str, bytes]] = []
+
+
+class Batch:
+    """
+    Entries read from the source together, with the contents of their files packed into one buffer, like a stretch
+    of a tar stream.
+
+    Attributes:
+        records (List[Record]): The entries, in scan order.
+        buffer (bytearray): The contents of the buffered files.
+    """
+
+    __slots__ = ("records", "buffer")
+
+    def __init__(self, records: List[Record], size: int):
+        """
+        Initialize a batch with an empty buffer.
+
+        Args:
+            records (List[Record]): The entries.
+            size (int): The size of the buffer in bytes.
+        """
+        self.records = records
+        self.buffer = bytearray(size)
+
+
+def is_buffered(entry_stat: os.stat_result, batch_bytes: int) -> bool:
+    """
+    Check if the contents of an entry are read into a batch buffer.
+
+    Args:
+        entry_stat (os.stat_result): The lstat result of the entry.
+        batch_bytes (int): The size batches are cut at.
+
+    Returns:
+        bool: True for regular files small enough to buffer, False otherwise.
+    """
+    return stat.S_ISREG(entry_stat.st_mode) and entry_stat.st_size <= min(LARGE_FILE_BYTES, batch_bytes)
+
+
+def read_xattrs(fd: int) -> List[Tuple[str, bytes]]:
+    """
+    Read the extended attributes of an open file.
+
+    Args:
+        fd (int): The file descriptor.
+
+    Returns:
+        List[Tuple[str, bytes]]: The names and values of the attributes.
+    """
+    try:
+        return [(name, os.getxattr(fd, name)) for name in os.listxattr(fd)]
+    except OSError:
+        return []
+
+
+def read_batch(source_root: str, entries: List[Tuple[str, os.stat_result]], batch_bytes: int) -> Batch:
+    """
+    Read the contents of the small files of a batch into its buffer.
+
+    Files that changed size since they were scanned are left for a writer to copy from the source.
+
+    Args:
+        source_root (str): The directory to copy from.
+        entries (List[Tuple[str, os.stat_result]]): The entries of the batch.
+        batch_bytes (int): The size batches are cut at.
+
+    Returns:
+        Batch: The batch.
+    """
+    records = [Record(rel_path, entry_stat) for rel_path, entry_stat in entries]
+    batch = Batch(records, sum(record.stat.st_size for record in records if is_buffered(record.stat, batch_bytes)))
+    view = memoryview(batch.buffer)
+    offset = 0
+
+    for record in records:
+        if not is_buffered(record.stat, batch_bytes):
+            continue
+
+        size = record.stat.st_size
+
+        try:
+            fd = os.open(os.path.join(source_root, record.rel_path), os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        except OSError:
+            # The writer copies it from the source and reports the error
+            offset += size
+            continue
+
+        try:
+            length = 0
+            while length < size:
+                read = os.readv(fd, [view[offset + length:offset + size]])
+                if not read:
+                    break
+
+                length += read
+
+            if length == size and not os.read(fd, 1):
+                record.offset = offset
+                record.length = length
+                record.xattrs = read_xattrs(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+        offset += size
+
+    return batch
+
+
+def create_file(dest: str) -> int:
+    """
+    Create a file to write, replacing anything already at the destination.
+
+    Args:
+        dest (str): The path of the file.
+
+    Returns:
+        int: The file descriptor, open for writing.
+    """
+    try:
+        return os.open(dest, WRITE_FLAGS, 0o600)
+    except FileExistsError:
+        remove_path(dest)
+        return os.open(dest, WRITE_FLAGS, 0o600)
+
+
+def write_record(dest: str, record: Record, view: memoryview) -> int:
+    """
+    Write a buffered file and its metadata through a single file descriptor.
+
+    Ownership is applied first, since chown clears setuid/setgid bits and file capabilities.
+
+    Args:
+        dest (str): The path to write.
+        record (Record): The file.
+        view (memoryview): The buffer of its batch.
+
+    Returns:
+        int: The number of data bytes written.
+    """
+    fd = create_file(dest)
+
+    try:
+        data = view[record.offset:record.offset + record.length]
+        while data:
+            data = data[os.write(fd, data):]
+
+        os.chown(fd, record.stat.st_uid, record.stat.st_gid)
+
+        for name, value in record.xattrs:
+            try:
+                os.setxattr(fd, name, value)
+            except OSError:
+                # Not every destination filesystem supports every namespace
+                pass
+
+        os.chmod(fd, stat.S_IMODE(record.stat.st_mode))
+        os.utime(fd, ns=(record.stat.st_atime_ns, record.stat.st_mtime_ns))
+    finally:
+        os.close(fd)
+
+    return record.length
+
+
+def copy_tree_pipelined(source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None = None,
+                        keep_existing: bool = False) -> CopyStats:
+    """
+    Copy a directory tree like copy_tree, with the reads and writes of small files split between two thread pools.
+
+    The scan cuts the tree into batches of entries.  Reader threads pack the contents of the small files of each
+    batch into one buffer, and a queue hands full buffers to writer threads, which write them out through one file
+    descriptor per file without touching the source again.  Large files, and files that changed since they were
+    scanned, are copied by the writers straight from the source.  The buffers held at once stay within the
+    configured cap, and the metadata of a directory is applied as soon as everything inside it is written.
+
+    Args:
+        source_root (str): The directory to copy from.
+        dest_root (str): The directory to copy into.
+        exclude (Callable[[str, bool], bool] | None): Called with a relative path and whether it is a directory,
+            returning True if it should not be copied.  Excluded directories are created empty.
+        keep_existing (bool): Whether to leave files already at the destination alone, like `cp --no-clobber`.
+
+    Returns:
+        CopyStats: The counters of the copy.
+
+    Raises:
+        Exception: The first error of a reader or writer that was not about copying a single entry.
+    """
+    started = time.perf_counter()
+    stats = CopyStats()
+    readers = max(1, RambootConfig.get_copy_readers())
+    writers = max(1, RambootConfig.get_copy_workers())
+    budget = ByteBudget(max(1, RambootConfig.get_copy_buffer_mb()) * 1024 ** 2)
+
+    # Small enough for every reader and writer to hold a batch at once
+    batch_bytes = max(1, min(BATCH_BYTES, budget.limit // (readers + writers)))
+
+    # Full buffers waiting for a writer, and batches waiting for a reader
+    write_queue: queue.Queue = queue.Queue(maxsize=writers)
+    slots = threading.BoundedSemaphore(readers * 2)
+
+    dirs = PendingDirectories(source_root, dest_root, lambda source, e: report_metadata_error(source, e, stats))
+    dirs.add("", os.lstat(source_root))
+    links = HardlinkTable()
+
+    # Errors other than failing to copy an entry stop the copy, the first one is raised once every thread is done
+    errors: List[BaseException] = []
+    failed = threading.Event()
+
+    def fail(e: BaseException) -> None:
+        errors.append(e)
+        failed.set()
+
+    def read(entries: List[Tuple[str, os.stat_result]], size: int) -> None:
+        try:
+            if failed.is_set():
+                return
+
+            budget.acquire(size)
+
+            try:
+                try:
+                    batch = read_batch(source_root, entries, batch_bytes)
+                except MemoryError:
+                    # Leave the whole batch for the writers to copy from the source
+                    batch = Batch([Record(rel_path, entry_stat) for rel_path, entry_stat in entries], 0)
+
+                write_queue.put((batch, size))
+            except BaseException:
+                budget.release(size)
+                raise
+        except Exception as e:
+            fail(e)
+        finally:
+            slots.release()
+
+    def write() -> None:
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+
+            batch, size = item
+            view = memoryview(batch.buffer)
+
+            try:
+                for record in batch.records:
+                    # After a failure batches are only drained, so readers never block on a full queue
+                    if failed.is_set():
+                        break
+
+                    source = os.path.join(source_root, record.rel_path)
+                    dest = os.path.join(dest_root, record.rel_path)
+
+                    try:
+                        if keep_existing and os.path.lexists(dest):
+                            continue
+
+                        if record.length is None:
+                            stats.add(copy_entry(source, dest, record.stat))
+                        else:
+                            stats.add(write_record(dest, record, view))
+                    except OSError as e:
+                        logger.warning("Failed to copy %s: %s", source, e)
+                        stats.add_error()
+                    finally:
+                        dirs.release(record.rel_path)
+            except Exception as e:
+                fail(e)
+            finally:
+                view.release()
+                budget.release(size)
+
+    os.makedirs(dest_root, exist_ok=True)
+
+    writer_threads = [threading.Thread(target=write, name=f"copy-writer-{index}", daemon=True)
+                      for index in range(writers)]
+    for thread in writer_threads:
+        thread.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=readers, thread_name_prefix="copy-reader") as executor:
+            # Reads not yet checked, at most one per slot plus those finished since the last check
+            reads: List[Future] = []
+
+            def submit_read(entries: List[Tuple[str, os.stat_result]], size: int) -> None:
+                for future in [future for future in reads if future.done()]:
+                    reads.remove(future)
+                    future.result()
+
+                if failed.is_set():
+                    raise errors[0]
+
+                slots.acquire()
+                reads.append(executor.submit(read, entries, size))
+
+            try:
+                entries: List[Tuple[str, os.stat_result]] = []
+                entries_bytes = 0
+
+                for rel_path, entry_stat in parallel_scan(source_root, RambootConfig.get_scan_workers(),
+                                                          exclude=exclude, on_scanned=dirs.scanned):
+                    # Directories always arrive before their contents
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        os.makedirs(os.path.join(dest_root, rel_path), exist_ok=True)
+                        dirs.add(rel_path, entry_stat)
+                        continue
+
+                    # The parent waits until the entry is written, or for good if it is linked at the end
+                    dirs.hold(rel_path)
+
+                    # Copy the first name of each hardlinked file, link the rest once everything is copied
+                    if entry_stat.st_nlink > 1 and not links.add(rel_path, entry_stat):
+                        continue
+
+                    size = entry_stat.st_size if is_buffered(entry_stat, batch_bytes) else 0
+                    if entries and (len(entries) >= BATCH_ENTRIES or entries_bytes + size > batch_bytes):
+                        submit_read(entries, entries_bytes)
+                        entries = []
+                        entries_bytes = 0
+
+                    entries.append((rel_path, entry_stat))
+                    entries_bytes += size
+
+                if entries:
+                    submit_read(entries, entries_bytes)
+            except BaseException:
+                # Let the readers still queued and the writers skip their work
+                failed.set()
+                raise
+
+        for future in reads:
+            future.result()
+    finally:
+        for _ in writer_threads:
+            write_queue.put(None)
+
+        for thread in writer_threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    logger.debug("%s: buffers peaked at %.1f MB", source_root, budget.peak / 10 ** 6)
+    finish_tree(source_root, dest_root, dirs, links, stats, started)
+
+    return stats
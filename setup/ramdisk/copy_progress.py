@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Tuple
+
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+
+logger = logging.getLogger(__name__)
+
+# Kernel log levels for lines written to /dev/kmsg, both show on the console by default
+KERN_WARNING = 4
+KERN_NOTICE = 5
+
+
+def count_used(source_root: str, exclude: Callable[[str, bool], bool] | None = None) -> Tuple[int, int]:
+    """
+    Estimate the bytes and files a copy of a source will write.
+
+    The statvfs used figure is instant but counts the whole filesystem, including masked and excluded paths.  A scan
+    is exact but has to walk the tree first.
+
+    Args:
+        source_root (str): The root of the source being copied.
+        exclude (Callable[[str, bool], bool] | None): The exclude callback used for the copy.
+
+    Returns:
+        Tuple[int, int]: The bytes and the number of entries to copy.
+    """
+    if RambootConfig.get_progress_count() == "scan":
+        total_bytes = 0
+        total_files = 0
+
+        for _, entry_stat in parallel_scan(source_root, RambootConfig.get_scan_workers(), exclude=exclude):
+            total_bytes += entry_stat.st_blocks * 512
+            total_files += 1
+
+        return total_bytes, total_files
+
+    stats = os.statvfs(source_root)
+    return (stats.f_blocks - stats.f_bfree) * stats.f_frsize, stats.f_files - stats.f_ffree
+
+
+def get_open_files(root: str) -> List[str]:
+    """
+    Find the files below a directory held open by ramboot or its children, such as `cp`.
+
+    Args:
+        root (str): The directory being copied from.
+
+    Returns:
+        List[str]: The open files.
+    """
+    pids = ["self"]
+
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children") as f:
+                pids += f.read().split()
+    except OSError:
+        pass
+
+    open_files = []
+    prefix = root.rstrip(os.path.sep) + os.path.sep
+
+    for pid in pids:
+        try:
+            fds = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+
+        for fd in fds:
+            try:
+                path = os.readlink(f"/proc/{pid}/fd/{fd}")
+            except OSError:
+                continue
+
+            if path.startswith(prefix) and os.path.isfile(path):
+                open_files.append(path)
+
+    return sorted(set(open_files))
+
+
+def format_seconds(seconds: float) -> str:
+    """
+    Format an estimated time left.
+
+    Args:
+        seconds (float): The number of seconds.
+
+    Returns:
+        str: The time as minutes and seconds.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s"
+
+
+class CopyProgress:
+    """
+    Periodically reports how far the copy of a mount has come, so a long copy is not mistaken for a hung machine.
+
+    Progress is measured from the blocks and inodes the destination filesystem gains, which works the same for `cp`
+    and the builtin engine.  When nothing is written for the stall timeout, a warning names the files being copied.
+    """
+
+    def __init__(self, name: str, source_root: str, dest_root: str,
+                 exclude: Callable[[str, bool], bool] | None = None):
+        """
+        Initialize the progress of a copy, counting what there is to copy.
+
+        Args:
+            name (str): The name the copy is reported under, such as its mount point.
+            source_root (str): The root of the source being copied.
+            dest_root (str): The directory being copied into.
+            exclude (Callable[[str, bool], bool] | None): The exclude callback used for the copy.
+        """
+        self.name = name
+        self.source_root = source_root
+        self.dest_root = dest_root
+        self.interval = RambootConfig.get_progress_interval()
+        self.stall_timeout = RambootConfig.get_progress_stall_timeout()
+        self.stop = threading.Event()
+        self.thread: threading.Thread | None = None
+
+        self.total_bytes, self.total_files = count_used(source_root, exclude) if self.interval > 0 else (0, 0)
+
+    def sample(self) -> Tuple[int, int]:
+        """
+        Measure what the destination filesystem holds.
+
+        Returns:
+            Tuple[int, int]: The used bytes and used inodes.
+        """
+        stats = os.statvfs(self.dest_root)
+        return (stats.f_blocks - stats.f_bfree) * stats.f_frsize, stats.f_files - stats.f_ffree
+
+    def write(self, message: str, level: int = KERN_NOTICE) -> None:
+        """
+        Write a progress line to the configured output, falling back to the log.
+
+        Args:
+            message (str): The line to write.
+            level (int): The kernel log level, when writing to /dev/kmsg.
+
+        Returns:
+            None
+        """
+        output = RambootConfig.get_progress_output()
+        prefix = f"<{level}>" if output == "/dev/kmsg" else ""
+
+        try:
+            with open(output, "a") as f:
+                f.write(f"{prefix}ramboot: {message}\n")
+        except OSError:
+            logger.log(logging.WARNING if level <= KERN_WARNING else logging.INFO, message)
+
+    def report(self) -> None:
+        """
+        Report the progress every interval until the copy is done, warning once per stall.
+
+        Returns:
+            None
+        """
+        start = time.monotonic()
+        base_bytes, base_files = self.sample()
+        last_bytes = 0
+        last_change = start
+        stalled = False
+
+        while not self.stop.wait(self.interval):
+            used_bytes, used_files = self.sample()
+            done_bytes = max(0, used_bytes - base_bytes)
+            done_files = max(0, used_files - base_files)
+            now = time.monotonic()
+            elapsed = now - start
+
+            if done_bytes != last_bytes:
+                last_bytes = done_bytes
+                last_change = now
+                stalled = False
+
+            bytes_per_second = done_bytes / elapsed
+            eta = "unknown"
+            if bytes_per_second > 0 and self.total_bytes > done_bytes:
+                eta = format_seconds((self.total_bytes - done_bytes) / bytes_per_second)
+
+            percent = min(100.0, 100.0 * done_bytes / self.total_bytes) if self.total_bytes else 0.0
+            self.write(f"{self.name}: {done_bytes / 2 ** 20:.0f}/{self.total_bytes / 2 ** 20:.0f} MiB "
+                       f"({percent:.0f}%), {done_files}/{self.total_files} files, "
+                       f"{bytes_per_second / 2 ** 20:.1f} MB/s, {done_files / elapsed:.0f} files/s, ETA {eta}")
+
+            if not stalled and self.stall_timeout > 0 and now - last_change >= self.stall_timeout:
+                stalled = True
+                open_files = get_open_files(self.source_root)
+                path = open_files[0] if open_files else self.source_root
+                self.write(f"{self.name}: no progress for {now - last_change:.0f}s, copying {path}", KERN_WARNING)
+
+    def __enter__(self) -> CopyProgress:
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self.report, name="progress", daemon=True)
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
@@ -0,0 +1,434 @@
+from __future__ import annotations
+
+import logging
+import os
+import stat
+import subprocess
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, List, Tuple
+
+from setup.mounts.mount_info import MountInfo
+from setup.ramdisk.block_clone import CLONE_STRATEGY, BlockClone
+from setup.ramdisk.copy_engine import CopyStats, copy_tree
+from setup.ramdisk.copy_pipeline import copy_tree_pipelined
+from setup.ramdisk.mkfs_populate import POPULATE_STRATEGY, MkfsPopulate
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+from utils.shell_commands import DISK_TYPES, get_field_from_key_vals, run_command
+
+logger = logging.getLogger(__name__)
+
+COPY_CMD = ["cp", "--archive", "--one-file-system"]
+
+# Mounts with at least this many files, averaging less than SMALL_FILE_BYTES, are copied in parallel
+MANY_FILES = 10000
+SMALL_FILE_BYTES = 64 * 1024
+
+# btrfs and zfs mounts using less than this share of their space are copied file by file, in parallel
+SPARSE_RATIO = 0.5
+
+# The calibration reads this many small files, half of them with one reader and half with the copy workers
+CALIBRATION_FILES = 400
+CALIBRATION_MAX_BYTES = 256 * 1024
+
+# Parallel reads have to be this much faster in the calibration for the builtin engine to be chosen
+CALIBRATION_SPEEDUP = 1.5
+
+
+class CopyStrategy(ABC):
+    """
+    A way of copying the tree of a mount onto the RAM disk.
+
+    Strategies register under their name with CopyStrategies, so a mount can be copied with any of them by name.
+    Block-level strategies copy while the ramdisk is created, and only apply to the mounts prepared for them.
+    """
+
+    name = ""
+    block_level = False
+
+    def can_copy(self, exclude: Callable[[str, bool], bool] | None) -> bool:
+        """
+        Check if the strategy can copy a source.
+
+        Args:
+            exclude (Callable[[str, bool], bool] | None): The exclude callback of the copy.
+
+        Returns:
+            bool: True if the strategy supports the copy, False otherwise.
+        """
+        return True
+
+    @abstractmethod
+    def copy(self, source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None,
+             keep_existing: bool) -> CopyStats:
+        """
+        Copy a source tree.
+
+        Args:
+            source_root (str): The root of the source being copied.
+            dest_root (str): The directory on the RAM disk to copy into.
+            exclude (Callable[[str, bool], bool] | None): Called with a relative path and whether it is a directory,
+                returning True if it should not be copied.
+            keep_existing (bool): Whether to leave files already on the RAM disk alone.
+
+        Returns:
+            CopyStats: The counters of the copy.
+        """
+
+
+class CpStrategy(CopyStrategy):
+    """
+    Copies with `cp --archive`, a single process that is hard to beat on large files.
+    """
+
+    name = "cp"
+
+    def can_copy(self, exclude: Callable[[str, bool], bool] | None) -> bool:
+        # cp cannot leave paths out
+        return exclude is None
+
+    def copy(self, source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None,
+             keep_existing: bool) -> CopyStats:
+        # cp behaves weirdly when you copy to an existing directory, adding /. to the end gives us the behavior we want
+        no_clobber = ["--no-clobber"] if keep_existing else []
+
+        before = os.statvfs(dest_root)
+        run_command(COPY_CMD + no_clobber + [os.path.join(source_root, "."), dest_root])
+        after = os.statvfs(dest_root)
+
+        # Estimated from the blocks and inodes the RAM disk filesystem gained
+        stats = CopyStats()
+        stats.bytes_copied = max(0, (before.f_bfree - after.f_bfree) * after.f_frsize)
+        stats.files_copied = max(0, before.f_ffree - after.f_ffree)
+        return stats
+
+
+class BuiltinStrategy(CopyStrategy):
+    """
+    Copies with the builtin engine, many files at once, which hides per-file latency on trees of small files.
+    """
+
+    name = "builtin"
+
+    def copy(self, source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None,
+             keep_existing: bool) -> CopyStats:
+        return copy_tree(source_root, dest_root, exclude, keep_existing)
+
+
+class InodeOrderStrategy(CopyStrategy):
+    """
+    Copies with the builtin engine in inode order, which follows the on-disk layout closely enough to cut seeks on
+    rotational disks.
+    """
+
+    name = "inode_order"
+
+    def copy(self, source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None,
+             keep_existing: bool) -> CopyStats:
+        return copy_tree(source_root, dest_root, exclude, keep_existing, inode_order=True)
+
+
+class PipelineStrategy(CopyStrategy):
+    """
+    Copies with separate reader and writer threads handing small files over in bounded buffers, so reading the source
+    and writing the ramdisk overlap instead of alternating in every worker.
+    """
+
+    name = "pipeline"
+
+    def copy(self, source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None,
+             keep_existing: bool) -> CopyStats:
+        return copy_tree_pipelined(source_root, dest_root, exclude, keep_existing)
+
+
+def get_prebuilt_stats(dest_root: str) -> CopyStats:
+    """
+    Count what a partition filled when the ramdisk was created holds, as if it had been copied.
+
+    Args:
+        dest_root (str): Where the partition is mounted.
+
+    Returns:
+        CopyStats: The bytes and inodes in use on the partition.
+    """
+    stats = CopyStats()
+    usage = os.statvfs(dest_root)
+    stats.bytes_copied = (usage.f_blocks - usage.f_bfree) * usage.f_frsize
+    stats.files_copied = usage.f_files - usage.f_ffree
+    return stats
+
+
+class PrebuiltStrategy(CopyStrategy):
+    """
+    Stands for a partition that was filled when the ramdisk was created, leaving nothing to copy.
+    """
+
+    block_level = True
+
+    def copy(self, source_root: str, dest_root: str, exclude: Callable[[str, bool], bool] | None,
+             keep_existing: bool) -> CopyStats:
+        return get_prebuilt_stats(dest_root)
+
+
+class CloneStrategy(PrebuiltStrategy):
+    """
+    Stands for the used blocks BlockClone cloned onto the partition of a mount.
+    """
+
+    name = CLONE_STRATEGY
+
+
+class PopulateStrategy(PrebuiltStrategy):
+    """
+    Stands for the partition MkfsPopulate built already populated from its mount.
+    """
+
+    name = POPULATE_STRATEGY
+
+
+def is_rotational(mount: MountInfo) -> bool | None:
+    """
+    Check if any disk a mount lives on is rotational.
+
+    Args:
+        mount (MountInfo): The mount to check.
+
+    Returns:
+        bool | None: True if a parent disk is rotational, False if none is, None if unknown.
+    """
+    try:
+        disks = mount.get_parent_disks() or []
+        flags = [get_field_from_key_vals(disk, "rota", "type", DISK_TYPES) for disk in disks]
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError):
+        return None
+
+    # Older lsblk reports the flag as "1" and "0"
+    flags = [flag in (True, "1") for flag in flags if flag is not None]
+    return any(flags) if flags else None
+
+
+def read_files(paths: List[str], workers: int) -> float:
+    """
+    Read files, timing it.
+
+    Args:
+        paths (List[str]): The files to read.
+        workers (int): How many files to read at once.
+
+    Returns:
+        float: The seconds taken.
+    """
+    def read(path: str) -> None:
+        try:
+            with open(path, "rb") as f:
+                while f.read(1024 ** 2):
+                    pass
+        except OSError:
+            pass
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(read, paths))
+
+    return time.perf_counter() - start
+
+
+def calibrate(source_root: str) -> float | None:
+    """
+    Measure how much faster a source reads in parallel, by reading half of a sample of small files with one reader
+    and the other half with the copy workers.
+
+    Args:
+        source_root (str): The root of the source being copied.
+
+    Returns:
+        float | None: The speedup of parallel reads, or None if there are too few files to tell.
+    """
+    scan = parallel_scan(source_root, RambootConfig.get_scan_workers())
+    paths = [os.path.join(source_root, rel_path) for rel_path, entry_stat in islice(
+        ((rel_path, entry_stat) for rel_path, entry_stat in scan
+         if stat.S_ISREG(entry_stat.st_mode) and 0 < entry_stat.st_size <= CALIBRATION_MAX_BYTES),
+        CALIBRATION_FILES)]
+    scan.close()
+
+    if len(paths) < CALIBRATION_FILES // 4:
+        return None
+
+    serial = read_files(paths[::2], 1)
+    parallel = read_files(paths[1::2], max(1, RambootConfig.get_copy_workers()))
+
+    return serial / parallel if parallel > 0 else None
+
+
+class CopyStrategies:
+    """
+    Picks the strategy each mount is copied with, and remembers why.
+
+    Per-mount overrides in the config come first.  With the `auto` engine, the choice follows the disks, filesystem and
+    shape of the source, optionally backed by a short read calibration.  Otherwise the configured engine is used.
+    """
+
+    _strategies: Dict[str, CopyStrategy] = {}
+    _choices: Dict[str, Tuple[str, str]] = {}
+
+    @classmethod
+    def register(cls, strategy: CopyStrategy) -> None:
+        """
+        Make a strategy available by its name.
+
+        Args:
+            strategy (CopyStrategy): The strategy.
+
+        Returns:
+            None
+        """
+        cls._strategies[strategy.name] = strategy
+
+    @classmethod
+    def get(cls, name: str) -> CopyStrategy:
+        """
+        Get a strategy by name.
+
+        Args:
+            name (str): The name of the strategy.
+
+        Returns:
+            CopyStrategy: The strategy.
+        """
+        return cls._strategies[name]
+
+    @classmethod
+    def get_names(cls) -> List[str]:
+        """
+        Get the names of every strategy.
+
+        Returns:
+            List[str]: The names, in the order the strategies were registered.
+        """
+        return list(cls._strategies)
+
+    @classmethod
+    def get_default(cls, exclude: Callable[[str, bool], bool] | None = None) -> str:
+        """
+        Get the strategy of the configured engine, when no mount is known.
+
+        Args:
+            exclude (Callable[[str, bool], bool] | None): The exclude callback of the copy.
+
+        Returns:
+            str: The name of the strategy.
+        """
+        engine = RambootConfig.get_copy_engine()
+        if engine not in cls._strategies or cls._strategies[engine].block_level \
+                or not cls._strategies[engine].can_copy(exclude):
+            return BuiltinStrategy.name
+
+        return engine
+
+    @classmethod
+    def choose(cls, mount: MountInfo, source_root: str, exclude: Callable[[str, bool], bool] | None) \
+            -> Tuple[str, str]:
+        """
+        Work out the strategy for a mount, without falling back for unsupported copies.
+
+        Args:
+            mount (MountInfo): The mount being copied.
+            source_root (str): The root of the (masked) source being copied.
+            exclude (Callable[[str, bool], bool] | None): The exclude callback of the copy.
+
+        Returns:
+            Tuple[str, str]: The name of the strategy and why it was chosen.
+        """
+        if BlockClone.is_cloned(mount.dest):
+            return CloneStrategy.name, "same filesystem as its partition, cloned the used blocks"
+
+        if MkfsPopulate.is_populated(mount.dest):
+            return PopulateStrategy.name, "built populated by mkfs"
+
+        # Block-level strategies that were not applied fall through to the rules below
+        override = RambootConfig.get_copy_strategies().get(mount.dest)
+        if override in cls._strategies and not cls._strategies[override].block_level:
+            return override, "configured for this mount"
+
+        if override is not None and override not in cls._strategies:
+            logger.warning("%s: unknown copy strategy %s, choosing one instead", mount.dest, override)
+
+        engine = RambootConfig.get_copy_engine()
+        if engine != "auto" and not (engine in cls._strategies and cls._strategies[engine].block_level):
+            return engine, "configured engine"
+
+        if is_rotational(mount):
+            return InodeOrderStrategy.name, "rotational disk, copying in inode order to cut seeks"
+
+        if RambootConfig.get_copy_calibrate():
+            speedup = calibrate(source_root)
+
+            if speedup is not None and speedup >= CALIBRATION_SPEEDUP:
+                return BuiltinStrategy.name, f"parallel reads were {speedup:.1f}x faster in the calibration"
+
+            if speedup is not None:
+                return CpStrategy.name, f"parallel reads were only {speedup:.1f}x faster in the calibration"
+
+        stats = os.statvfs(source_root)
+        used_bytes = (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+        files = stats.f_files - stats.f_ffree
+        used_ratio = (stats.f_blocks - stats.f_bfree) / stats.f_blocks if stats.f_blocks else 0.0
+
+        if files >= MANY_FILES and used_bytes / files < SMALL_FILE_BYTES:
+            return BuiltinStrategy.name, f"{files} files averaging {used_bytes / files / 1024:.0f} KiB"
+
+        if mount.fstype in {"btrfs", "zfs"} and used_ratio < SPARSE_RATIO:
+            return BuiltinStrategy.name, f"{mount.fstype} only {used_ratio:.0%} used"
+
+        return CpStrategy.name, "no reason to avoid cp"
+
+    @classmethod
+    def select(cls, mount: MountInfo, source_root: str, exclude: Callable[[str, bool], bool] | None = None) -> str:
+        """
+        Pick the strategy for a mount, logging and remembering why.
+
+        Args:
+            mount (MountInfo): The mount being copied.
+            source_root (str): The root of the (masked) source being copied.
+            exclude (Callable[[str, bool], bool] | None): The exclude callback of the copy.
+
+        Returns:
+            str: The name of the strategy.
+        """
+        name, reason = cls.choose(mount, source_root, exclude)
+
+        if name not in cls._strategies:
+            name, reason = BuiltinStrategy.name, f"unknown engine {name}"
+
+        if not cls._strategies[name].can_copy(exclude):
+            name, reason = BuiltinStrategy.name, f"{name} cannot apply the exclusion rules, {reason}"
+
+        logger.info("%s: copying with %s, %s", mount.dest, name, reason)
+        cls._choices[mount.dest] = (name, reason)
+
+        return name
+
+    @classmethod
+    def get_choice(cls, dest: str) -> Tuple[str, str] | None:
+        """
+        Get the strategy a mount was copied with and why.
+
+        Args:
+            dest (str): The mount point.
+
+        Returns:
+            Tuple[str, str] | None: The name of the strategy and the reason, or None if it was not selected.
+        """
+        return cls._choices.get(dest)
+
+
+CopyStrategies.register(CpStrategy())
+CopyStrategies.register(BuiltinStrategy())
+CopyStrategies.register(InodeOrderStrategy())
+CopyStrategies.register(PipelineStrategy())
+CopyStrategies.register(CloneStrategy())
+CopyStrategies.register(PopulateStrategy())
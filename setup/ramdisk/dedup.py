@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import stat
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_HASH_BYTES = 64 * 1024
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# (device, size, mode, uid, gid, mtime_ns), files can only be linked together if all of these match
+CandidateKey = Tuple[int, int, int, int, int, int]
+# (path, inode, allocated bytes)
+Candidate = Tuple[str, int, int]
+
+
+def hash_file(path: str, limit: int | None = None) -> bytes:
+    """
+    Hash the contents of a file.
+
+    Args:
+        path (str): The file to hash.
+        limit (int | None): Only hash this many leading bytes, or the whole file if None.
+
+    Returns:
+        bytes: The digest of the hashed bytes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    remaining = limit
+
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(HASH_CHUNK_BYTES if remaining is None else min(remaining, HASH_CHUNK_BYTES))
+
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    return digest.digest()
+
+
+def get_xattrs(path: str) -> Dict[str, bytes]:
+    """
+    Read all extended attributes of a file.
+
+    Args:
+        path (str): The file to read.
+
+    Returns:
+        Dict[str, bytes]: Attribute names mapped to their values.
+    """
+    try:
+        return {name: os.getxattr(path, name, follow_symlinks=False)
+                for name in os.listxattr(path, follow_symlinks=False)}
+    except OSError:
+        return {}
+
+
+def is_excluded(path: str, excluded: List[str]) -> bool:
+    """
+    Check if a path is at or below any excluded path.
+
+    Args:
+        path (str): The absolute path, as seen after the root is pivoted.
+        excluded (List[str]): Normalized absolute paths to exclude.
+
+    Returns:
+        bool: True if the path is excluded, False otherwise.
+    """
+    return any(path == prefix or path.startswith(prefix + os.path.sep) for prefix in excluded)
+
+
+class Deduplicator:
+    """
+    Hardlinks byte-identical regular files on the ramdisk together.
+
+    Trees are handed over as soon as they are copied, so scanning and partial hashing run in a worker pool while the
+    next mount is being copied.  Candidates are grouped by size and metadata, then by a hash of their first bytes,
+    and finally confirmed with a hash of the whole file before being linked.
+    """
+
+    def __init__(self, ramdisk_base: str):
+        """
+        Initialize a Deduplicator for a ramdisk.
+
+        Args:
+            ramdisk_base (str): The base directory on the RAM disk.
+        """
+        self.ramdisk_base = ramdisk_base
+        self.min_size = RambootConfig.get_dedup_min_size()
+        self.excluded = [os.path.normpath(path) for path in RambootConfig.get_dedup_exclude()]
+        self._executor = ThreadPoolExecutor(max_workers=max(1, RambootConfig.get_dedup_workers()))
+        self._scans: List[Future] = []
+
+    def add_tree(self, path: str, nested: List[str] = ()) -> None:
+        """
+        Queue a freshly copied tree on the ramdisk for deduplication.
+
+        Args:
+            path (str): The directory on the RAM disk holding a copied mount.
+            nested (List[str]): Directories, relative to the tree, holding other mounts queued on their own.
+
+        Returns:
+            None
+        """
+        self._scans.append(self._executor.submit(self._scan_tree, path, set(nested)))
+
+    def _scan_tree(self, path: str, nested: set) -> List[Tuple[CandidateKey, bytes, Candidate]]:
+        """
+        Find deduplication candidates in a tree and hash their leading bytes.
+
+        Args:
+            path (str): The directory on the RAM disk to scan.
+            nested (set): Directories, relative to the tree, to leave out of the scan.
+
+        Returns:
+            List[Tuple[CandidateKey, bytes, Candidate]]: The candidate keys, partial hashes and candidates.
+        """
+        candidates = []
+        scan = parallel_scan(path, RambootConfig.get_scan_workers(), skip=lambda rel_path, is_dir: rel_path in nested)
+
+        for rel_path, entry_stat in scan:
+            if not stat.S_ISREG(entry_stat.st_mode) or entry_stat.st_size < self.min_size:
+                continue
+
+            full_path = os.path.join(path, rel_path)
+            if is_excluded(os.path.join(os.path.sep, os.path.relpath(full_path, self.ramdisk_base)), self.excluded):
+                continue
+
+            key = (entry_stat.st_dev, entry_stat.st_size, entry_stat.st_mode, entry_stat.st_uid, entry_stat.st_gid,
+                   entry_stat.st_mtime_ns)
+
+            try:
+                partial = hash_file(full_path, PARTIAL_HASH_BYTES)
+            except OSError:
+                continue
+
+            candidates.append((key, partial, (full_path, entry_stat.st_ino, entry_stat.st_blocks * 512)))
+
+        return candidates
+
+    def _link_group(self, candidates: List[Candidate]) -> int:
+        """
+        Confirm a group of candidates with full hashes and hardlink the identical ones together.
+
+        Every name of a replaced inode is linked, so files that were already hardlinked stay one file.  Inodes with
+        names outside the group, such as in excluded paths, cannot be freed, so they are only ever kept.
+
+        Args:
+            candidates (List[Candidate]): Candidates sharing metadata and a partial hash.
+
+        Returns:
+            int: The number of bytes freed on the ramdisk.
+        """
+        names: Dict[int, List[str]] = defaultdict(list)
+        allocated: Dict[int, int] = {}
+
+        for path, inode, size in candidates:
+            names[inode].append(path)
+            allocated[inode] = size
+
+        # (inode, whether it has names outside the group) by content and extended attributes
+        by_hash: Dict[Tuple[bytes, tuple], List[Tuple[int, bool]]] = defaultdict(list)
+
+        for inode, paths in names.items():
+            try:
+                # Files already linked together only need hashing once
+                key = (hash_file(paths[0]), tuple(sorted(get_xattrs(paths[0]).items())))
+                stats = [os.lstat(path) for path in paths]
+            except OSError:
+                continue
+
+            if any(entry_stat.st_ino != inode for entry_stat in stats):
+                continue
+
+            by_hash[key].append((inode, stats[0].st_nlink > len(paths)))
+
+        saved = 0
+        for identical in by_hash.values():
+            # Keep an inode that cannot be freed anyway, if there is one
+            identical.sort(key=lambda item: not item[1])
+            keep_path = names[identical[0][0]][0]
+
+            for inode, shared in identical[1:]:
+                if not shared and self._relink(keep_path, names[inode]):
+                    saved += allocated[inode]
+
+        return saved
+
+    def _relink(self, keep_path: str, paths: List[str]) -> bool:
+        """
+        Replace every name of an inode with a hardlink to the kept file.
+
+        Args:
+            keep_path (str): The file to link to.
+            paths (List[str]): Every name of the inode being replaced.
+
+        Returns:
+            bool: True if every name was replaced, freeing the inode, False otherwise.
+        """
+        for path in paths:
+            temp_path = f"{path}.ramboot-dedup"
+
+            try:
+                os.link(keep_path, temp_path)
+                os.replace(temp_path, path)
+            except OSError:
+                if os.path.lexists(temp_path):
+                    os.unlink(temp_path)
+                return False
+
+        return True
+
+    def finish(self) -> int:
+        """
+        Wait for all queued trees, then link identical files together.
+
+        Returns:
+            int: The number of bytes freed on the ramdisk.
+        """
+        groups: Dict[Tuple[CandidateKey, bytes], List[Candidate]] = defaultdict(list)
+
+        for scan in self._scans:
+            for key, partial, candidate in scan.result():
+                groups[(key, partial)].append(candidate)
+
+        duplicate_groups = [candidates for candidates in groups.values() if len(candidates) > 1]
+        saved = sum(self._executor.map(self._link_group, duplicate_groups))
+
+        self._executor.shutdown()
+        logger.info("Deduplication saved %d bytes across %d candidate groups", saved, len(duplicate_groups))
+
+        return saved
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from typing import Dict, List, Set
+
+from setup.mounts.mount_info import MountInfo
+from setup.mounts.source_mounts import mount_source
+from setup.ramdisk.file_copy import apply_metadata
+from setup.ramdisk.image_cache import ImageCache
+from setup.ramdisk.keep_on_disk import get_backing_name
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import get_ramboot_cmd, run_command
+
+logger = logging.getLogger(__name__)
+
+# Relative to the ramdisk base, where the staging area holding the overlay layers is moved before pivoting
+PENDING_DIR = ".ramboot/pending"
+
+# Relative to the ramdisk copy point of each pending mount, the overlay upper and work directories
+UPPER_DIR = ".ramboot/upper"
+WORK_DIR = ".ramboot/work"
+
+# Relative to the staging area, the ramdisk side and the source side of each pending mount
+RAM_DIR = "ram"
+LOWER_DIR = "lower"
+STATE_FILE = "state.json"
+
+
+def write_status(status: Dict) -> None:
+    """
+    Write the progress of an early pivot to the configured status file.
+
+    Args:
+        status (Dict): The status to report, written as JSON.
+
+    Returns:
+        None
+    """
+    status_file = RambootConfig.get_early_pivot_status_file()
+    os.makedirs(os.path.dirname(status_file), exist_ok=True)
+
+    temp_path = f"{status_file}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(dict(status, updated=time.time()), f, indent=2)
+
+    os.replace(temp_path, status_file)
+
+
+class EarlyPivot:
+    """
+    Pivots into the ramdisk once the boot-critical set is copied, leaving everything else to a background copy.
+
+    Every mount still needing a copy is mounted as an overlay, with its source filesystem as the lower layer and the
+    ramdisk as the upper layer.  The whole tree is reachable right away, and whatever is copied or written after the
+    pivot lands on the ramdisk.  The layers are mounted in a staging area that is moved into the ramdisk along with the
+    system mounts, where the background copy picks them up.
+    """
+
+    _staging: str | None = None
+    _pending: List[Dict] = []
+    _disks_in_use: Set[str] = set()
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        """
+        Check if the root should be pivoted before the copy is complete.
+
+        A ramdisk restored from the cached image only needs the changes copied, so it is never pivoted early.
+
+        Returns:
+            bool: True if the root should be pivoted early, False otherwise.
+        """
+        return RambootConfig.get_early_pivot() and not ImageCache.is_restored()
+
+    @classmethod
+    def is_pending(cls) -> bool:
+        """
+        Check if any mount is still being served from its source filesystem.
+
+        Returns:
+            bool: True if the background copy has mounts left to copy, False otherwise.
+        """
+        return bool(cls._pending)
+
+    @classmethod
+    def get_upper_dir(cls, ramdisk_copy_point: str) -> str:
+        """
+        Get the overlay upper directory of a pending mount, creating it if needed.
+
+        Files copied ahead of the pivot go here, so the overlay serves them from the ramdisk.
+
+        Args:
+            ramdisk_copy_point (str): The directory the mount is copied to on the RAM disk.
+
+        Returns:
+            str: The path of the upper directory.
+        """
+        upper = os.path.join(ramdisk_copy_point, UPPER_DIR)
+        os.makedirs(upper, exist_ok=True)
+
+        return upper
+
+    @classmethod
+    def mount_all(cls, pending_mounts: List[MountInfo], masked_paths: Dict[str, List[str]], ramdisk_base: str) -> None:
+        """
+        Mount an overlay of the source filesystem and the ramdisk over the copy point of every pending mount.
+
+        Args:
+            pending_mounts (List[MountInfo]): The mounts left to copy, ordered by depth.
+            masked_paths (Dict[str, List[str]]): Mount points mapped to the directories, relative to the mount, whose
+                contents are not copied.
+            ramdisk_base (str): The base directory on the RAM disk.
+
+        Returns:
+            None
+        """
+        cls._staging = tempfile.mkdtemp()
+        cls._pending = []
+        cls._disks_in_use = set()
+        run_command(["mount", "--types", "tmpfs", "--options", "size=1m,mode=700", "tmpfs", cls._staging])
+
+        # Take hold of the ramdisk side of every mount first, the overlays hide the mounts below them
+        for mount in pending_mounts:
+            name = get_backing_name(mount)
+            ram = os.path.join(cls._staging, RAM_DIR, name)
+            lower = os.path.join(cls._staging, LOWER_DIR, name)
+
+            os.makedirs(ram)
+            run_command(["mount", "--bind", os.path.join(ramdisk_base, mount.dest.lstrip(os.path.sep)), ram])
+
+            if mount.is_root():
+                os.makedirs(lower)
+                run_command(["mount", "--bind", os.path.sep, lower])
+            else:
+                mount_source(mount, lower)
+
+            # The root of an overlay takes its ownership and permissions from the upper layer
+            upper = cls.get_upper_dir(ram)
+            apply_metadata(upper, os.lstat(lower), lower)
+            os.makedirs(os.path.join(ram, WORK_DIR), exist_ok=True)
+
+            if mount.get_parent_disks() is not None:
+                cls._disks_in_use.update(mount.get_parent_disks())
+
+            cls._pending.append({"source": mount.source, "dest": mount.dest, "fstype": mount.fstype,
+                                 "fsopts": mount.fsopts, "name": name, "masked": masked_paths.get(mount.dest, [])})
+
+        for entry in cls._pending:
+            ram = os.path.join(cls._staging, RAM_DIR, entry["name"])
+
+            # Renamed directories would otherwise be recorded as redirects, which only the overlay understands
+            options = (f"lowerdir={os.path.join(cls._staging, LOWER_DIR, entry['name'])},"
+                       f"upperdir={os.path.join(ram, UPPER_DIR)},workdir={os.path.join(ram, WORK_DIR)},redirect_dir=off")
+            target = os.path.join(ramdisk_base, entry["dest"].lstrip(os.path.sep))
+
+            run_command(["mount", "--types", "overlay", "--options", options, "overlay", target])
+            logger.info("%s pending, served from its source until copied", entry["dest"])
+
+        with open(os.path.join(cls._staging, STATE_FILE), "w") as f:
+            json.dump(cls._pending, f, indent=2)
+
+        write_status({"state": "pending", "mounts": {entry["dest"]: {"state": "pending", "files_copied": 0,
+                                                                     "bytes_copied": 0} for entry in cls._pending}})
+
+    @classmethod
+    def move_staging(cls, ramdisk_base: str) -> None:
+        """
+        Move the staging area into the ramdisk, so the background copy can reach the layers after the pivot.
+
+        Args:
+            ramdisk_base (str): The base directory on the RAM disk.
+
+        Returns:
+            None
+        """
+        if cls._staging is None:
+            return
+
+        target = os.path.join(ramdisk_base, PENDING_DIR)
+        os.makedirs(target, exist_ok=True)
+        run_command(["mount", "--move", cls._staging, target])
+        os.rmdir(cls._staging)
+
+    @classmethod
+    def start_background_copy(cls) -> None:
+        """
+        Start copying the pending mounts in the background.
+
+        Must be called after the root is pivoted, the copy runs as its own process so init can take over.
+
+        Returns:
+            None
+        """
+        if not cls.is_pending():
+            return
+
+        subprocess.Popen(get_ramboot_cmd() + ["complete-copy"], start_new_session=True)
+
+    @classmethod
+    def get_disks_in_use(cls) -> Set[str]:
+        """
+        Get the disks still backing pending mounts.
+
+        Returns:
+            Set[str]: The paths of the parent disks, e.g. /dev/sda.
+        """
+        return cls._disks_in_use
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import stat
+from typing import Callable, Dict
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.mounts.source_mounts import mounted_source
+from utils.path_matcher import PathMatcher
+from utils.ramboot_config import RambootConfig
+from utils.scan import parallel_scan
+
+logger = logging.getLogger(__name__)
+
+
+class ExclusionRules:
+    """
+    Applies the configured exclusion rules to the copy stage.
+
+    The rules are compiled once into a PathMatcher.  Excluded bytes are measured before the ramdisk is sized, so
+    sizing can leave them out and a per-rule summary can be emitted once the copy is done.  The state lives on the
+    class, since it is shared between the sizing and copy stages of a single boot.
+    """
+
+    _matcher: PathMatcher | None = None
+    _mount_bytes: Dict[str, int] = {}
+    _rule_bytes: Dict[int, int] = {}
+
+    @classmethod
+    def get_matcher(cls) -> PathMatcher:
+        """
+        Get the compiled exclusion rules.
+
+        Returns:
+            PathMatcher: The matcher for the configured rules.
+        """
+        if cls._matcher is None:
+            cls._matcher = PathMatcher(RambootConfig.get_exclude_rules())
+
+        return cls._matcher
+
+    @classmethod
+    def get_exclude(cls, mount: MountInfo) -> Callable[[str, bool], bool] | None:
+        """
+        Build the exclude callback for walking the source of a mount.
+
+        Args:
+            mount (MountInfo): The mount being copied.
+
+        Returns:
+            Callable[[str, bool], bool] | None: Called with a path relative to the mount and whether it is a
+                directory, returning True if it is excluded.  None if no rule can apply to the mount.
+        """
+        matcher = cls.get_matcher()
+
+        if not matcher or not matcher.might_match_below(mount.dest):
+            return None
+
+        return lambda rel_path, is_dir: matcher.match(os.path.join(mount.dest, rel_path)) is not None
+
+    @classmethod
+    def estimate(cls, physical_mounts: AllMounts) -> None:
+        """
+        Measure the bytes each mount and each rule keeps off the ramdisk.
+
+        Only the parts of a source that could hold excluded paths are walked, so rules naming specific directories
+        are cheap to measure.  Rules matching path components anywhere, such as *.pyc, need a full walk.
+
+        Args:
+            physical_mounts (AllMounts): An object containing all the physical mounts.
+
+        Returns:
+            None
+        """
+        cls._mount_bytes = {}
+        cls._rule_bytes = {}
+        matcher = cls.get_matcher()
+
+        for mount in physical_mounts:
+            if cls.get_exclude(mount) is None:
+                continue
+
+            def skip(rel_path: str, is_dir: bool) -> bool:
+                return is_dir and not matcher.might_match_below(os.path.join(mount.dest, rel_path))
+
+            def exclude(rel_path: str, is_dir: bool) -> bool:
+                # Keep excluded files in the walk so they can be counted, only stop at excluded directories
+                return is_dir and matcher.match(os.path.join(mount.dest, rel_path)) is not None
+
+            with mounted_source(mount) as source_root:
+                for rel_path, entry_stat in parallel_scan(source_root, RambootConfig.get_scan_workers(),
+                                                          skip=skip, exclude=exclude):
+                    rule = matcher.match(os.path.join(mount.dest, rel_path))
+
+                    if rule is None:
+                        continue
+
+                    used = 0
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        subtree = parallel_scan(os.path.join(source_root, rel_path), RambootConfig.get_scan_workers())
+                        used = sum(sub_stat.st_blocks * 512 for _, sub_stat in subtree)
+                    else:
+                        used = entry_stat.st_blocks * 512
+
+                    cls._mount_bytes[mount.dest] = cls._mount_bytes.get(mount.dest, 0) + used
+                    cls._rule_bytes[rule] = cls._rule_bytes.get(rule, 0) + used
+
+    @classmethod
+    def get_reserved_gb(cls, mount: MountInfo | None = None) -> int:
+        """
+        Get the excluded space, in whole gigabytes, that no longer needs to be allocated on the ramdisk.
+
+        Args:
+            mount (MountInfo | None): The mount to check, or None for all mounts.
+
+        Returns:
+            int: The excluded space in gigabytes, rounded down.
+        """
+        if mount is None:
+            excluded = sum(cls._mount_bytes.values())
+        else:
+            excluded = cls._mount_bytes.get(mount.dest, 0)
+
+        return math.floor(float(excluded) / 1024 ** 3)
+
+    @classmethod
+    def log_summary(cls) -> None:
+        """
+        Log the bytes kept off the ramdisk by each rule.
+
+        Returns:
+            None
+        """
+        for rule, used in cls.get_matcher().summarize(cls._rule_bytes):
+            logger.info("Excluded %d bytes matching %s", used, rule)
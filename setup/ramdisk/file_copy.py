@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import os
+import shutil
+import stat
+
+
+def copy_xattrs(source: str, dest: str) -> None:
+    """
+    Copy extended attributes (including SELinux labels) from one path to another without following symlinks.
+
+    Args:
+        source (str): The path to copy extended attributes from.
+        dest (str): The path to copy extended attributes to.
+
+    Returns:
+        None
+    """
+    try:
+        names = os.listxattr(source, follow_symlinks=False)
+    except OSError:
+        return
+
+    for name in names:
+        try:
+            os.setxattr(dest, name, os.getxattr(source, name, follow_symlinks=False), follow_symlinks=False)
+        except OSError:
+            # Not every destination filesystem supports every namespace
+            pass
+
+
+def set_metadata(dest: str, mode: int, uid: int, gid: int, atime_ns: int, mtime_ns: int,
+                 source: str | None = None) -> None:
+    """
+    Apply ownership, extended attributes, permissions and timestamps to a path.
+
+    Ownership is applied first, since chown clears setuid/setgid bits and file capabilities.
+
+    Args:
+        dest (str): The path to update.
+        mode (int): The mode of the source entry, including its file type.
+        uid (int): The owner.
+        gid (int): The group.
+        atime_ns (int): The access time in nanoseconds.
+        mtime_ns (int): The modification time in nanoseconds.
+        source (str | None): The source path to copy extended attributes from, skipped if None.
+
+    Returns:
+        None
+    """
+    os.chown(dest, uid, gid, follow_symlinks=False)
+
+    if source is not None:
+        copy_xattrs(source, dest)
+
+    if not stat.S_ISLNK(mode):
+        os.chmod(dest, stat.S_IMODE(mode))
+
+    os.utime(dest, ns=(atime_ns, mtime_ns), follow_symlinks=False)
+
+
+def apply_metadata(dest: str, source_stat: os.stat_result, source: str | None = None) -> None:
+    """
+    Apply ownership, extended attributes, permissions and timestamps from a source entry to a path.
+
+    Args:
+        dest (str): The path to update.
+        source_stat (os.stat_result): The lstat result of the source entry.
+        source (str | None): The source path to copy extended attributes from, skipped if None.
+
+    Returns:
+        None
+    """
+    set_metadata(dest, source_stat.st_mode, source_stat.st_uid, source_stat.st_gid, source_stat.st_atime_ns,
+                 source_stat.st_mtime_ns, source)
+
+
+def remove_path(path: str) -> None:
+    """
+    Remove a path of any type, recursively for directories.
+
+    Args:
+        path (str): The path to remove.
+
+    Returns:
+        None
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def copy_entry(source: str, dest: str, source_stat: os.stat_result, metadata: bool = True) -> int:
+    """
+    Copy a single filesystem entry, preserving its type and metadata.
+
+    Directories are created but their contents are not copied, and their metadata should be applied once their
+    children have been written.  Anything already at the destination is replaced.
+
+    Args:
+        source (str): The path to copy from.
+        dest (str): The path to copy to.
+        source_stat (os.stat_result): The lstat result of the source entry.
+        metadata (bool): Whether to apply the metadata of the entry, or leave it to the caller.
+
+    Returns:
+        int: The number of data bytes copied.
+    """
+    mode = source_stat.st_mode
+
+    if stat.S_ISDIR(mode):
+        if os.path.lexists(dest) and not os.path.isdir(dest):
+            os.unlink(dest)
+
+        os.makedirs(dest, exist_ok=True)
+        return 0
+
+    remove_path(dest)
+
+    if stat.S_ISREG(mode):
+        shutil.copyfile(source, dest, follow_symlinks=False)
+        copied = source_stat.st_size
+    elif stat.S_ISLNK(mode):
+        os.symlink(os.readlink(source), dest)
+        copied = 0
+    else:
+        # Character/block devices, fifos and sockets
+        os.mknod(dest, mode, source_stat.st_rdev)
+        copied = 0
+
+    if metadata:
+        apply_metadata(dest, source_stat, source)
+
+    return copied
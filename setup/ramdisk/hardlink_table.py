@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import os
+from array import array
+from typing import Iterator, Tuple
+
+# Slots in a new table, always a power of two
+INITIAL_SLOTS = 1024
+
+# An empty slot, path ids are stored one up
+EMPTY = 0
+
+
+class HardlinkTable:
+    """
+    Tracks the names of hardlinked files during a copy, in flat arrays rather than a dict of paths.
+
+    The first name seen of each inode is remembered under its (device, inode) pair in an open addressing hash table,
+    and every later name is queued to be linked to it once the copy is done.  Paths are packed into one byte buffer
+    and referred to by id.  Only entries with more than one link should be added, so files without other names take
+    no memory at all.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty table.
+        """
+        self._devs = array("Q", bytes(8 * INITIAL_SLOTS))
+        self._inos = array("Q", bytes(8 * INITIAL_SLOTS))
+        self._ids = array("Q", bytes(8 * INITIAL_SLOTS))
+        self._used = 0
+
+        # Path i is the bytes from offset i to offset i + 1
+        self._paths = bytearray()
+        self._offsets = array("Q", [0])
+
+        # Pairs of path ids, the first name and another name to link to it
+        self._links = array("Q")
+
+    def __len__(self) -> int:
+        """
+        Count the names waiting to be linked.
+
+        Returns:
+            int: The number of names.
+        """
+        return len(self._links) // 2
+
+    def _add_path(self, rel_path: str) -> int:
+        """
+        Pack a path into the buffer.
+
+        Args:
+            rel_path (str): The path.
+
+        Returns:
+            int: The id of the path.
+        """
+        self._paths += os.fsencode(rel_path)
+        self._offsets.append(len(self._paths))
+        return len(self._offsets) - 2
+
+    def _get_path(self, path_id: int) -> str:
+        """
+        Unpack a path from the buffer.
+
+        Args:
+            path_id (int): The id of the path.
+
+        Returns:
+            str: The path.
+        """
+        return os.fsdecode(bytes(self._paths[self._offsets[path_id]:self._offsets[path_id + 1]]))
+
+    def _find_slot(self, dev: int, ino: int) -> int:
+        """
+        Find the slot of an inode, or the empty slot it would go in.
+
+        Args:
+            dev (int): The device of the inode.
+            ino (int): The inode number.
+
+        Returns:
+            int: The index of the slot.
+        """
+        mask = len(self._ids) - 1
+        slot = hash((dev, ino)) & mask
+
+        while self._ids[slot] != EMPTY and (self._devs[slot] != dev or self._inos[slot] != ino):
+            slot = (slot + 1) & mask
+
+        return slot
+
+    def _grow(self) -> None:
+        """
+        Double the number of slots, moving every inode to its new slot.
+
+        Returns:
+            None
+        """
+        devs, inos, ids = self._devs, self._inos, self._ids
+        slots = len(ids) * 2
+        self._devs = array("Q", bytes(8 * slots))
+        self._inos = array("Q", bytes(8 * slots))
+        self._ids = array("Q", bytes(8 * slots))
+
+        for dev, ino, path_id in zip(devs, inos, ids):
+            if path_id != EMPTY:
+                slot = self._find_slot(dev, ino)
+                self._devs[slot], self._inos[slot], self._ids[slot] = dev, ino, path_id
+
+    def add(self, rel_path: str, entry_stat: os.stat_result) -> bool:
+        """
+        Record a name of a hardlinked file.
+
+        Args:
+            rel_path (str): The path of the name relative to the root.
+            entry_stat (os.stat_result): The lstat result of the name.
+
+        Returns:
+            bool: True if this is the first name of the inode and should be copied, False if it was queued to be
+                linked to the first name instead.
+        """
+        slot = self._find_slot(entry_stat.st_dev, entry_stat.st_ino)
+
+        if self._ids[slot] != EMPTY:
+            self._links.append(self._ids[slot] - 1)
+            self._links.append(self._add_path(rel_path))
+            return False
+
+        self._devs[slot] = entry_stat.st_dev
+        self._inos[slot] = entry_stat.st_ino
+        self._ids[slot] = self._add_path(rel_path) + 1
+        self._used += 1
+
+        # Keep the table at most half full, so probes stay short
+        if self._used * 2 > len(self._ids):
+            self._grow()
+
+        return True
+
+    def get_links(self) -> Iterator[Tuple[str, str]]:
+        """
+        Get the names queued to be linked.
+
+        Yields:
+            Tuple[str, str]: The first name of an inode and another of its names.
+        """
+        for index in range(0, len(self._links), 2):
+            yield self._get_path(self._links[index]), self._get_path(self._links[index + 1])
+
+    def get_bytes(self) -> int:
+        """
+        Get the memory held by the table.
+
+        Returns:
+            int: The size of its arrays and path buffer in bytes.
+        """
+        return sum(len(values) * values.itemsize for values in (self._devs, self._inos, self._ids, self._offsets,
+                                                                 self._links)) + len(self._paths)
@@ -0,0 +1,326 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import stat
+from typing import Dict, List, Tuple
+from urllib.parse import quote, unquote_to_bytes
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import run_command
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FILE = "ramdisk.img"
+MANIFEST_FILE = "manifest.tsv"
+MANIFEST_HEADER = "# ramboot-manifest v1"
+
+DD_CMD = ["dd", "bs=4M", "conv=sparse", "status=none"]
+FSFREEZE_CMD = "/usr/sbin/fsfreeze"
+REREAD_PARTITIONS_CMD = ["/usr/sbin/blockdev", "--rereadpt"]
+
+# (mode, size, mtime_ns, ctime_ns, inode), enough to tell if a file changed since the image was taken
+ManifestEntry = Tuple[int, int, int, int, int]
+Manifest = Dict[str, Dict[str, ManifestEntry]]
+
+
+def manifest_entry(entry_stat: os.stat_result) -> ManifestEntry:
+    """
+    Reduce a stat result to the fields compared when looking for changed files.
+
+    Args:
+        entry_stat (os.stat_result): The lstat result of a source entry.
+
+    Returns:
+        ManifestEntry: The manifest entry for the stat result.
+    """
+    return (entry_stat.st_mode, entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_ctime_ns,
+            entry_stat.st_ino)
+
+
+def entry_bytes(entry: ManifestEntry) -> int:
+    """
+    Get the number of data bytes a manifest entry accounts for.
+
+    Args:
+        entry (ManifestEntry): The manifest entry.
+
+    Returns:
+        int: The size of regular files, 0 for everything else.
+    """
+    return entry[1] if stat.S_ISREG(entry[0]) else 0
+
+
+def is_subpath(path: str, parent: str) -> bool:
+    """
+    Check if a path is the same as, or below, another path.
+
+    Args:
+        path (str): The path to check.
+        parent (str): The potential parent path.
+
+    Returns:
+        bool: True if path is inside parent, False otherwise.
+    """
+    return os.path.commonpath([path, parent]) == parent
+
+
+class ImageCache:
+    """
+    Keeps a raw image of a populated ramdisk on disk, along with a manifest of the source files it was built from.
+
+    When the ramdisk layout matches the cached one, the image is written straight onto the ramdisk device and only the
+    files that changed since the manifest was taken are copied from the source.
+    """
+
+    _device: str | None = None
+    _mounts_key: List[List[str]] = []
+    _fingerprint: str | None = None
+    _mount_points: List[str] = []
+    _restored_manifest: Manifest | None = None
+    _records: Manifest = {}
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        """
+        Check if the image cache is enabled.
+
+        Returns:
+            bool: True if the image cache is enabled, False otherwise.
+        """
+        return RambootConfig.get_image_cache_enabled()
+
+    @classmethod
+    def is_restored(cls) -> bool:
+        """
+        Check if the ramdisk was populated from the cached image during this boot.
+
+        Returns:
+            bool: True if the cached image was restored, False otherwise.
+        """
+        return cls._restored_manifest is not None
+
+    @classmethod
+    def get_image_path(cls) -> str:
+        """
+        Get the path of the cached ramdisk image.
+
+        Returns:
+            str: The path of the cached ramdisk image.
+        """
+        return os.path.join(RambootConfig.get_image_cache_dir(), IMAGE_FILE)
+
+    @classmethod
+    def get_manifest_path(cls) -> str:
+        """
+        Get the path of the manifest describing the cached ramdisk image.
+
+        Returns:
+            str: The path of the manifest.
+        """
+        return os.path.join(RambootConfig.get_image_cache_dir(), MANIFEST_FILE)
+
+    @classmethod
+    def set_mounts(cls, physical_mounts: AllMounts) -> None:
+        """
+        Record the mounts that will be copied to the ramdisk, as part of the cache fingerprint.
+
+        Args:
+            physical_mounts (AllMounts): An object containing all the physical mounts.
+
+        Returns:
+            None
+        """
+        cls._mounts_key = sorted([mount.dest, mount.fstype, mount.source] for mount in physical_mounts)
+
+    @classmethod
+    def get_cache_dir_rel_path(cls, mount: MountInfo, all_mounts: AllMounts) -> str | None:
+        """
+        Get the location of the cache directory relative to a mount, if that mount holds it.
+
+        Args:
+            mount (MountInfo): The mount to check.
+            all_mounts (AllMounts): All mounts being copied, used to find the deepest mount holding the cache.
+
+        Returns:
+            str | None: The cache directory relative to the mount root, or None if another mount holds it.
+        """
+        cache_dir = os.path.normpath(RambootConfig.get_image_cache_dir())
+        holders = [other for other in all_mounts if is_subpath(cache_dir, other.dest)]
+
+        if not holders or max(holders, key=lambda other: len(other.dest)).dest != mount.dest:
+            return None
+
+        return os.path.relpath(cache_dir, mount.dest)
+
+    @classmethod
+    def restore(cls, device: str, ramdisk_mount_points: List[str], layout: list) -> bool:
+        """
+        Write the cached image onto the ramdisk device if it was built for the same layout.
+
+        Args:
+            device (str): The ramdisk block device.
+            ramdisk_mount_points (List[str]): The mount points of the ramdisk filesystems, frozen when saving.
+            layout (list): A JSON serializable description of the ramdisk partitions.
+
+        Returns:
+            bool: True if the image was restored and the device no longer needs partitioning or formatting.
+        """
+        cls._device = device
+        cls._mount_points = ramdisk_mount_points
+        cls._fingerprint = hashlib.sha256(json.dumps([cls._mounts_key, layout]).encode()).hexdigest()
+
+        if not cls.is_enabled():
+            return False
+
+        if not os.path.isfile(cls.get_image_path()) or not os.path.isfile(cls.get_manifest_path()):
+            logger.info("No cached ramdisk image found, doing a full copy")
+            return False
+
+        fingerprint, manifest = read_manifest(cls.get_manifest_path())
+
+        if fingerprint != cls._fingerprint:
+            logger.info("Cached ramdisk image was built for a different layout, doing a full copy")
+            return False
+
+        # The fresh ramdisk is zero filled, so zero blocks in the image can be skipped
+        result = run_command(DD_CMD + [f"if={cls.get_image_path()}", f"of={device}"])
+        if result.returncode != 0:
+            logger.warning("Failed to restore the cached ramdisk image, doing a full copy")
+            return False
+
+        run_command(REREAD_PARTITIONS_CMD + [device])
+
+        cls._restored_manifest = manifest
+        return True
+
+    @classmethod
+    def get_restored_entries(cls, mount: MountInfo) -> Dict[str, ManifestEntry]:
+        """
+        Get the manifest entries of a mount as they were when the restored image was taken.
+
+        Args:
+            mount (MountInfo): The mount to get entries for.
+
+        Returns:
+            Dict[str, ManifestEntry]: Relative paths mapped to their manifest entries.
+        """
+        if cls._restored_manifest is None:
+            return {}
+
+        return cls._restored_manifest.get(mount.dest, {})
+
+    @classmethod
+    def record(cls, mount: MountInfo, entries: Dict[str, ManifestEntry]) -> None:
+        """
+        Record the source entries of a mount for the manifest written alongside the next image.
+
+        Args:
+            mount (MountInfo): The mount the entries belong to.
+            entries (Dict[str, ManifestEntry]): Relative paths mapped to their manifest entries.
+
+        Returns:
+            None
+        """
+        cls._records[mount.dest] = entries
+
+    @classmethod
+    def save(cls) -> None:
+        """
+        Write the populated ramdisk device and the recorded manifest to the cache directory.
+
+        The ramdisk filesystems are frozen while the device is imaged so the image is consistent.
+
+        Returns:
+            None
+        """
+        if not cls.is_enabled() or cls._device is None:
+            return
+
+        cache_dir = RambootConfig.get_image_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        image_tmp = cls.get_image_path() + ".tmp"
+        manifest_tmp = cls.get_manifest_path() + ".tmp"
+
+        run_command(["sync"])
+
+        for mount_point in cls._mount_points:
+            run_command([FSFREEZE_CMD, "--freeze", mount_point])
+
+        try:
+            result = run_command(DD_CMD + [f"if={cls._device}", f"of={image_tmp}"])
+        finally:
+            for mount_point in reversed(cls._mount_points):
+                run_command([FSFREEZE_CMD, "--unfreeze", mount_point])
+
+        if result.returncode != 0:
+            logger.warning("Failed to image the ramdisk, the image cache was not updated")
+
+            if os.path.exists(image_tmp):
+                os.remove(image_tmp)
+            return
+
+        write_manifest(manifest_tmp, cls._fingerprint, cls._records)
+
+        # Replace the manifest last, an old manifest with a new image would fail the fingerprint check anyway
+        os.replace(image_tmp, cls.get_image_path())
+        os.replace(manifest_tmp, cls.get_manifest_path())
+        logger.info("Saved ramdisk image to %s", cache_dir)
+
+
+def write_manifest(manifest_path: str, fingerprint: str, manifest: Manifest) -> None:
+    """
+    Write a manifest to disk.
+
+    Paths are percent-encoded so tabs, newlines and non UTF-8 names survive the round trip.
+
+    Args:
+        manifest_path (str): The file to write.
+        fingerprint (str): The layout fingerprint of the image the manifest describes.
+        manifest (Manifest): Mount destinations mapped to their entries.
+
+    Returns:
+        None
+    """
+    with open(manifest_path, "w") as f:
+        f.write(f"{MANIFEST_HEADER} {fingerprint}\n")
+
+        for dest, entries in manifest.items():
+            quoted_dest = quote(os.fsencode(dest))
+
+            for rel_path, entry in entries.items():
+                fields = [quoted_dest, quote(os.fsencode(rel_path))] + [str(val) for val in entry]
+                f.write("\t".join(fields) + "\n")
+
+
+def read_manifest(manifest_path: str) -> Tuple[str | None, Manifest]:
+    """
+    Read a manifest from disk.
+
+    Args:
+        manifest_path (str): The file to read.
+
+    Returns:
+        Tuple[str | None, Manifest]: The layout fingerprint, or None if the file is not a manifest, and the
+            mount destinations mapped to their entries.
+    """
+    manifest: Manifest = {}
+
+    with open(manifest_path, "r") as f:
+        header = f.readline().split()
+
+        if " ".join(header[:-1]) != MANIFEST_HEADER:
+            return None, manifest
+
+        for line in f:
+            quoted_dest, quoted_path, *fields = line.rstrip("\n").split("\t")
+            dest = os.fsdecode(unquote_to_bytes(quoted_dest))
+            rel_path = os.fsdecode(unquote_to_bytes(quoted_path))
+
+            manifest.setdefault(dest, {})[rel_path] = tuple(int(field) for field in fields)
+
+    return header[-1], manifest
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import itertools
+import logging
+import os
+from typing import Dict, List, Set
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.mounts.source_mounts import mount_source
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import run_command
+
+logger = logging.getLogger(__name__)
+
+# Relative to the ramdisk base, where the sources backing kept subtrees are mounted
+BACKING_DIR = ".ramboot/disk"
+
+READ_ONLY = "ro"
+READ_WRITE = "rw"
+
+
+def get_backing_name(mount: MountInfo) -> str:
+    """
+    Turn a mount point into a flat name for its backing directory.
+
+    Args:
+        mount (MountInfo): The mount backing kept subtrees.
+
+    Returns:
+        str: The flat name, e.g. var-lib for /var/lib and root for /.
+    """
+    return mount.dest.strip(os.path.sep).replace(os.path.sep, "-") or "root"
+
+
+class KeepOnDisk:
+    """
+    Leaves configured subtrees on disk, reachable from the ramdisk through bind mounts.
+
+    The subtrees are hidden from the copy, their source filesystem is mounted inside the ramdisk and each subtree is
+    bind mounted into place, read-only or read-write.  The disks backing them stay in use after the root is pivoted.
+    """
+
+    _mounted: List[List[str]] = []
+    _disks_in_use: Set[str] = set()
+
+    @classmethod
+    def get_paths(cls, all_mounts: AllMounts) -> Dict[str, str]:
+        """
+        Get the configured subtrees and their access mode.
+
+        Subtrees with other mounts below them are skipped, the bind mount would hide those mounts.
+
+        Args:
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            Dict[str, str]: Normalized absolute paths mapped to "ro" or "rw".
+        """
+        paths = {}
+
+        for path, mode in RambootConfig.get_keep_on_disk().items():
+            path = os.path.normpath(path)
+            nested = [mount.dest for mount in all_mounts
+                      if mount.dest != path and os.path.commonpath([path, mount.dest]) == path]
+
+            if path == os.path.sep or nested:
+                logger.warning("Not keeping %s on disk, it holds other mounts", path)
+                continue
+
+            if mode not in (READ_ONLY, READ_WRITE):
+                logger.warning("Unknown keep_on_disk mode %s for %s, using %s", mode, path, READ_ONLY)
+                mode = READ_ONLY
+
+            paths[path] = mode
+
+        return paths
+
+    @classmethod
+    def get_rel_paths(cls, mount: MountInfo, all_mounts: AllMounts) -> List[str]:
+        """
+        Get the kept subtrees that live on a mount, relative to the mount.
+
+        Args:
+            mount (MountInfo): The mount to check.
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            List[str]: The kept subtrees relative to the mount root, "." if the whole mount is kept.
+        """
+        return [os.path.relpath(path, mount.dest) for path in cls.get_paths(all_mounts)
+                if all_mounts.get_holder(path).dest == mount.dest]
+
+    @classmethod
+    def is_whole_mount(cls, mount: MountInfo, all_mounts: AllMounts) -> bool:
+        """
+        Check if a mount is kept on disk as a whole, so it does not need copying.
+
+        Args:
+            mount (MountInfo): The mount to check.
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            bool: True if the whole mount is kept on disk, False otherwise.
+        """
+        return mount.dest in cls.get_paths(all_mounts)
+
+    @classmethod
+    def mount_all(cls, all_mounts: AllMounts, ramdisk_base: str) -> None:
+        """
+        Mount the sources backing kept subtrees inside the ramdisk and bind mount each subtree into place.
+
+        Args:
+            all_mounts (AllMounts): All mounts being copied.
+            ramdisk_base (str): The base directory on the RAM disk.
+
+        Returns:
+            None
+        """
+        cls._mounted = []
+        cls._disks_in_use = set()
+        paths = cls.get_paths(all_mounts)
+
+        for mount in all_mounts:
+            rel_paths = cls.get_rel_paths(mount, all_mounts)
+
+            if not rel_paths:
+                continue
+
+            # Nothing can write to a backing filesystem whose subtrees are all read-only, not even through the backing
+            read_only = all(paths[os.path.normpath(os.path.join(mount.dest, rel_path))] == READ_ONLY
+                            for rel_path in rel_paths)
+            fsopts = mount.fsopts + ["ro"] if read_only else mount.fsopts
+
+            backing = os.path.join(ramdisk_base, BACKING_DIR, get_backing_name(mount))
+            mount_source(mount, backing, read_only)
+
+            if mount.get_parent_disks() is not None:
+                cls._disks_in_use.update(mount.get_parent_disks())
+
+            for rel_path in rel_paths:
+                path = os.path.normpath(os.path.join(mount.dest, rel_path))
+                mode = paths[path]
+                target = os.path.join(ramdisk_base, path.lstrip(os.path.sep))
+
+                os.makedirs(target, exist_ok=True)
+                run_command(["mount", "--bind", os.path.join(backing, rel_path), target])
+
+                if mode == READ_ONLY:
+                    run_command(["mount", "--options", "remount,bind,ro", target])
+
+                cls._mounted.append([mount.source, mount.fstype, ",".join(fsopts),
+                                     get_backing_name(mount), rel_path, path, mode])
+                logger.info("%s kept on disk (%s)", path, mode)
+
+    @classmethod
+    def get_disks_in_use(cls) -> Set[str]:
+        """
+        Get the disks still backing kept subtrees.
+
+        Returns:
+            Set[str]: The paths of the parent disks, e.g. /dev/sda.
+        """
+        return cls._disks_in_use
+
+    @classmethod
+    def get_fstab_lines(cls) -> List[str]:
+        """
+        Build fstab lines describing the backing and bind mounts, as seen after the root is pivoted.
+
+        Returns:
+            List[str]: The fstab lines, each backing mount before the bind mounts depending on it.
+        """
+        lines = []
+        backing_base = os.path.join(os.path.sep, BACKING_DIR)
+
+        for backing_name, entries in itertools.groupby(cls._mounted, key=lambda entry: entry[3]):
+            entries = list(entries)
+            source, fstype, fsopts = entries[0][:3]
+            backing = os.path.join(backing_base, backing_name)
+
+            # Mirror mount_source, zfs datasets need zfsutil unless they use legacy mount points
+            if fstype == "zfs":
+                fsopts = "zfsutil,ro" if "ro" in fsopts.split(",") else "zfsutil"
+
+            lines.append(f"{source}\t{backing}\t{fstype}\t{fsopts or 'defaults'}\t0\t0")
+
+            for *_, rel_path, path, mode in entries:
+                lines.append(f"{os.path.normpath(os.path.join(backing, rel_path))}\t{path}\tnone\tbind,{mode}\t0\t0")
+
+        return lines
@@ -1,9 +1,19 @@
+import logging
 import os
-import subprocess
-
+from concurrent.futures import ThreadPoolExecutor
+
+from setup.ramdisk.block_clone import WIPE_CMD, BlockClone
+from setup.ramdisk.compressed_images import CompressedImages
+from setup.ramdisk.exclusions import ExclusionRules
+from setup.ramdisk.image_cache import ImageCache
+from setup.ramdisk.keep_on_disk import KeepOnDisk
+from setup.ramdisk.mkfs_populate import MkfsPopulate
 from setup.ramdisk.ramdisk_part_info import AllRamdiskPartInfo, RamdiskPartInfo
 from setup.mounts.mount_info import AllMounts, MountInfo
 from utils.ramboot_config import RambootConfig
+from utils.shell_commands import run_command
+
+logger = logging.getLogger(__name__)
 
 RAMDISK_DEV = "/dev/ram0"
 RAMDISK_BASE = "/mnt/ramdisk-ramboot"
@@ -24,7 +34,7 @@ def modprobe_ramdisk(size_in_gb: int, num_partitions: int) -> None:
     modprobe_cmd = ["/usr/sbin/modprobe", "brd", "rd_nr=1", f"max_part={num_partitions}",
                     f"rd_size={1024 * 1024 * size_in_gb}"]
 
-    subprocess.run(modprobe_cmd)
+    run_command(modprobe_cmd)
 
 
 def partition_ramdisk(all_ramdisk_partitions: AllRamdiskPartInfo) -> None:
@@ -48,27 +58,72 @@ def partition_ramdisk(all_ramdisk_partitions: AllRamdiskPartInfo) -> None:
     sgdisk_cmd.append(RAMDISK_DEV)
 
     # Partition Ramdisk
-    subprocess.run(sgdisk_cmd)
+    run_command(sgdisk_cmd)
+
+
+def format_partition(part_info: RamdiskPartInfo) -> None:
+    """
+    Format a partition on the RAM disk with its filesystem type, populated from its source if planned.
+
+    Args:
+        part_info (RamdiskPartInfo): The partition to format.
+
+    Returns:
+        None
+    """
+    if MkfsPopulate.populate(part_info, f"{RAMDISK_DEV}p{part_info.order}"):
+        return
+
+    run_command([f"/usr/sbin/mkfs.{part_info.fstype}", f"{RAMDISK_DEV}p{part_info.order}"])
 
 
 def format_partitions(all_ramdisk_partitions: AllRamdiskPartInfo) -> None:
     """
     Format each partition on the RAM disk with the specified filesystem type.
 
+    Partitions planned for cloning get the used blocks of their source instead, unless the clone fails.  The other
+    partitions are formatted, and populated when planned, all at once.
+
     Args:
         all_ramdisk_partitions (AllRamdiskPartInfo): An object containing partition information for the RAM disk.
 
     Returns:
         None
     """
-    for part_info in all_ramdisk_partitions:
-        subprocess.run([f"/usr/sbin/mkfs.{part_info.fstype}", f"{RAMDISK_DEV}p{part_info.order}"])
+    # Clones go first and one at a time, since the root is read-only while it is cloned
+    remaining = [part_info for part_info in all_ramdisk_partitions
+                 if not BlockClone.clone(part_info, f"{RAMDISK_DEV}p{part_info.order}")]
+
+    with ThreadPoolExecutor(max_workers=max(1, len(remaining)), thread_name_prefix="format") as executor:
+        list(executor.map(format_partition, remaining))
+
+
+def mount_partition(mount_src: str, mount_dest: str) -> bool:
+    """
+    Mount a partition of the RAM disk.
+
+    With discard configured, deleting files on the ramdisk frees their memory right away.
+
+    Args:
+        mount_src (str): The block device of the partition.
+        mount_dest (str): Where to mount it.
+
+    Returns:
+        bool: True if the partition was mounted, False otherwise.
+    """
+    if RambootConfig.get_reclaim_discard():
+        return run_command(["mount", "--options", "discard", mount_src, mount_dest]).returncode == 0
+
+    return run_command(["mount", mount_src, mount_dest]).returncode == 0
 
 
 def mount_partitions(all_ramdisk_partitions: AllRamdiskPartInfo) -> None:
     """
     Mount each partition of the RAM disk to the specified destination.
 
+    A cloned or populated partition that cannot be mounted is wiped and formatted empty instead, so its mount is
+    copied file by file.
+
     Args:
         all_ramdisk_partitions (AllRamdiskPartInfo): An object containing partition information for the RAM disk.
 
@@ -83,7 +138,24 @@ def mount_partitions(all_ramdisk_partitions: AllRamdiskPartInfo) -> None:
         # Create dest if it doesn't exist
         os.makedirs(mount_dest, exist_ok=True)
 
-        subprocess.run(["mount", mount_src, mount_dest])
+        mounted = mount_partition(mount_src, mount_dest)
+        prebuilt = BlockClone.is_cloned(part_info.destination) or MkfsPopulate.is_populated(part_info.destination)
+
+        if not mounted and prebuilt:
+            logger.warning("%s: unable to mount the prebuilt partition, copying file by file instead",
+                           part_info.destination)
+            BlockClone.discard(part_info.destination)
+            MkfsPopulate.discard(part_info.destination)
+
+            run_command(WIPE_CMD + [mount_src])
+            run_command([f"/usr/sbin/mkfs.{part_info.fstype}", mount_src])
+            mounted = mount_partition(mount_src, mount_dest)
+
+        if not mounted:
+            logger.error("%s: unable to mount %s", part_info.destination, mount_src)
+
+        # Clones keep the size of their source until grown
+        BlockClone.grow(part_info, mount_dest)
 
 
 def create_ramdisk_partitions(physical_mounts: AllMounts) -> AllRamdiskPartInfo:
@@ -100,7 +172,17 @@ def create_ramdisk_partitions(physical_mounts: AllMounts) -> AllRamdiskPartInfo:
 
     # Using enumerate, since multiple items at the same depth with different partition sizes may exist
     for idx, mount in enumerate(physical_mounts, start=1):
-        ramdisk_partitions.append(RamdiskPartInfo.create_ramdisk_part_info(mount, order=idx))
+        part_info = RamdiskPartInfo.create_ramdisk_part_info(mount, order=idx)
+
+        # Subtrees packed into compressed images live in a tmpfs, and excluded paths are not copied at all
+        reserved_gb = CompressedImages.get_reserved_gb(mount) + ExclusionRules.get_reserved_gb(mount)
+        part_info.size_in_gb = max(1, part_info.size_in_gb - reserved_gb)
+
+        # Mounts kept on disk as a whole only need a placeholder
+        if KeepOnDisk.is_whole_mount(mount, physical_mounts):
+            part_info.size_in_gb = 1
+
+        ramdisk_partitions.append(part_info)
 
     return AllRamdiskPartInfo(ramdisk_partitions)
 
@@ -143,6 +225,16 @@ def create_ramdisk_worker(all_ramdisk_partitions: AllRamdiskPartInfo) -> str:
     # Create the block device
     modprobe_ramdisk(total_ramdisk_size, len(all_ramdisk_partitions))
 
+    # If the cached image matches this layout, it already holds partitioned and formatted filesystems
+    layout = [[part_info.order, part_info.size_in_gb, part_info.fstype, part_info.destination]
+              for part_info in all_ramdisk_partitions] + [total_ramdisk_size]
+    mount_points = [os.path.join(RAMDISK_BASE, part_info.destination.lstrip("/"))
+                    for part_info in all_ramdisk_partitions]
+
+    if ImageCache.restore(RAMDISK_DEV, mount_points, layout):
+        mount_partitions(all_ramdisk_partitions)
+        return RAMDISK_BASE
+
     # Partition the block device
     partition_ramdisk(all_ramdisk_partitions)
 
@@ -177,8 +269,9 @@ def get_simple_ramdisk_size(physical_mounts: AllMounts) -> int:
     parent_disks_to_size_dict = {tuple(mount.get_parent_disks()): mount.get_parent_size_gb() for mount in
                                  physical_mounts if mount.get_parent_disks() is not None}
 
-    # Get the sum of the parent_gb_sizes
-    return sum(val for val in parent_disks_to_size_dict.values())
+    # Get the sum of the parent_gb_sizes, less the subtrees packed into compressed images and excluded paths
+    reserved_gb = CompressedImages.get_reserved_gb() + ExclusionRules.get_reserved_gb()
+    return max(1, sum(val for val in parent_disks_to_size_dict.values()) - reserved_gb)
 
 
 def get_simple_ramdisk_fstype(root_mount: MountInfo) -> str:
@@ -211,6 +304,15 @@ def create_ramdisk(physical_mounts: AllMounts) -> str:
     """
     root_mount = physical_mounts.get_root_mount()
 
+    # The image cache is only valid for the same set of mounts
+    ImageCache.set_mounts(physical_mounts)
+
+    # Measure the subtrees that will be packed into compressed images instead of taking up ramdisk space
+    CompressedImages.estimate(physical_mounts)
+
+    # Measure the paths excluded from the copy
+    ExclusionRules.estimate(physical_mounts)
+
     # Check if single partition is requested or fstype is btrfs
     # btrfs has subvolumes which act weirdly, easier to assume a single partition
     # zfs uses volumes as well, easier to assume a single partition
@@ -223,4 +325,9 @@ def create_ramdisk(physical_mounts: AllMounts) -> str:
     # Otherwise, keep going with more complex partitioning
     else:
         all_ramdisk_partitions = create_ramdisk_partitions(physical_mounts)
+
+        # Partitions can be cloned from their source or built populated instead of formatted empty and copied
+        BlockClone.plan(physical_mounts, all_ramdisk_partitions)
+        MkfsPopulate.plan(physical_mounts, all_ramdisk_partitions)
+
         return create_ramdisk_worker(all_ramdisk_partitions)
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+from typing import List
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.ramdisk.compressed_images import CompressedImages
+from setup.ramdisk.image_cache import ImageCache
+from setup.ramdisk.keep_on_disk import KeepOnDisk
+
+
+def get_masked_paths(mount: MountInfo, all_mounts: AllMounts) -> List[str]:
+    """
+    Get the directories of a mount whose contents must not be copied to the RAM disk.
+
+    These are the subtrees packed into compressed images, the subtrees kept on disk and the image cache directory.
+
+    Args:
+        mount (MountInfo): The mount being copied.
+        all_mounts (AllMounts): A collection of all mount point information.
+
+    Returns:
+        List[str]: The directories to leave empty, relative to the mount root.
+    """
+    masked_paths = CompressedImages.get_rel_paths(mount, all_mounts) + KeepOnDisk.get_rel_paths(mount, all_mounts)
+
+    if ImageCache.is_enabled():
+        cache_rel_path = ImageCache.get_cache_dir_rel_path(mount, all_mounts)
+
+        if cache_rel_path is not None:
+            masked_paths.append(cache_rel_path)
+
+    return masked_paths
@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import os
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List
+
+from setup.ramdisk.file_copy import set_metadata
+
+# Entries whose metadata one metadata worker applies at a time
+METADATA_BATCH = 1024
+
+# Entries queued before they are applied while still copying, so the queue does not grow with the tree
+METADATA_QUEUE_LIMIT = 8 * METADATA_BATCH
+
+
+class MetadataQueue:
+    """
+    Metadata of copied entries waiting to be applied, kept in parallel arrays rather than one object per entry.
+
+    Each entry is a relative path plus its mode, owner, group and timestamps.  Extended attributes, including SELinux
+    labels, are read from the source again when applied, so they take no memory while queued.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty queue.
+        """
+        self.paths: List[str] = []
+        self.modes = array("I")
+        self.uids = array("I")
+        self.gids = array("I")
+        self.atimes = array("q")
+        self.mtimes = array("q")
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """
+        Count the queued entries.
+
+        Returns:
+            int: The number of entries.
+        """
+        return len(self.paths)
+
+    def add(self, rel_path: str, entry_stat: os.stat_result) -> None:
+        """
+        Queue the metadata of an entry.
+
+        Args:
+            rel_path (str): The path of the entry relative to the root.
+            entry_stat (os.stat_result): The lstat result of the source entry.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.paths.append(rel_path)
+            self.modes.append(entry_stat.st_mode)
+            self.uids.append(entry_stat.st_uid)
+            self.gids.append(entry_stat.st_gid)
+            self.atimes.append(entry_stat.st_atime_ns)
+            self.mtimes.append(entry_stat.st_mtime_ns)
+
+    def take(self) -> MetadataQueue:
+        """
+        Move every queued entry to a new queue, leaving this one empty.
+
+        Returns:
+            MetadataQueue: The queued entries.
+        """
+        taken = MetadataQueue()
+
+        with self._lock:
+            taken.paths, self.paths = self.paths, taken.paths
+            taken.modes, self.modes = self.modes, taken.modes
+            taken.uids, self.uids = self.uids, taken.uids
+            taken.gids, self.gids = self.gids, taken.gids
+            taken.atimes, self.atimes = self.atimes, taken.atimes
+            taken.mtimes, self.mtimes = self.mtimes, taken.mtimes
+
+        return taken
+
+    def get_batches(self, size: int = METADATA_BATCH) -> Iterator[List[int]]:
+        """
+        Split the queue into batches of neighbouring paths.
+
+        Args:
+            size (int): The most entries in a batch.
+
+        Yields:
+            List[int]: The indexes of the entries of a batch, sorted by path.
+        """
+        indexes = sorted(range(len(self.paths)), key=self.paths.__getitem__)
+
+        for start in range(0, len(indexes), size):
+            yield indexes[start:start + size]
+
+    def apply(self, source_root: str, dest_root: str, indexes: List[int], on_error: Callable[[str, OSError], None]) \
+            -> None:
+        """
+        Apply the metadata of some entries.
+
+        Args:
+            source_root (str): The directory copied from.
+            dest_root (str): The directory copied into.
+            indexes (List[int]): The entries to apply, in order.
+            on_error (Callable[[str, OSError], None]): Called with the source path of each entry that failed.
+
+        Returns:
+            None
+        """
+        for index in indexes:
+            source = os.path.join(source_root, self.paths[index])
+
+            try:
+                set_metadata(os.path.join(dest_root, self.paths[index]), self.modes[index], self.uids[index],
+                             self.gids[index], self.atimes[index], self.mtimes[index], source)
+            except OSError as e:
+                on_error(source, e)
+
+    def apply_all(self, source_root: str, dest_root: str, workers: int, on_error: Callable[[str, OSError], None]) \
+            -> None:
+        """
+        Apply the metadata of every entry with a pool of workers, one path-sorted batch each at a time.
+
+        Args:
+            source_root (str): The directory copied from.
+            dest_root (str): The directory copied into.
+            workers (int): The number of metadata workers.
+            on_error (Callable[[str, OSError], None]): Called with the source path of each entry that failed.
+
+        Returns:
+            None
+        """
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="metadata") as executor:
+            for future in [executor.submit(self.apply, source_root, dest_root, batch, on_error)
+                           for batch in self.get_batches()]:
+                future.result()
+
+
+class PendingDirectories:
+    """
+    Directories whose metadata waits for everything inside them to be written, since writing into a directory
+    changes its timestamps.
+
+    Each directory counts what it is still waiting for: its own scan, its subdirectories and the entries being copied
+    into it.  Once the count drops to zero its metadata is applied right away and its parent stops waiting for it, so
+    only the directories along the paths still being copied are kept, rather than every directory of the tree.
+    """
+
+    def __init__(self, source_root: str, dest_root: str, on_error: Callable[[str, OSError], None]):
+        """
+        Initialize with nothing pending.
+
+        Args:
+            source_root (str): The directory copied from.
+            dest_root (str): The directory copied into.
+            on_error (Callable[[str, OSError], None]): Called with the source path of each directory that failed.
+        """
+        self.source_root = source_root
+        self.dest_root = dest_root
+        self.on_error = on_error
+
+        # Relative path to [outstanding count, lstat result]
+        self._pending: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """
+        Count the directories still pending.
+
+        Returns:
+            int: The number of directories.
+        """
+        return len(self._pending)
+
+    def add(self, rel_path: str, entry_stat: os.stat_result) -> None:
+        """
+        Start waiting on a directory until it is scanned, and have its parent wait on it.
+
+        Args:
+            rel_path (str): The path of the directory relative to the root, "" for the root itself.
+            entry_stat (os.stat_result): The lstat result of the source directory.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._pending[rel_path] = [1, entry_stat]
+
+            if rel_path:
+                self._pending[os.path.dirname(rel_path)][0] += 1
+
+    def hold(self, rel_path: str) -> None:
+        """
+        Have the parent of an entry wait until the entry is written.
+
+        Args:
+            rel_path (str): The path of the entry relative to the root.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._pending[os.path.dirname(rel_path)][0] += 1
+
+    def release(self, rel_path: str) -> None:
+        """
+        Stop waiting on an entry held with hold.
+
+        Args:
+            rel_path (str): The path of the entry relative to the root.
+
+        Returns:
+            None
+        """
+        self._release(os.path.dirname(rel_path))
+
+    def scanned(self, rel_path: str) -> None:
+        """
+        Stop waiting on the scan of a directory, every entry inside it has been added or held.
+
+        Args:
+            rel_path (str): The path of the directory relative to the root.
+
+        Returns:
+            None
+        """
+        self._release(rel_path)
+
+    def _release(self, rel_path: str) -> None:
+        """
+        Count down a directory, applying the metadata of it and of every parent that has nothing left to wait for.
+
+        Args:
+            rel_path (str): The path of the directory relative to the root.
+
+        Returns:
+            None
+        """
+        while True:
+            with self._lock:
+                entry = self._pending[rel_path]
+                entry[0] -= 1
+
+                if entry[0]:
+                    return
+
+                del self._pending[rel_path]
+
+            # Applied before its parent is counted down, so children always come before their parents
+            self._apply(rel_path, entry[1])
+
+            if not rel_path:
+                return
+
+            rel_path = os.path.dirname(rel_path)
+
+    def _apply(self, rel_path: str, entry_stat: os.stat_result) -> None:
+        """
+        Apply the metadata of a directory.
+
+        Args:
+            rel_path (str): The path of the directory relative to the root.
+            entry_stat (os.stat_result): The lstat result of the source directory.
+
+        Returns:
+            None
+        """
+        source = os.path.join(self.source_root, rel_path)
+
+        try:
+            set_metadata(os.path.join(self.dest_root, rel_path), entry_stat.st_mode, entry_stat.st_uid,
+                         entry_stat.st_gid, entry_stat.st_atime_ns, entry_stat.st_mtime_ns, source)
+        except OSError as e:
+            self.on_error(source, e)
+
+    def finish(self) -> None:
+        """
+        Apply the metadata of every directory still pending, children before their parents, once nothing more is
+        written into the tree.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for rel_path in sorted(pending, reverse=True):
+            self._apply(rel_path, pending[rel_path][1])
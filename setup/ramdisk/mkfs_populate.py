@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import logging
+from typing import Dict, List, Set, Tuple
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.mounts.source_mounts import masked_source, mounted_source
+from setup.ramdisk.early_pivot import EarlyPivot
+from setup.ramdisk.exclusions import ExclusionRules
+from setup.ramdisk.masked_paths import get_masked_paths
+from setup.ramdisk.ramdisk_part_info import AllRamdiskPartInfo, RamdiskPartInfo
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import run_command
+
+logger = logging.getLogger(__name__)
+
+# The name of the copy strategy for populated mounts, which only describes the copy already made
+POPULATE_STRATEGY = "populate"
+
+# mke2fs can only build ext filesystems populated from a directory
+POPULATE_FSTYPES = {"ext2", "ext3", "ext4"}
+
+
+class MkfsPopulate:
+    """
+    Builds ext ramdisk partitions already populated from their source with `mkfs -d`, instead of formatting them
+    empty and copying the mount file by file afterwards.
+
+    mke2fs writes the files straight into the new filesystem, without mounting it, so there are no per-file writes
+    through the VFS.  Sources are read through a bind mount, which leaves their submounts and masked subtrees out, but
+    exclusion rules cannot be applied.
+    """
+
+    _planned: Dict[int, Tuple[MountInfo, List[str]]] = {}
+    _populated: Set[str] = set()
+
+    @classmethod
+    def is_wanted(cls, mount: MountInfo) -> bool:
+        """
+        Check if a mount should be populated by mkfs, when it can be.
+
+        Args:
+            mount (MountInfo): The mount to check.
+
+        Returns:
+            bool: True if the populate strategy is configured for the mount, False otherwise.
+        """
+        override = RambootConfig.get_copy_strategies().get(mount.dest)
+        if override is not None:
+            return override == POPULATE_STRATEGY
+
+        return RambootConfig.get_copy_engine() == POPULATE_STRATEGY
+
+    @classmethod
+    def plan(cls, physical_mounts: AllMounts, all_ramdisk_partitions: AllRamdiskPartInfo) -> None:
+        """
+        Pick the partitions to build populated rather than empty.
+
+        Args:
+            physical_mounts (AllMounts): The physical mounts being copied.
+            all_ramdisk_partitions (AllRamdiskPartInfo): The partitions of the ramdisk, one per mount.
+
+        Returns:
+            None
+        """
+        # An early pivot serves mounts from their sources through overlays until the background copy is done
+        if EarlyPivot.is_enabled():
+            return
+
+        mounts = {mount.dest: mount for mount in physical_mounts}
+
+        for part_info in all_ramdisk_partitions:
+            mount = mounts[part_info.destination]
+
+            if not cls.is_wanted(mount):
+                continue
+
+            if part_info.fstype not in POPULATE_FSTYPES:
+                logger.info("%s: not populating with mkfs, the partition is %s", mount.dest, part_info.fstype)
+                continue
+
+            if ExclusionRules.get_exclude(mount) is not None:
+                logger.info("%s: not populating with mkfs, it has exclusion rules", mount.dest)
+                continue
+
+            cls._planned[part_info.order] = (mount, get_masked_paths(mount, physical_mounts))
+
+    @classmethod
+    def populate(cls, part_info: RamdiskPartInfo, device: str) -> bool:
+        """
+        Build a partition populated from its source, if planned.
+
+        Args:
+            part_info (RamdiskPartInfo): The ramdisk partition.
+            device (str): The block device of the partition.
+
+        Returns:
+            bool: True if the partition holds the populated filesystem and needs no formatting, False otherwise.
+        """
+        if part_info.order not in cls._planned:
+            return False
+
+        mount, masked_paths = cls._planned[part_info.order]
+
+        # mke2fs crosses into submounts, the bind mount leaves them out
+        with mounted_source(mount) as source_root, masked_source(source_root, masked_paths, bind=True) as source_view:
+            result = run_command([f"/usr/sbin/mkfs.{part_info.fstype}", "-d", source_view, device])
+
+        if result.returncode != 0:
+            logger.warning("%s: failed to populate with mkfs, copying file by file instead", mount.dest)
+            return False
+
+        logger.info("%s: built %s populated from %s", mount.dest, device, mount.source)
+        cls._populated.add(mount.dest)
+        return True
+
+    @classmethod
+    def discard(cls, dest: str) -> None:
+        """
+        Forget the populated partition of a mount that could not be mounted, so it is copied file by file instead.
+
+        Args:
+            dest (str): The mount point.
+
+        Returns:
+            None
+        """
+        cls._populated.discard(dest)
+
+    @classmethod
+    def is_populated(cls, dest: str) -> bool:
+        """
+        Check if a mount was populated by mkfs, and needs no copying.
+
+        Args:
+            dest (str): The mount point.
+
+        Returns:
+            bool: True if the mount was populated, False otherwise.
+        """
+        return dest in cls._populated
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import subprocess
+from typing import Dict, List, Set
+
+from setup.mounts.mount_info import AllMounts, MountInfo
+from setup.mounts.source_mounts import mount_source
+from setup.ramdisk.keep_on_disk import KeepOnDisk, get_backing_name
+from utils.ramboot_config import RambootConfig
+from utils.shell_commands import get_ramboot_cmd
+
+logger = logging.getLogger(__name__)
+
+# Relative to the ramdisk base, where the sources receiving written back changes are mounted
+WRITE_BACK_DIR = ".ramboot/write_back"
+STATE_FILE = "state.json"
+
+
+class WriteBack:
+    """
+    Keeps configured ramdisk paths persistent by writing their changes back to the source filesystems.
+
+    The sources are mounted inside the ramdisk before pivoting, so their disks are never hidden, and a daemon started
+    after pivoting writes the changes back.
+    """
+
+    _entries: List[Dict] = []
+    _disks_in_use: Set[str] = set()
+
+    @classmethod
+    def get_paths(cls, all_mounts: AllMounts) -> Dict[str, MountInfo]:
+        """
+        Get the configured paths and the mounts holding them.
+
+        Paths kept on disk are skipped, they are written to their source directly.
+
+        Args:
+            all_mounts (AllMounts): All mounts being copied.
+
+        Returns:
+            Dict[str, MountInfo]: Normalized absolute paths mapped to the mount holding them.
+        """
+        kept = KeepOnDisk.get_paths(all_mounts)
+        paths = {}
+
+        for path in RambootConfig.get_write_back_paths():
+            path = os.path.normpath(path)
+
+            if any(path == kept_path or path.startswith(kept_path + os.path.sep) for kept_path in kept):
+                logger.warning("Not writing back %s, it is kept on disk", path)
+                continue
+
+            paths[path] = all_mounts.get_holder(path)
+
+        return paths
+
+    @classmethod
+    def mount_all(cls, all_mounts: AllMounts, ramdisk_base: str) -> None:
+        """
+        Mount the sources of the written back paths inside the ramdisk and record them for the daemon.
+
+        Args:
+            all_mounts (AllMounts): All mounts being copied.
+            ramdisk_base (str): The base directory on the RAM disk.
+
+        Returns:
+            None
+        """
+        cls._entries = []
+        cls._disks_in_use = set()
+        mounted = set()
+
+        for path, mount in cls.get_paths(all_mounts).items():
+            backing = os.path.join(WRITE_BACK_DIR, get_backing_name(mount))
+
+            if mount.dest not in mounted:
+                mount_source(mount, os.path.join(ramdisk_base, backing))
+                mounted.add(mount.dest)
+
+                if mount.get_parent_disks() is not None:
+                    cls._disks_in_use.update(mount.get_parent_disks())
+
+            cls._entries.append({"path": path, "dest": mount.dest, "source": mount.source, "fstype": mount.fstype,
+                                 "fsopts": mount.fsopts, "backing": os.path.join(os.path.sep, backing)})
+            logger.info("%s written back to %s", path, mount.source)
+
+        if cls._entries:
+            with open(os.path.join(ramdisk_base, WRITE_BACK_DIR, STATE_FILE), "w") as f:
+                json.dump(cls._entries, f, indent=2)
+
+    @classmethod
+    def start(cls) -> None:
+        """
+        Start the write-back daemon, if any path is written back.
+
+        Must be called after the root is pivoted, so the daemon watches the ramdisk.
+
+        Returns:
+            None
+        """
+        if not cls._entries:
+            return
+
+        subprocess.Popen(get_ramboot_cmd() + ["write-back"], start_new_session=True)
+
+    @classmethod
+    def get_disks_in_use(cls) -> Set[str]:
+        """
+        Get the disks receiving written back changes.
+
+        Returns:
+            Set[str]: The paths of the parent disks, e.g. /dev/sda.
+        """
+        return cls._disks_in_use
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import shlex
+import subprocess
+from collections import Counter
+from typing import Dict, List
+
+from utils.ramboot_config import RambootConfig
+
+# Fixture format version, bumped if the layout below changes
+FIXTURE_VERSION = 1
+
+
+def command_key(cmd: List[str]) -> str:
+    """
+    Get the key a command's output is stored under in a fixture.
+
+    Args:
+        cmd (List[str]): The command and its arguments.
+
+    Returns:
+        str: The command as a shell-quoted string.
+    """
+    return " ".join(shlex.quote(arg) for arg in cmd)
+
+
+class CommandReplay:
+    """
+    Records the output of the commands used to discover mounts, or replays it from a fixture instead of running them.
+
+    A fixture is a JSON file holding the fstab along with the output of every lsblk, lvs, zpool and zfs command run, so
+    discovery can be measured offline against a recorded host or a synthetic topology.  Commands are counted per program
+    while recording or replaying.
+    """
+
+    _mode: str | None = None
+    _fixture: Dict = {}
+    _counts: Counter = Counter()
+
+    @classmethod
+    def is_active(cls) -> bool:
+        """
+        Check if commands are being recorded or replayed.
+
+        Returns:
+            bool: True if commands go through the replay layer, False otherwise.
+        """
+        return cls._mode is not None
+
+    @classmethod
+    def record(cls) -> None:
+        """
+        Start recording the output of every command run, along with the fstab.
+
+        Returns:
+            None
+        """
+        with open(RambootConfig.get_fstab_file()) as f:
+            fstab = f.read()
+
+        cls._mode = "record"
+        cls._fixture = {"version": FIXTURE_VERSION, "fstab": fstab, "commands": {}}
+        cls._counts = Counter()
+
+    @classmethod
+    def replay(cls, fixture: Dict) -> None:
+        """
+        Start answering commands from a fixture instead of running them.
+
+        Args:
+            fixture (Dict): A recorded or generated fixture.
+
+        Returns:
+            None
+        """
+        cls._mode = "replay"
+        cls._fixture = fixture
+        cls._counts = Counter()
+
+    @classmethod
+    def stop(cls) -> Dict:
+        """
+        Stop recording or replaying.
+
+        Returns:
+            Dict: The fixture, holding everything recorded.
+        """
+        cls._mode = None
+        return cls._fixture
+
+    @classmethod
+    def get_counts(cls) -> Counter:
+        """
+        Get how many times each program was run since recording or replaying started.
+
+        Returns:
+            Counter: The number of runs of each program, by its path as given.
+        """
+        return cls._counts
+
+    @classmethod
+    def check_output(cls, cmd: List[str]) -> str:
+        """
+        Run a command, or answer it from the fixture, like check_output_wrapper.
+
+        Args:
+            cmd (List[str]): The command and its arguments.
+
+        Returns:
+            str: The stripped output of the command.
+
+        Raises:
+            FileNotFoundError: If the program was not installed when the fixture was made.
+            subprocess.CalledProcessError: If the command failed when the fixture was made.
+            KeyError: If the command is not in the fixture being replayed.
+        """
+        cls._counts[cmd[0]] += 1
+        key = command_key(cmd)
+
+        if cls._mode == "record":
+            try:
+                output = subprocess.check_output(cmd).decode("utf-8")
+            except FileNotFoundError:
+                cls._fixture["commands"][key] = {"missing": True}
+                raise
+            except subprocess.CalledProcessError as e:
+                cls._fixture["commands"][key] = {"returncode": e.returncode, "output": e.output.decode("utf-8")}
+                raise
+
+            cls._fixture["commands"][key] = {"returncode": 0, "output": output}
+            return output.strip()
+
+        result = cls._fixture["commands"].get(key)
+        if result is None:
+            raise KeyError(f"{key} is not in the fixture")
+
+        if result.get("missing"):
+            raise FileNotFoundError(cmd[0])
+
+        if result["returncode"] != 0:
+            raise subprocess.CalledProcessError(result["returncode"], cmd, result["output"].encode("utf-8"))
+
+        return result["output"].strip()
+
@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import os
+import re
+from typing import Dict, List, Tuple
+
+GLOB_CHARS = set("*?[")
+
+# Trie keys that can never collide with a path component
+TERMINAL = "\0rule"
+GLOBS = "\0globs"
+
+
+def is_glob(pattern: str) -> bool:
+    """
+    Check if a pattern contains glob characters.
+
+    Args:
+        pattern (str): The pattern to check.
+
+    Returns:
+        bool: True if the pattern contains *, ? or [, False otherwise.
+    """
+    return any(char in GLOB_CHARS for char in pattern)
+
+
+def translate_glob(pattern: str) -> str:
+    """
+    Translate a glob into a regular expression where `*` and `?` stay within a path component and `**` spans any
+    number of components.
+
+    Args:
+        pattern (str): The glob to translate.
+
+    Returns:
+        str: The equivalent regular expression, without anchors.
+    """
+    regex = ""
+    idx = 0
+
+    while idx < len(pattern):
+        char = pattern[idx]
+
+        if pattern.startswith("**/", idx):
+            regex += "(?:.*/)?"
+            idx += 3
+            continue
+
+        if pattern.startswith("**", idx):
+            regex += ".*"
+            idx += 2
+            continue
+
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", idx + 1)
+
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                body = pattern[idx + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += f"[{body}]"
+                idx = end
+        else:
+            regex += re.escape(char)
+
+        idx += 1
+
+    return regex
+
+
+class PathMatcher:
+    """
+    Matches absolute paths against a list of exclusion rules, compiled so each check stays cheap.
+
+    Three kinds of rules are supported:
+        - Absolute paths without glob characters, e.g. /tmp, matching the path and everything below it.
+        - Absolute globs, e.g. /var/cache/*, matching paths relative to the literal directory they start with.
+        - Globs without a /, e.g. *.pyc, matching any path component.
+
+    Literal paths and the literal directories of absolute globs are stored in a trie of path components, so only
+    the globs rooted along a path are ever evaluated.  Component globs are combined into a single regular expression.
+    A path matches if it, or any of its parents, matches a rule.
+    """
+
+    def __init__(self, rules: List[str]):
+        """
+        Compile a list of exclusion rules.
+
+        Args:
+            rules (List[str]): The exclusion rules, in priority order.
+        """
+        self.rules: List[str] = list(rules)
+        self._trie: dict = {}
+
+        component_globs = []
+
+        for idx, rule in enumerate(self.rules):
+            if not rule.startswith(os.path.sep):
+                component_globs.append(f"(?P<r{idx}>{translate_glob(rule)})")
+                continue
+
+            components = [part for part in rule.split(os.path.sep) if part]
+            literal = []
+
+            for part in components:
+                if is_glob(part):
+                    break
+                literal.append(part)
+
+            node = self._trie
+            for part in literal:
+                node = node.setdefault(part, {})
+
+            remainder = components[len(literal):]
+
+            if not remainder:
+                node.setdefault(TERMINAL, idx)
+                continue
+
+            glob = os.path.sep.join(remainder)
+            depth = None if "**" in glob else len(remainder)
+            node.setdefault(GLOBS, []).append((re.compile(translate_glob(glob)), depth, idx))
+
+        self._component_regex = re.compile("|".join(component_globs)) if component_globs else None
+
+    def __bool__(self) -> bool:
+        """
+        Check if the matcher has any rules.
+
+        Returns:
+            bool: True if there are rules, False otherwise.
+        """
+        return bool(self.rules)
+
+    @staticmethod
+    def _split(path: str) -> List[str]:
+        """
+        Split a path into its components, ignoring empty ones.
+
+        Args:
+            path (str): The path to split.
+
+        Returns:
+            List[str]: The path components.
+        """
+        return [part for part in path.split(os.path.sep) if part]
+
+    def match(self, path: str) -> int | None:
+        """
+        Find the rule excluding a path.
+
+        Args:
+            path (str): The absolute path to check.
+
+        Returns:
+            int | None: The index of a matching rule, or None if the path is not excluded.
+        """
+        components = self._split(path)
+
+        if self._component_regex is not None:
+            for part in components:
+                found = self._component_regex.fullmatch(part)
+
+                if found is not None:
+                    return int(found.lastgroup[1:])
+
+        node = self._trie
+        for depth in range(len(components) + 1):
+            if TERMINAL in node:
+                return node[TERMINAL]
+
+            for regex, glob_depth, idx in node.get(GLOBS, ()):
+                lengths = range(1, len(components) - depth + 1) if glob_depth is None else (glob_depth,)
+
+                for length in lengths:
+                    if depth + length <= len(components) and \
+                            regex.fullmatch(os.path.sep.join(components[depth:depth + length])):
+                        return idx
+
+            if depth == len(components) or components[depth] not in node:
+                return None
+
+            node = node[components[depth]]
+
+        return None
+
+    def might_match_below(self, path: str) -> bool:
+        """
+        Check if anything below a directory could match a rule, allowing walks to skip whole subtrees.
+
+        Args:
+            path (str): The absolute path of the directory.
+
+        Returns:
+            bool: True if a path below the directory might be excluded, False if none can be.
+        """
+        if self._component_regex is not None:
+            return True
+
+        node = self._trie
+        for part in self._split(path):
+            if TERMINAL in node or GLOBS in node:
+                return True
+
+            if part not in node:
+                return False
+
+            node = node[part]
+
+        return True
+
+    def summarize(self, rule_bytes: Dict[int, int]) -> List[Tuple[str, int]]:
+        """
+        Pair per-rule byte counts with their rules.
+
+        Args:
+            rule_bytes (Dict[int, int]): Rule indexes mapped to byte counts.
+
+        Returns:
+            List[Tuple[str, int]]: Rules and their byte counts, largest first.
+        """
+        return sorted(((self.rules[idx], size) for idx, size in rule_bytes.items()), key=lambda item: -item[1])
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from utils.ramboot_config import RambootConfig
+
+logger = logging.getLogger(__name__)
+
+# How many functions and allocation sites each report lists
+REPORT_LINES = 40
+
+
+def get_rss_bytes() -> int:
+    """
+    Get the current resident set size of this process.
+
+    Returns:
+        int: The resident bytes.
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_cpu_seconds() -> Tuple[float, float]:
+    """
+    Get the CPU time used so far by this process and by its finished children.
+
+    Returns:
+        Tuple[float, float]: The user plus system seconds of this process and of its children.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+class PhaseProfiler:
+    """
+    Profiles each phase of the boot with cProfile and tracemalloc, alongside its memory and CPU use, to tell time
+    spent in Python apart from time spent in external commands.
+
+    Enabled by the RAMBOOT_PROFILE environment variable or the config.  Only the thread running the boot is profiled,
+    copy workers show up as time spent waiting on them.
+    """
+
+    _enabled: bool = os.getenv("RAMBOOT_PROFILE", "") not in ("", "0") or RambootConfig.get_profiling_enabled()
+    _phases: List[Tuple[str, cProfile.Profile, tracemalloc.Snapshot, int, Dict]] = []
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        """
+        Check if the phases of the boot are profiled.
+
+        Returns:
+            bool: True if profiling is enabled, False otherwise.
+        """
+        return cls._enabled
+
+    @classmethod
+    @contextmanager
+    def profile(cls, name: str) -> Iterator[None]:
+        """
+        Profile a phase of the boot, if profiling is enabled.
+
+        Args:
+            name (str): The name of the phase.
+
+        Yields:
+            None
+        """
+        if not cls._enabled:
+            yield
+            return
+
+        start = time.monotonic()
+        own_start, children_start = get_cpu_seconds()
+        rss_start = get_rss_bytes()
+
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+
+        try:
+            yield
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            own_end, children_end = get_cpu_seconds()
+            usage = {"phase": name, "seconds": round(time.monotonic() - start, 3),
+                     "cpu_seconds": round(own_end - own_start, 3),
+                     "children_cpu_seconds": round(children_end - children_start, 3),
+                     "rss_start_bytes": rss_start, "rss_end_bytes": get_rss_bytes(),
+                     "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                     "python_peak_bytes": peak}
+
+            cls._phases.append((name, profiler, snapshot, peak, usage))
+            logger.info("Profiled %s: %.1fs, %.1fs CPU, %.1fs in children, %d bytes peak in Python", name,
+                        usage["seconds"], usage["cpu_seconds"], usage["children_cpu_seconds"], peak)
+
+    @classmethod
+    def save(cls) -> None:
+        """
+        Write the sorted stats of each profiled phase and a summary of their resource use.
+
+        For each phase, `<n>-<phase>.prof` holds the raw cProfile stats for pstats or a viewer, `<n>-<phase>.txt` the
+        functions sorted by cumulative and by own time, and `<n>-<phase>.memory.txt` the allocation sites still
+        holding the most memory at the end of the phase.
+
+        Returns:
+            None
+        """
+        if not cls._enabled or not cls._phases:
+            return
+
+        directory = RambootConfig.get_profiling_dir()
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+
+            for index, (name, profiler, snapshot, peak, _) in enumerate(cls._phases, start=1):
+                base = os.path.join(directory, f"{index:02d}-{name}")
+                profiler.dump_stats(f"{base}.prof")
+
+                with open(f"{base}.txt", "w") as f:
+                    for sort in (pstats.SortKey.CUMULATIVE, pstats.SortKey.TIME):
+                        stream = io.StringIO()
+                        pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(REPORT_LINES)
+                        f.write(f"Sorted by {sort.value}\n{stream.getvalue()}\n")
+
+                with open(f"{base}.memory.txt", "w") as f:
+                    f.write(f"Peak traced memory: {peak} bytes\n\n")
+                    for statistic in snapshot.statistics("lineno")[:REPORT_LINES]:
+                        f.write(f"{statistic}\n")
+
+            with open(os.path.join(directory, "summary.json"), "w") as f:
+                json.dump([usage for *_, usage in cls._phases], f, indent=2)
+        except OSError as e:
+            logger.warning("Unable to write the profiles to %s: %s", directory, e)
+            return
+
+        logger.info("Profiles of %d phases written to %s", len(cls._phases), directory)
@@ -112,3 +112,498 @@ class RambootConfig:
             str: The alternative filesystem type, defaulting to "ext4".
         """
         return cls._config.get("ramdisk_simple", "zfs_replacement_fstype", fallback="ext4")
+
+    @classmethod
+    def get_scan_workers(cls) -> int:
+        """
+        Get the number of directories to scan concurrently when walking a source tree.
+
+        Returns:
+            int: The number of scan workers, defaulting to 8.
+        """
+        return cls._config.getint("copy", "scan_workers", fallback=8)
+
+    @classmethod
+    def get_copy_workers(cls) -> int:
+        """
+        Get the number of files to copy concurrently when ramboot copies files itself.
+
+        Returns:
+            int: The number of copy workers, defaulting to 8.
+        """
+        return cls._config.getint("copy", "copy_workers", fallback=8)
+
+    @classmethod
+    def get_copy_readers(cls) -> int:
+        """
+        Get the number of reader threads packing files into buffers for the pipeline strategy.
+
+        Returns:
+            int: The number of readers, defaulting to 4.
+        """
+        return cls._config.getint("copy", "readers", fallback=4)
+
+    @classmethod
+    def get_copy_buffer_mb(cls) -> int:
+        """
+        Get the most memory the pipeline strategy holds in file buffers between its readers and writers.
+
+        Returns:
+            int: The cap in megabytes, defaulting to 256.
+        """
+        return cls._config.getint("copy", "buffer_mb", fallback=256)
+
+    @classmethod
+    def get_copy_defer_metadata(cls) -> bool:
+        """
+        Check if the builtin engine applies metadata in batches once the data is copied, instead of after each file.
+
+        Returns:
+            bool: True if metadata is deferred, defaulting to True.
+        """
+        return cls._config.getboolean("copy", "defer_metadata", fallback=True)
+
+    @classmethod
+    def get_copy_adaptive(cls) -> bool:
+        """
+        Check if the builtin engine adapts the number of copy workers to the measured throughput while copying.
+
+        Returns:
+            bool: True if the number of copy workers is adapted, defaulting to False.
+        """
+        return cls._config.getboolean("copy", "adaptive", fallback=False)
+
+    @classmethod
+    def get_copy_min_workers(cls) -> int:
+        """
+        Get the fewest copy workers the adaptive controller may use.
+
+        Returns:
+            int: The minimum number of copy workers, defaulting to 1.
+        """
+        return cls._config.getint("copy", "min_workers", fallback=1)
+
+    @classmethod
+    def get_copy_max_workers(cls) -> int:
+        """
+        Get the most copy workers the adaptive controller may use.
+
+        Returns:
+            int: The maximum number of copy workers, defaulting to 32.
+        """
+        return cls._config.getint("copy", "max_workers", fallback=32)
+
+    @classmethod
+    def get_copy_adapt_interval(cls) -> float:
+        """
+        Get the length of the windows the adaptive controller measures throughput over.
+
+        Returns:
+            float: The window length in seconds, defaulting to 1.
+        """
+        return cls._config.getfloat("copy", "adapt_interval", fallback=1.0)
+
+    @classmethod
+    def get_copy_workers_file(cls) -> str:
+        """
+        Get the file the adaptive controller keeps the learned number of copy workers in, per topology.
+
+        Returns:
+            str: The path of the file, defaulting to /var/lib/ramboot/copy_workers.json.
+        """
+        return cls._config.get("copy", "workers_file", fallback="/var/lib/ramboot/copy_workers.json")
+
+    @classmethod
+    def get_image_cache_enabled(cls) -> bool:
+        """
+        Check if the ramdisk image cache should be used.
+
+        Returns:
+            bool: True if the image cache should be used, defaulting to False.
+        """
+        return cls._config.getboolean("image_cache", "enabled", fallback=False)
+
+    @classmethod
+    def get_image_cache_dir(cls) -> str:
+        """
+        Get the directory holding the cached ramdisk image and its manifest.
+
+        Returns:
+            str: The image cache directory, defaulting to /var/lib/ramboot/image_cache.
+        """
+        return cls._config.get("image_cache", "directory", fallback="/var/lib/ramboot/image_cache")
+
+    @classmethod
+    def get_image_cache_refresh_ratio(cls) -> float:
+        """
+        Get the fraction of bytes copied from the source, relative to bytes restored from the image, above which
+        the cached image is rewritten after a delta restore.
+
+        Returns:
+            float: The refresh ratio, defaulting to 0.1.
+        """
+        return cls._config.getfloat("image_cache", "refresh_ratio", fallback=0.1)
+
+    @classmethod
+    def get_compressed_image_paths(cls) -> list:
+        """
+        Get the subtrees to pack into read-only compressed images with a writable overlay.
+
+        Returns:
+            list: A list of absolute paths, defaulting to an empty list.
+        """
+        return json.loads(cls._config.get("compressed_images", "paths", fallback="[]"))
+
+    @classmethod
+    def get_compressed_image_format(cls) -> str:
+        """
+        Get the filesystem used for compressed images.
+
+        Returns:
+            str: Either "squashfs" or "erofs", defaulting to "squashfs".
+        """
+        return cls._config.get("compressed_images", "format", fallback="squashfs")
+
+    @classmethod
+    def get_compressed_image_compression(cls) -> str:
+        """
+        Get the compression algorithm used for compressed images.
+
+        Returns:
+            str: The compression algorithm, defaulting to "zstd".
+        """
+        return cls._config.get("compressed_images", "compression", fallback="zstd")
+
+    @classmethod
+    def get_compressed_image_tmpfs_size(cls) -> str | None:
+        """
+        Get the size limit of the tmpfs holding compressed images and their overlay upper directories.
+
+        Returns:
+            str | None: A tmpfs size option such as "8G" or "25%", defaulting to None (the kernel default).
+        """
+        return cls._config.get("compressed_images", "tmpfs_size", fallback=None)
+
+    @classmethod
+    def get_dedup_enabled(cls) -> bool:
+        """
+        Check if identical files on the ramdisk should be hardlinked together after copying.
+
+        Returns:
+            bool: True if deduplication is enabled, defaulting to False.
+        """
+        return cls._config.getboolean("dedup", "enabled", fallback=False)
+
+    @classmethod
+    def get_dedup_min_size(cls) -> int:
+        """
+        Get the smallest file size, in bytes, considered for deduplication.
+
+        Returns:
+            int: The minimum file size, defaulting to 4096.
+        """
+        return cls._config.getint("dedup", "min_size", fallback=4096)
+
+    @classmethod
+    def get_dedup_workers(cls) -> int:
+        """
+        Get the number of hashing workers used for deduplication.
+
+        Returns:
+            int: The number of hashing workers, defaulting to 4.
+        """
+        return cls._config.getint("dedup", "workers", fallback=4)
+
+    @classmethod
+    def get_dedup_exclude(cls) -> list:
+        """
+        Get the paths below which files are never hardlinked, since they may be modified in place.
+
+        Returns:
+            list: A list of absolute paths, defaulting to common mutable locations.
+        """
+        default = '["/etc", "/home", "/root", "/tmp", "/var/tmp", "/var/log", "/var/spool"]'
+        return json.loads(cls._config.get("dedup", "exclude", fallback=default))
+
+    @classmethod
+    def get_copy_engine(cls) -> str:
+        """
+        Get the engine used to copy mounts to the ramdisk.
+
+        Returns:
+            str: A copy strategy, "cp", "builtin", "inode_order", "pipeline", "clone" or "populate", or "auto" to
+                pick one per mount, defaulting to "cp".  The builtin engine is used instead of cp for mounts with
+                exclusion rules.
+        """
+        return cls._config.get("copy", "engine", fallback="cp")
+
+    @classmethod
+    def get_copy_strategies(cls) -> dict:
+        """
+        Get the copy strategies configured for specific mounts, which take precedence over the engine.
+
+        Returns:
+            dict: The name of the strategy by mount point, defaulting to {}.
+        """
+        return json.loads(cls._config.get("copy", "strategies", fallback="{}"))
+
+    @classmethod
+    def get_copy_calibrate(cls) -> bool:
+        """
+        Check if the auto engine times a short read of each source to pick its copy strategy.
+
+        Returns:
+            bool: True if the read calibration is enabled, defaulting to False.
+        """
+        return cls._config.getboolean("copy", "calibrate", fallback=False)
+
+    @classmethod
+    def get_exclude_rules(cls) -> list:
+        """
+        Get the rules for paths whose contents should not be copied to the ramdisk.
+
+        Returns:
+            list: A list of absolute paths, absolute globs and component globs, defaulting to an empty list.
+        """
+        return json.loads(cls._config.get("exclude", "rules", fallback="[]"))
+
+    @classmethod
+    def get_keep_on_disk(cls) -> dict:
+        """
+        Get the subtrees that stay on disk and are bind mounted into the ramdisk instead of being copied.
+
+        Returns:
+            dict: Absolute paths mapped to "ro" or "rw", defaulting to an empty dict.
+        """
+        return json.loads(cls._config.get("keep_on_disk", "paths", fallback="{}"))
+
+    @classmethod
+    def get_profile_record(cls) -> bool:
+        """
+        Check if the files opened after the root is pivoted should be recorded into an access profile.
+
+        Returns:
+            bool: True if an access profile should be recorded, defaulting to False.
+        """
+        return cls._config.getboolean("profile", "record", fallback=False)
+
+    @classmethod
+    def get_profile_record_seconds(cls) -> int:
+        """
+        Get how long to record opened files for after the root is pivoted.
+
+        Returns:
+            int: The recording duration in seconds, defaulting to 120.
+        """
+        return cls._config.getint("profile", "record_seconds", fallback=120)
+
+    @classmethod
+    def get_profile_path(cls) -> str:
+        """
+        Get the path of the access profile on the root filesystem.
+
+        Returns:
+            str: The access profile path, defaulting to /var/lib/ramboot/boot_profile.gz.
+        """
+        return cls._config.get("profile", "path", fallback="/var/lib/ramboot/boot_profile.gz")
+
+    @classmethod
+    def get_profile_use(cls) -> bool:
+        """
+        Check if an existing access profile should be used to copy boot-critical files first.
+
+        Returns:
+            bool: True if the access profile should be used, defaulting to True.
+        """
+        return cls._config.getboolean("profile", "use", fallback=True)
+
+    @classmethod
+    def get_early_pivot(cls) -> bool:
+        """
+        Check if the root should be pivoted once the boot-critical set is copied, copying the rest in the background.
+
+        Returns:
+            bool: True if the root should be pivoted early, defaulting to False.
+        """
+        return cls._config.getboolean("early_pivot", "enabled", fallback=False)
+
+    @classmethod
+    def get_early_pivot_status_file(cls) -> str:
+        """
+        Get the file reporting the progress of the background copy after an early pivot.
+
+        Returns:
+            str: The status file path, defaulting to /run/ramboot/early_pivot.json.
+        """
+        return cls._config.get("early_pivot", "status_file", fallback="/run/ramboot/early_pivot.json")
+
+    @classmethod
+    def get_write_back_paths(cls) -> list:
+        """
+        Get the ramdisk paths whose changes are written back to their source filesystems.
+
+        Returns:
+            list: Absolute paths, defaulting to an empty list.
+        """
+        return json.loads(cls._config.get("write_back", "paths", fallback="[]"))
+
+    @classmethod
+    def get_write_back_flush_interval(cls) -> int:
+        """
+        Get how often changes are written back to the source filesystems.
+
+        Returns:
+            int: The flush interval in seconds, defaulting to 30.
+        """
+        return cls._config.getint("write_back", "flush_interval", fallback=30)
+
+    @classmethod
+    def get_write_back_metrics_file(cls) -> str:
+        """
+        Get the file reporting write-back lag and the amount of data written back.
+
+        Returns:
+            str: The metrics file path, defaulting to /run/ramboot/write_back.json.
+        """
+        return cls._config.get("write_back", "metrics_file", fallback="/run/ramboot/write_back.json")
+
+    @classmethod
+    def get_reclaim_discard(cls) -> bool:
+        """
+        Check if the ramdisk filesystems should be mounted with discard, freeing memory as files are deleted.
+
+        Returns:
+            bool: True if the ramdisk filesystems are mounted with discard, defaulting to False.
+        """
+        return cls._config.getboolean("reclaim", "discard", fallback=False)
+
+    @classmethod
+    def get_reclaim_trim_interval(cls) -> int:
+        """
+        Get how often the ramdisk filesystems are trimmed to free the memory of deleted files.
+
+        Returns:
+            int: The trim interval in seconds, defaulting to 0 (never).
+        """
+        return cls._config.getint("reclaim", "trim_interval", fallback=0)
+
+    @classmethod
+    def get_trace_enabled(cls) -> bool:
+        """
+        Check if the phases of the boot should be traced.
+
+        Returns:
+            bool: True if a trace is written, defaulting to False.
+        """
+        return cls._config.getboolean("trace", "enabled", fallback=False)
+
+    @classmethod
+    def get_trace_file(cls) -> str:
+        """
+        Get the file the trace is written to, on the ramdisk once the root is pivoted.
+
+        Returns:
+            str: The trace file path, defaulting to /var/log/ramboot/trace.json.
+        """
+        return cls._config.get("trace", "file", fallback="/var/log/ramboot/trace.json")
+
+    @classmethod
+    def get_metrics_textfile(cls) -> str | None:
+        """
+        Get the Prometheus textfile the boot metrics are written to, for the node_exporter textfile collector.
+
+        Returns:
+            str | None: The .prom file path, defaulting to None (no metrics are written).
+        """
+        return cls._config.get("metrics", "textfile", fallback=None)
+
+    @classmethod
+    def get_history_file(cls) -> str | None:
+        """
+        Get the file on disk a record of each boot is appended to.
+
+        Returns:
+            str | None: The history file path, defaulting to None (no history is kept).
+        """
+        return cls._config.get("history", "file", fallback=None)
+
+    @classmethod
+    def get_history_threshold(cls) -> float:
+        """
+        Get how much slower than its rolling median a phase has to be to be flagged as a regression.
+
+        Returns:
+            float: The threshold as a fraction of the median, defaulting to 0.25.
+        """
+        return cls._config.getfloat("history", "threshold", fallback=0.25)
+
+    @classmethod
+    def get_history_window(cls) -> int:
+        """
+        Get how many previous boots the rolling median of each phase is taken over.
+
+        Returns:
+            int: The number of boots, defaulting to 10.
+        """
+        return cls._config.getint("history", "window", fallback=10)
+
+    @classmethod
+    def get_progress_interval(cls) -> int:
+        """
+        Get how often the progress of copying each mount is reported.
+
+        Returns:
+            int: The interval in seconds, defaulting to 10.  0 disables progress reports.
+        """
+        return cls._config.getint("progress", "interval", fallback=10)
+
+    @classmethod
+    def get_progress_stall_timeout(cls) -> int:
+        """
+        Get how long a copy may make no progress before a stall warning names the file being copied.
+
+        Returns:
+            int: The timeout in seconds, defaulting to 60.  0 disables stall warnings.
+        """
+        return cls._config.getint("progress", "stall_timeout", fallback=60)
+
+    @classmethod
+    def get_progress_output(cls) -> str:
+        """
+        Get where progress reports are written.
+
+        Returns:
+            str: A file such as /dev/kmsg or /dev/console, defaulting to /dev/kmsg.
+        """
+        return cls._config.get("progress", "output", fallback="/dev/kmsg")
+
+    @classmethod
+    def get_progress_count(cls) -> str:
+        """
+        Get how the bytes and files to copy are counted up front.
+
+        Returns:
+            str: "statvfs" for the used figure of the source filesystem, or "scan" for a parallel scan of the
+                source, defaulting to "statvfs".
+        """
+        return cls._config.get("progress", "count", fallback="statvfs")
+
+    @classmethod
+    def get_profiling_enabled(cls) -> bool:
+        """
+        Check if each phase of the boot should be profiled, also enabled by the RAMBOOT_PROFILE environment variable.
+
+        Returns:
+            bool: True if the phases are profiled, defaulting to False.
+        """
+        return cls._config.getboolean("profiling", "enabled", fallback=False)
+
+    @classmethod
+    def get_profiling_dir(cls) -> str:
+        """
+        Get the directory the profiles are written to, on the ramdisk once the root is pivoted.
+
+        Returns:
+            str: The profile directory, defaulting to /var/log/ramboot/profile.
+        """
+        return cls._config.get("profiling", "directory", fallback="/var/log/ramboot/profile")
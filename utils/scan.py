@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import os
+import stat
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# (relative path, stat result) for a single entry below the scan root
+ScanResult = Tuple[str, os.stat_result]
+
+# Directories scanned ahead of the consumer per worker
+SCAN_AHEAD = 2
+
+
+def scan_directory(root: str, rel_dir: str, root_dev: int | None, skip: Callable[[str, bool], bool] | None,
+                   exclude: Callable[[str, bool], bool] | None = None) -> Tuple[List[ScanResult], List[str]]:
+    """
+    Scan a single directory without descending into it.
+
+    Args:
+        root (str): The root of the scan.
+        rel_dir (str): The directory to scan, relative to the root.
+        root_dev (int | None): If set, subdirectories on a different device are not descended into.
+        skip (Callable[[str, bool], bool] | None): Called with a relative path and whether it is a directory,
+            returning True if the entry should be left out of the scan.
+        exclude (Callable[[str, bool], bool] | None): Like skip, but excluded directories are still returned, only
+            their contents are left out.
+
+    Returns:
+        Tuple[List[ScanResult], List[str]]: The entries found and the subdirectories left to scan.
+    """
+    results = []
+    subdirs = []
+
+    try:
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                rel_path = os.path.join(rel_dir, entry.name)
+
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # Vanished while scanning
+                    continue
+
+                is_dir = stat.S_ISDIR(entry_stat.st_mode)
+
+                if skip is not None and skip(rel_path, is_dir):
+                    continue
+
+                excluded = exclude is not None and exclude(rel_path, is_dir)
+                if excluded and not is_dir:
+                    continue
+
+                results.append((rel_path, entry_stat))
+
+                # Mimic --one-file-system, keep the mount point but not its contents
+                if is_dir and not excluded and (root_dev is None or entry_stat.st_dev == root_dev):
+                    subdirs.append(rel_path)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+
+    return results, subdirs
+
+
+def parallel_scan(root: str, workers: int = 8, one_file_system: bool = True,
+                  skip: Callable[[str, bool], bool] | None = None,
+                  exclude: Callable[[str, bool], bool] | None = None,
+                  on_scanned: Callable[[str], None] | None = None) -> Iterator[ScanResult]:
+    """
+    Walk a directory tree using a pool of os.scandir workers.
+
+    Only a few directories per worker are scanned ahead of the consumer, and the rest are taken depth first, so
+    memory is bound by the depth of the tree and the number of workers rather than the size of the tree: the
+    directories waiting to be scanned are the unscanned siblings along the current path.  Results are not ordered,
+    except that a directory is always yielded before its contents.  Once the entries of a directory have been
+    yielded, or right after it if it is not descended into, it is passed to `on_scanned`.
+
+    Args:
+        root (str): The directory to walk.
+        workers (int): The number of directories to scan concurrently.
+        one_file_system (bool): Whether to stay on the filesystem of the root.
+        skip (Callable[[str, bool], bool] | None): Called with a relative path and whether it is a directory,
+            returning True if the entry should be left out of the scan.
+        exclude (Callable[[str, bool], bool] | None): Like skip, but excluded directories are still yielded, only
+            their contents are left out.
+        on_scanned (Callable[[str], None] | None): Called with the relative path of each directory, the root
+            included, once its own entries have been yielded.
+
+    Yields:
+        ScanResult: The relative path and lstat result of each entry below the root.
+    """
+    root_dev = os.lstat(root).st_dev if one_file_system else None
+    workers = max(1, workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        waiting = [""]
+        pending: Dict[Future, str] = {}
+
+        while waiting or pending:
+            while waiting and len(pending) < workers * SCAN_AHEAD:
+                rel_dir = waiting.pop()
+                pending[executor.submit(scan_directory, root, rel_dir, root_dev, skip, exclude)] = rel_dir
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                rel_dir = pending.pop(future)
+                results, subdirs = future.result()
+
+                # Reversed, so the stack hands them out in the order they were found
+                waiting.extend(reversed(subdirs))
+
+                yield from results
+
+                if on_scanned is not None:
+                    descended = set(subdirs)
+                    for rel_path, entry_stat in results:
+                        if stat.S_ISDIR(entry_stat.st_mode) and rel_path not in descended:
+                            on_scanned(rel_path)
+
+                    on_scanned(rel_dir)
@@ -3,11 +3,40 @@ from __future__ import annotations
 import json
 import subprocess
 import os
-from typing import List
+import sys
+from typing import List, Set
+
+from utils.command_replay import CommandReplay
+from utils.trace import Tracer
+
+# Device types that are whole disks, loop devices back the sources of the end-to-end benchmark
+DISK_TYPES = {"disk", "loop"}
 
 
 def check_output_wrapper(cmd: List[str]) -> str:
-    return subprocess.check_output(cmd).decode("utf-8").strip()
+    with Tracer.span(os.path.basename(cmd[0]), "command", cmd=cmd):
+        if CommandReplay.is_active():
+            return CommandReplay.check_output(cmd)
+
+        return subprocess.check_output(cmd).decode("utf-8").strip()
+
+
+def run_command(cmd: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """
+    Run an external command, like subprocess.run, timing it when tracing.
+
+    Args:
+        cmd (List[str]): The command and its arguments.
+        **kwargs: Passed on to subprocess.run.
+
+    Returns:
+        subprocess.CompletedProcess: The finished command.
+    """
+    with Tracer.span(os.path.basename(cmd[0]), "command", cmd=cmd) as span:
+        result = subprocess.run(cmd, **kwargs)
+        span["returncode"] = result.returncode
+
+    return result
 
 
 def get_device_json_tree(device: str) -> dict:
@@ -19,17 +48,21 @@ def get_device_json_tree(device: str) -> dict:
 
 
 def get_field_from_key_val(device: str, field: str, key: str, val: str) -> str | None:
-    def check(_tree: dict, _field: str, _key: str, _val: str) -> str | None:
-        if _key in _tree and _tree[_key] == _val:
+    return get_field_from_key_vals(device, field, key, {val})
+
+
+def get_field_from_key_vals(device: str, field: str, key: str, vals: Set[str]) -> str | None:
+    def check(_tree: dict, _field: str, _key: str, _vals: Set[str]) -> str | None:
+        if _key in _tree and _tree[_key] in _vals:
             return _tree[_field]
 
         if "children" in _tree:
-            return check(_tree["children"][0], _field, _key, _val)
+            return check(_tree["children"][0], _field, _key, _vals)
 
         return None
 
     tree = get_device_json_tree(device)
-    return check(tree, field, key, val)
+    return check(tree, field, key, vals)
 
 
 def get_first_matching_field(device: str, field: str, continue_on_none: bool = True) -> str | None:
@@ -54,15 +87,19 @@ def get_mount_size(device: str) -> int:
 
 
 def get_disk_size(device: str) -> int:
-    return int(get_field_from_key_val(device, "size", "type", "disk"))
+    return int(get_field_from_key_vals(device, "size", "type", DISK_TYPES))
 
 
 def get_all_fields_from_key_val(device: str, field: str, key: str, val: str) -> List[str]:
+    return get_all_fields_from_key_vals(device, field, key, {val})
+
+
+def get_all_fields_from_key_vals(device: str, field: str, key: str, vals: Set[str]) -> List[str]:
     tree = get_device_json_tree(device)
     matches = set()
 
     def traverse(_tree: dict):
-        if key in _tree and _tree[key] == val:
+        if key in _tree and _tree[key] in vals:
             matches.add(_tree[field])
 
         if "children" in _tree:
@@ -74,7 +111,7 @@ def get_all_fields_from_key_val(device: str, field: str, key: str, val: str) ->
 
 
 def get_device_disks(device: str) -> List[str]:
-    return get_all_fields_from_key_val(device, "name", "type", "disk")
+    return get_all_fields_from_key_vals(device, "name", "type", DISK_TYPES)
 
 
 def get_device_partitions(device: str) -> List[str]:
@@ -93,10 +130,24 @@ def run_commands(*args: List[str]) -> None:
             return
 
         try:
-            subprocess.run(arg)
+            run_command(arg)
         except FileNotFoundError:
             pass
 
 
 def check_command(cmd: List[str]) -> bool:
     return os.path.exists(cmd[0])
+
+
+def get_ramboot_cmd() -> List[str]:
+    """
+    Get the command that runs this ramboot binary (or script) again, for spawning background helpers.
+
+    Returns:
+        List[str]: The command, to be followed by a subcommand and its arguments.
+    """
+    # PyInstaller sets sys.frozen, the executable is ramboot itself
+    if getattr(sys, "frozen", False):
+        return [sys.executable]
+
+    return [sys.executable, os.path.abspath(sys.argv[0])]
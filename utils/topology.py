@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from setup.mounts.mount_info import AllMounts
+
+
+def get_topology_fingerprint(physical_mounts: AllMounts) -> str:
+    """
+    Fingerprint the mounts being copied, so boots are only compared against boots of the same system layout.
+
+    Args:
+        physical_mounts (AllMounts): The physical mounts being copied.
+
+    Returns:
+        str: A short hash of the sources, mount points, filesystem types and parent disks.
+    """
+    topology = [[mount.source, mount.dest, mount.fstype, mount.get_parent_disks()] for mount in physical_mounts]
+    return hashlib.sha256(json.dumps(topology, default=str).encode()).hexdigest()[:12]
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, ContextManager, Dict, List
+
+from utils.ramboot_config import RambootConfig
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """
+    A timed section of the boot, recorded as a complete event once it ends.
+
+    Attributes:
+        name (str): The name shown for the span.
+        category (str): The category of the span, e.g. phase, mount, command or copy.
+        args (Dict): Details shown with the span, such as byte counts and results, which may be added while it runs.
+    """
+
+    __slots__ = ("name", "category", "args", "start")
+
+    def __init__(self, name: str, category: str, args: Dict):
+        """
+        Initialize a span, which starts once it is entered.
+
+        Args:
+            name (str): The name shown for the span.
+            category (str): The category of the span.
+            args (Dict): Details shown with the span.
+        """
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0
+
+    def __enter__(self) -> Dict:
+        self.start = time.perf_counter_ns()
+        return self.args
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self.args["error"] = repr(exc_value)
+
+        Tracer.add_span(self.name, self.category, self.start, time.perf_counter_ns(), self.args)
+
+
+class Tracer:
+    """
+    Records nested spans for the phases of a boot and writes them as a Chrome trace, for Perfetto or
+    chrome://tracing.
+
+    Spans nest by time on each thread, so a span entered inside another is shown below it.  Listeners are told about
+    every span that ends, whether the trace is written or not.  When tracing is disabled and nothing listens, spans cost
+    a single check.
+    """
+
+    _enabled: bool = RambootConfig.get_trace_enabled()
+    _events: List[Dict] = []
+    _threads: Dict[int, str] = {}
+    _listeners: List[Callable[[str, str, float, Dict], None]] = []
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        """
+        Check if spans are recorded.
+
+        Returns:
+            bool: True if tracing is enabled, False otherwise.
+        """
+        return cls._enabled
+
+    @classmethod
+    def add_listener(cls, listener: Callable[[str, str, float, Dict], None]) -> None:
+        """
+        Have a callback told about every span that ends, even if the trace is not written.
+
+        Args:
+            listener (Callable[[str, str, float, Dict], None]): Called with the name, category, duration in seconds
+                and details of each span, from the thread that ended it.
+
+        Returns:
+            None
+        """
+        cls._listeners.append(listener)
+
+    @classmethod
+    def span(cls, name: str, category: str, **args) -> ContextManager[Dict]:
+        """
+        Time a section of the boot.
+
+        Args:
+            name (str): The name shown for the span.
+            category (str): The category of the span, e.g. phase, mount, command or copy.
+            **args: Details shown with the span.
+
+        Returns:
+            ContextManager[Dict]: A context manager giving the details of the span, to add results to.
+        """
+        if not cls._enabled and not cls._listeners:
+            return contextlib.nullcontext(args)
+
+        return Span(name, category, args)
+
+    @classmethod
+    def add_span(cls, name: str, category: str, start: int, end: int, args: Dict,
+                 thread: threading.Thread | None = None) -> None:
+        """
+        Record a span that has ended.
+
+        Args:
+            name (str): The name shown for the span.
+            category (str): The category of the span.
+            start (int): When the span started, from time.perf_counter_ns().
+            end (int): When the span ended, from time.perf_counter_ns().
+            args (Dict): Details shown with the span.
+            thread (threading.Thread | None): The thread to show the span on, defaulting to the current thread.
+
+        Returns:
+            None
+        """
+        for listener in cls._listeners:
+            listener(name, category, (end - start) / 1e9, args)
+
+        if not cls._enabled:
+            return
+
+        if thread is None:
+            thread = threading.current_thread()
+
+        event = {"name": name, "cat": category, "ph": "X", "ts": start / 1000, "dur": (end - start) / 1000,
+                 "pid": os.getpid(), "tid": thread.ident, "args": args}
+
+        with cls._lock:
+            cls._events.append(event)
+            cls._threads[thread.ident] = thread.name
+
+    @classmethod
+    def save(cls) -> None:
+        """
+        Write the recorded spans to the trace file, if tracing is enabled.
+
+        Returns:
+            None
+        """
+        if not cls._enabled:
+            return
+
+        path = RambootConfig.get_trace_file()
+
+        with cls._lock:
+            metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread_id,
+                         "args": {"name": name}} for thread_id, name in cls._threads.items()]
+            trace = {"traceEvents": metadata + cls._events, "displayTimeUnit": "ms"}
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(trace, f)
+        except OSError as e:
+            logger.warning("Unable to write the trace to %s: %s", path, e)
+            return
+
+        logger.info("Trace of %d spans written to %s", len(trace["traceEvents"]) - len(metadata), path)